@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Stand-in for docker command, to benchmark vdist without real containers.
+
+It understands the docker commands vdist runs. Every image exists, so builds
+always take provisioning snapshot hit path, and every build script prints
+some output, optionally waits and leaves a package in the build folder.
+
+Behaviour is tuned through environment variables:
+    FAKE_DOCKER_STATE: folder where fake containers are kept (mandatory).
+    FAKE_DOCKER_BUILD_SECONDS: how long every build script lasts (0).
+    FAKE_DOCKER_OUTPUT_LINES: lines every build script prints (1000), one of
+        every ten to stderr, like bash -x traces.
+    FAKE_DOCKER_PACKAGE_SIZE: bytes of package every build generates (1 MiB).
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+import uuid
+
+PHASES = ['setup', 'python', 'source', 'dependencies', 'install', 'package']
+WRITE_BLOCK_SIZE = 1024 * 1024
+PACKAGE_NAME = 'package_1.0_amd64.deb'
+
+
+def _get_setting(name, default):
+    return type(default)(os.environ.get(name, default))
+
+
+def _get_container_file(container_id):
+    return os.path.join(os.environ['FAKE_DOCKER_STATE'],
+                        '%s.json' % container_id)
+
+
+def inspect(arguments):
+    if any('.Config.Labels' in argument for argument in arguments):
+        # Only label vdist reads is provisioning time of snapshots.
+        print('0')
+    else:
+        print('sha256:%s' % ('0' * 64))
+    return 0
+
+
+def run(arguments):
+    binds = {}
+    for position, argument in enumerate(arguments):
+        if argument == '-v':
+            host_path, container_path = arguments[position + 1].split(':')[:2]
+            binds[container_path] = host_path
+    container_id = uuid.uuid4().hex
+    with open(_get_container_file(container_id), 'w') as f:
+        json.dump(binds, f)
+    print(container_id)
+    return 0
+
+
+def _get_host_path(binds, container_path):
+    for bind_path in sorted(binds, key=len, reverse=True):
+        if container_path.startswith(bind_path + '/'):
+            return binds[bind_path] + container_path[len(bind_path):]
+    return None
+
+
+def _print_output(lines, duration):
+    # Output is spread along the phases, waiting between them.
+    pause = duration / len(PHASES)
+    lines_per_phase = lines // len(PHASES)
+    for phase in PHASES:
+        print('##vdist-phase %s %.3f' % (phase, time.time()))
+        for line_number in range(lines_per_phase):
+            if line_number % 10 == 0:
+                print('+ traced command %d' % line_number, file=sys.stderr)
+            else:
+                print('output line %d of phase %s' % (line_number, phase))
+        sys.stdout.flush()
+        time.sleep(pause)
+    print('##vdist-exit 0 %.3f' % time.time())
+
+
+def _write_package(shared_dir):
+    package_size = _get_setting('FAKE_DOCKER_PACKAGE_SIZE', WRITE_BLOCK_SIZE)
+    block = b'0' * WRITE_BLOCK_SIZE
+    with open(os.path.join(shared_dir, PACKAGE_NAME), 'wb') as f:
+        while package_size > 0:
+            f.write(block[:package_size])
+            package_size -= WRITE_BLOCK_SIZE
+    # Like profile templates do.
+    with open(os.path.join(shared_dir, 'scratch', 'packages.list'), 'a') as f:
+        f.write('%s\n' % PACKAGE_NAME)
+
+
+def exec_(arguments):
+    container_id, script = arguments[0], arguments[1]
+    with open(_get_container_file(container_id)) as f:
+        binds = json.load(f)
+    script_path = _get_host_path(binds, script)
+    if script_path is None or not os.path.isfile(script_path):
+        print('%s: no such file' % script, file=sys.stderr)
+        return 127
+    if os.path.basename(script) == 'buildscript.sh':
+        _print_output(_get_setting('FAKE_DOCKER_OUTPUT_LINES', 1000),
+                      _get_setting('FAKE_DOCKER_BUILD_SECONDS', 0.0))
+        # Build folder is the one holding scratch folder with the script.
+        _write_package(os.path.dirname(os.path.dirname(script_path)))
+    return 0
+
+
+def rm(arguments):
+    container_file = _get_container_file(arguments[-1])
+    if os.path.exists(container_file):
+        os.remove(container_file)
+    return 0
+
+
+def ignore(arguments):
+    return 0
+
+
+COMMANDS = {'inspect': inspect,
+            'pull': ignore,
+            'run': run,
+            'exec': exec_,
+            'commit': ignore,
+            'stop': ignore,
+            'rm': rm}
+
+
+if __name__ == '__main__':
+    sys.exit(COMMANDS.get(sys.argv[1], ignore)(sys.argv[2:]))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Measure vdist host side overhead running builds against a fake docker.
+
+Every scenario runs a number of builds of a local source tree of a given
+size in a fresh process with its own HOME, so vdist caches start empty and
+resource usage is measured for that scenario alone. Containers are replaced
+by fake_docker.py, so what is measured is vdist itself: build folder
+creation, source copying, template rendering, threads, log streaming and
+package delivery.
+
+Results are written as JSON to be compared between vdist versions.
+
+Usage:
+    python benchmarks/run_benchmarks.py --builds 1,10 --source-sizes 1M,100M
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKE_DOCKER = os.path.join(BENCHMARKS_DIR, 'fake_docker.py')
+
+DEFAULT_BUILDS = '1,10,100,500'
+DEFAULT_SOURCE_SIZES = '1M,100M,1G,5G'
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+SOURCE_FILE_SIZE = 1024 * 1024
+SOURCE_FILES_PER_DIR = 100
+SAMPLE_INTERVAL = 0.01
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def create_source_tree(path, size):
+    block = os.urandom(SOURCE_FILE_SIZE)
+    with open(os.path.join(path, 'setup.py'), 'w') as f:
+        f.write('from setuptools import setup\nsetup(name="benchmark")\n')
+    file_number = 0
+    while size > 0:
+        directory = os.path.join(
+            path, 'package%d' % (file_number // SOURCE_FILES_PER_DIR))
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        with open(os.path.join(directory, 'data%d.bin' % file_number),
+                  'wb') as f:
+            f.write(block[:size])
+        size -= SOURCE_FILE_SIZE
+        file_number += 1
+
+
+class ResourceSampler(threading.Thread):
+    # Peak thread and file descriptor counts of this process.
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='sampler')
+        self.daemon = True
+        self.peak_threads = 0
+        self.peak_fds = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_threads = max(self.peak_threads,
+                                    threading.active_count() - 1)
+            self.peak_fds = max(self.peak_fds,
+                                len(os.listdir('/proc/self/fd')))
+            self._stop_event.wait(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _count_log(build_dir):
+    lines = 0
+    size = 0
+    log_path = os.path.join(build_dir, 'logs', 'machine.log')
+    if os.path.isfile(log_path):
+        size = os.path.getsize(log_path)
+        with open(log_path, 'rb') as f:
+            lines = sum(1 for _ in f)
+    return lines, size
+
+
+def run_scenario(arguments):
+    # Runs in a child process, with HOME already pointing to a scratch
+    # folder, so vdist is imported only now.
+    sys.path.insert(0, REPOSITORY_DIR)
+    import logging
+    import vdist.builder as builder
+    import vdist.configuration as configuration
+
+    logging.disable(logging.CRITICAL if arguments.quiet else logging.NOTSET)
+    vdist_builder = builder.Builder(max_jobs=arguments.jobs,
+                                    start_delay=0,
+                                    docker_backend='cli',
+                                    docker_cli=FAKE_DOCKER,
+                                    use_result_cache=False)
+    for build_number in range(arguments.builds):
+        _configuration = configuration.Configuration({
+            'app': 'app%d' % build_number,
+            'version': '1.0',
+            'profile': 'ubuntu-trusty',
+            'source_directory': arguments.source,
+            'output_folder': arguments.output_folder})
+        build = vdist_builder.add_build(**_configuration.builder_parameters)
+        vdist_builder.add_output_folder(build, _configuration.output_folder)
+
+    sampler = ResourceSampler()
+    sampler.start()
+    start_time = time.time()
+    results = vdist_builder.build()
+    wall_seconds = time.time() - start_time
+    sampler.stop()
+
+    log_lines = 0
+    log_bytes = 0
+    delivery_seconds = 0
+    for result in results:
+        for artifact in result.report.get('artifacts', []):
+            delivery_seconds += artifact['seconds']
+        if result.build_dir is not None:
+            lines, size = _count_log(result.build_dir)
+            log_lines += lines
+            log_bytes += size
+    return {
+        'builds': arguments.builds,
+        'failed_builds': len([result for result in results
+                              if not result.succeeded]),
+        'wall_seconds': round(wall_seconds, 3),
+        'delivery_seconds': round(delivery_seconds, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss,
+        'peak_threads': sampler.peak_threads,
+        'peak_fds': sampler.peak_fds,
+        'log_lines': log_lines,
+        'log_lines_per_second': round(log_lines / wall_seconds, 1),
+        'log_bytes_per_second': round(log_bytes / wall_seconds, 1),
+    }
+
+
+def _get_vdist_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=REPOSITORY_DIR).decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_child(arguments, builds, source_dir, source_size):
+    scratch_dir = tempfile.mkdtemp(prefix='vdist-benchmark-')
+    try:
+        home_dir = os.path.join(scratch_dir, 'home')
+        state_dir = os.path.join(scratch_dir, 'containers')
+        os.mkdir(home_dir)
+        os.mkdir(state_dir)
+        environment = dict(os.environ,
+                           HOME=home_dir,
+                           FAKE_DOCKER_STATE=state_dir,
+                           FAKE_DOCKER_BUILD_SECONDS=str(
+                               arguments.build_seconds),
+                           FAKE_DOCKER_OUTPUT_LINES=str(arguments.output_lines),
+                           FAKE_DOCKER_PACKAGE_SIZE=str(
+                               parse_size(arguments.package_size)))
+        command = [sys.executable, os.path.abspath(__file__), '--scenario',
+                   '--builds', str(builds),
+                   '--source', source_dir,
+                   '--output-folder', os.path.join(scratch_dir, 'output')]
+        if arguments.jobs:
+            command.extend(['--jobs', str(arguments.jobs)])
+        if arguments.quiet:
+            command.append('--quiet')
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(command, env=environment,
+                                             stderr=devnull)
+        scenario = json.loads(output.decode('UTF-8'))
+        scenario['source_size'] = source_size
+        return scenario
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def run_benchmarks(arguments):
+    scenarios = []
+    for source_size in arguments.source_sizes.split(','):
+        source_dir = tempfile.mkdtemp(prefix='vdist-benchmark-source-')
+        try:
+            create_source_tree(source_dir, parse_size(source_size))
+            for builds in arguments.builds.split(','):
+                scenario = _run_child(arguments, int(builds), source_dir,
+                                      source_size)
+                print('%(builds)5d builds, %(source_size)5s source: '
+                      '%(wall_seconds)8.2fs, %(peak_rss_kb)7d KB RSS, '
+                      '%(peak_threads)4d threads, %(peak_fds)5d fds, '
+                      '%(log_lines_per_second)10.1f log lines/s' % scenario)
+                scenarios.append(scenario)
+        finally:
+            shutil.rmtree(source_dir, ignore_errors=True)
+    report = {
+        'vdist_revision': _get_vdist_revision(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(),
+        'settings': {'jobs': arguments.jobs,
+                     'build_seconds': arguments.build_seconds,
+                     'output_lines': arguments.output_lines,
+                     'package_size': arguments.package_size},
+        'scenarios': scenarios,
+    }
+    with open(arguments.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to %s' % arguments.output)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Measure vdist orchestration overhead using a fake '
+                    'docker command.')
+    parser.add_argument('--builds', default=DEFAULT_BUILDS,
+                        help='Comma separated number of builds of every '
+                             'scenario (default: %s).' % DEFAULT_BUILDS)
+    parser.add_argument('--source-sizes', default=DEFAULT_SOURCE_SIZES,
+                        help='Comma separated sizes of source trees, with '
+                             'K, M or G suffix (default: %s).' %
+                             DEFAULT_SOURCE_SIZES)
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Builds running at the same time (default: '
+                             'all of them).')
+    parser.add_argument('--build-seconds', type=float, default=0.0,
+                        help='Seconds every fake build lasts.')
+    parser.add_argument('--output-lines', type=int, default=1000,
+                        help='Lines every fake build prints.')
+    parser.add_argument('--package-size', default='1M',
+                        help='Size of package every fake build generates.')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Turn vdist logging off, to measure log '
+                             'streaming without logging handlers.')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file to write results to.')
+    # Used internally to run a single scenario in a child process.
+    parser.add_argument('--scenario', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    parser.add_argument('--output-folder', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    if arguments.scenario:
+        arguments.builds = int(arguments.builds)
+        print(json.dumps(run_scenario(arguments)))
+    else:
+        run_benchmarks(arguments)
+
+
+if __name__ == '__main__':
+    main()
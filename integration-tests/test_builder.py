@@ -49,19 +49,15 @@ def _purge_list(original_list, purgables):
 def _call_builder(builder_parameters):
     builder = Builder()
     builder.add_build(**builder_parameters)
-    builder.build()
+    return builder.build()[0].build_dir
 
 
 def _generate_rpm(builder_parameters, centos_version):
-    _call_builder(builder_parameters)
-    homedir = os.path.expanduser('~')
+    build_dir = _call_builder(builder_parameters)
     filename_prefix = "-".join([builder_parameters["app"],
                                 builder_parameters["version"]])
     target_file = os.path.join(
-        homedir,
-        '.vdist',
-        'dist',
-        "".join([filename_prefix, "-{0}".format(centos_version)]),
+        build_dir,
         "".join([filename_prefix, '-1.x86_64.rpm']),
     )
     assert os.path.isfile(target_file)
@@ -70,17 +66,11 @@ def _generate_rpm(builder_parameters, centos_version):
 
 
 def _generate_deb(builder_parameters):
-    _call_builder(builder_parameters)
-    homedir = os.path.expanduser('~')
-    filename_prefix = "-".join([builder_parameters["app"],
-                                builder_parameters["version"]])
+    build_dir = _call_builder(builder_parameters)
     deb_filename_prefix = "_".join([builder_parameters["app"],
                                     builder_parameters["version"]])
     target_file = os.path.join(
-        homedir,
-        '.vdist',
-        'dist',
-        "".join([filename_prefix, "-ubuntu-trusty"]),
+        build_dir,
         "".join([deb_filename_prefix, '_amd64.deb']),
     )
     assert os.path.isfile(target_file)
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import sys
+
+import vdist.artifacts as artifacts
+import vdist.defaults as defaults
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+PACKAGE_CONTENT = b'package' * 1000
+
+
+def _create_build_dir(root, manifest=None):
+    build_dir = os.path.join(root, 'build')
+    os.makedirs(os.path.join(build_dir, defaults.SCRATCH_DIR))
+    for filename in ['myapp_1.0_amd64.deb', 'unrelated.txt']:
+        with open(os.path.join(build_dir, filename), 'wb') as f:
+            f.write(PACKAGE_CONTENT)
+    if manifest is not None:
+        with open(os.path.join(build_dir, defaults.SCRATCH_DIR,
+                               defaults.SCRATCH_MANIFEST_NAME), 'w') as f:
+            f.write(manifest)
+    return build_dir
+
+
+def test_get_packages_from_manifest():
+    with TemporaryDirectory() as temporary_dir:
+        build_dir = _create_build_dir(
+            temporary_dir, 'myapp_1.0_amd64.deb\nmyapp_1.0_amd64.deb\n')
+        assert artifacts.get_packages(build_dir) == \
+            [os.path.join(build_dir, 'myapp_1.0_amd64.deb')]
+
+
+def test_get_packages_without_manifest():
+    with TemporaryDirectory() as temporary_dir:
+        build_dir = _create_build_dir(temporary_dir)
+        assert artifacts.get_packages(build_dir) == \
+            [os.path.join(build_dir, 'myapp_1.0_amd64.deb'),
+             os.path.join(build_dir, 'unrelated.txt')]
+
+
+def test_deliver_links_package():
+    with TemporaryDirectory() as temporary_dir:
+        package = os.path.join(_create_build_dir(temporary_dir),
+                               'myapp_1.0_amd64.deb')
+        output_folders = [os.path.join(temporary_dir, 'out1'),
+                          os.path.join(temporary_dir, 'out2')]
+        entry = artifacts.deliver(package, output_folders)
+        assert entry['methods'] == ['link', 'link']
+        assert entry['sha256'] == hashlib.sha256(PACKAGE_CONTENT).hexdigest()
+        assert entry['size'] == len(PACKAGE_CONTENT)
+        for output_folder in output_folders:
+            assert os.listdir(output_folder) == ['myapp_1.0_amd64.deb']
+            assert os.path.samefile(
+                package, os.path.join(output_folder, 'myapp_1.0_amd64.deb'))
+
+
+def test_deliver_copies_across_filesystems(monkeypatch):
+    # Hard links fail across filesystems.
+    monkeypatch.setattr(artifacts, '_link', lambda source, target: False)
+    with TemporaryDirectory() as temporary_dir:
+        package = os.path.join(_create_build_dir(temporary_dir),
+                               'myapp_1.0_amd64.deb')
+        output_folders = [os.path.join(temporary_dir, 'out1'),
+                          os.path.join(temporary_dir, 'out2')]
+        entry = artifacts.deliver(package, output_folders)
+        assert entry['methods'] == ['copy', 'copy']
+        assert entry['sha256'] == hashlib.sha256(PACKAGE_CONTENT).hexdigest()
+        for output_folder in output_folders:
+            assert os.listdir(output_folder) == ['myapp_1.0_amd64.deb']
+            with open(os.path.join(output_folder, 'myapp_1.0_amd64.deb'),
+                      'rb') as f:
+                assert f.read() == PACKAGE_CONTENT
@@ -0,0 +1,128 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+import vdist.defaults as defaults
+from vdist.asyncbuilder import AsyncBuilder
+from vdist.builder import Builder, BuildCancelledException
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+
+@pytest.fixture(autouse=True)
+def vdist_dir(monkeypatch):
+    # Builders create their run folders and caches here, not at user's
+    # ~/.vdist.
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setenv('HOME', temporary_dir)
+        monkeypatch.setattr(defaults, 'BUILD_BASEDIR',
+                            os.path.join(temporary_dir, 'dist'))
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        yield temporary_dir
+
+
+class DummyBuilder(Builder):
+    # Runs no containers, builds just take as many seconds as their version.
+
+    def __init__(self, **kwargs):
+        Builder.__init__(self, start_delay=0, docker_backend='cli',
+                         **kwargs)
+        self.release = threading.Event()
+        self.finished = threading.Event()
+
+    def finish(self, results):
+        Builder.finish(self, results)
+        self.finished.set()
+
+    def run_build(self, build, result=None):
+        self._check_cancelled(build)
+        self._emit('phase_changed', build, phase='building')
+        if build.version == 'blocked':
+            self.release.wait(5)
+            self._check_cancelled(build)
+        else:
+            time.sleep(float(build.version))
+        self._emit('artifact_ready', build, path='%s.deb' % build.app)
+        return result
+
+
+def _add_builds(async_builder, versions):
+    return [async_builder.add_build(app='app%d' % i, version=version,
+                                    source={'type': 'git', 'uri': 'x',
+                                            'branch': 'master'},
+                                    profile='ubuntu-trusty')
+            for i, version in enumerate(versions)]
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_builder_results_as_completed():
+    async def run():
+        async_builder = AsyncBuilder(DummyBuilder())
+        events = []
+        async_builder.add_listener(
+            lambda event: events.append((event.build.app, event.name)))
+        _add_builds(async_builder, ['0.2', '0.0'])
+        async_builder.start()
+        finished = []
+        for next_result in async_builder.as_completed():
+            finished.append((await next_result).build.app)
+        results = await async_builder.build()
+        return finished, results, events
+
+    finished, results, events = _run(run())
+    assert finished == ['app1', 'app0']
+    assert [result.build.app for result in results] == ['app0', 'app1']
+    assert all(result.succeeded for result in results)
+    assert ('app0', 'queued') in events
+    assert ('app1', 'artifact_ready') in events
+
+
+def test_async_builder_finishes_without_build():
+    async def run():
+        dummy_builder = DummyBuilder()
+        async_builder = AsyncBuilder(dummy_builder)
+        _add_builds(async_builder, ['0', '0'])
+        async_builder.start()
+        for next_result in async_builder.as_completed():
+            await next_result
+        for _ in range(100):
+            if dummy_builder.finished.is_set():
+                break
+            await asyncio.sleep(0.05)
+        return dummy_builder
+
+    dummy_builder = _run(run())
+    assert dummy_builder.finished.is_set()
+    assert dummy_builder._run_lock is None
+
+
+def test_async_builder_cancel():
+    async def run():
+        dummy_builder = DummyBuilder(max_jobs=1)
+        async_builder = AsyncBuilder(dummy_builder)
+        running, pending = _add_builds(async_builder, ['blocked', '0'])
+        async_builder.start()
+        async_builder.cancel(pending)
+        async_builder.cancel(running)
+        dummy_builder.release.set()
+        return await async_builder.build()
+
+    results = _run(run())
+    assert all(isinstance(result.error, BuildCancelledException)
+               for result in results)
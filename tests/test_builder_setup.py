@@ -1,6 +1,19 @@
+import json
+import os
+import subprocess
+import sys
+
 import pytest
 
-from vdist.builder import Builder, NoBuildsFoundException
+import vdist.defaults as defaults
+from vdist.builder import Build, Builder, NoBuildsFoundException
+from vdist.scheduler import BuildResult
+from vdist.source import directory, git
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
 
 
 def test_builder_nobuilds():
@@ -19,3 +32,414 @@ def test_internal_profile_loads():
 
     for profile_id in internal_profile_ids:
         assert profile_id in profiles
+
+
+def _get_dummy_build(**kwargs):
+    parameters = dict(app='myapp',
+                      version='1.0',
+                      source=git(uri='https://github.com/objectified/vdist',
+                                 branch='master'),
+                      profile='ubuntu-trusty')
+    parameters.update(kwargs)
+    return Build(**parameters)
+
+
+def test_render_template_python_cache():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build()
+
+    script = b._render_template(build, {
+        'python_cache_dir': '/vdist/cache/python/key',
+        'python_cache_file': '/vdist/cache/python/key/python.tar.gz'})
+    assert 'PYTHON_CACHE_FILE="/vdist/cache/python/key/python.tar.gz"' in script
+
+    script = b._render_template(build)
+    assert 'PYTHON_CACHE_FILE=""' in script
+
+
+def test_python_cache_keyed_by_provisioning(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        b = Builder()
+        b.get_available_profiles()
+        build = _get_dummy_build(compile_python=True)
+        profile = b._get_profile(build)
+        with_deps = _get_dummy_build(compile_python=True,
+                                     build_deps=['libsqlite3-dev'])
+        assert b._get_python_cache_key(build, profile, 'image') != \
+            b._get_python_cache_key(with_deps, profile, 'image')
+        # Interpreters missing modules must not be reused by builds
+        # installing the libraries they need.
+        context = b._get_python_cache_context(
+            build, profile, 'image', BuildResult(build))
+        context_with_deps = b._get_python_cache_context(
+            with_deps, profile, 'image', BuildResult(with_deps))
+        assert context['python_cache_file'] != \
+            context_with_deps['python_cache_file']
+        assert context['configure_cache_file'] != \
+            context_with_deps['configure_cache_file']
+
+
+def test_render_template_python_cache_hit_skips_compile_deps():
+    b = Builder()
+    b.get_available_profiles()
+    script = b._render_template(_get_dummy_build(compile_python=True))
+    hit_branch = script[script.index('Python interpreter cache hit'):
+                        script.index('Python interpreter cache miss')]
+    assert 'build-dep python' not in hit_branch
+    assert 'build-dep python' in script
+
+
+def test_render_provision_script():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build(build_deps=['libxml2-dev'])
+
+    provision_script = b._render_provision_script(build)
+    assert provision_script.startswith('#!/bin/bash')
+    assert 'install -y libxml2-dev' in provision_script
+    assert 'fpm -s dir' not in provision_script
+
+    build_script = b._render_template(build, {'provisioned': True})
+    assert 'install -y libxml2-dev' not in build_script
+    assert 'fpm -s dir' in build_script
+
+    snapshot_image = b._get_snapshot_image('sha256:1234', provision_script)
+    assert snapshot_image.startswith('vdist-provisioned:')
+    assert snapshot_image == b._get_snapshot_image('sha256:1234',
+                                                   provision_script)
+
+
+def test_render_package_cache():
+    b = Builder()
+    profiles = b.get_available_profiles()
+    for profile_id, package_manager in [('ubuntu-trusty', 'apt-get'),
+                                        ('centos7', 'yum')]:
+        build = _get_dummy_build(profile=profile_id)
+        context = b._get_package_cache_context(profiles[profile_id])
+        provision_script = b._render_provision_script(build, context)
+        assert 'flock $PACKAGE_CACHE_DIR/lock %s' % package_manager in \
+            provision_script
+        assert context['package_cache_dir'] in provision_script
+
+
+def test_result_cache_store_and_restore(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        first_build_dir = os.path.join(temporary_dir, 'first')
+        second_build_dir = os.path.join(temporary_dir, 'second')
+        os.makedirs(os.path.join(first_build_dir, defaults.SCRATCH_DIR))
+        os.mkdir(second_build_dir)
+        with open(os.path.join(first_build_dir, 'myapp_1.0_amd64.deb'),
+                  'w') as f:
+            f.write('package')
+
+        b = Builder()
+        assert not b._restore_cached_result('key', second_build_dir)
+        b._store_result('key', first_build_dir)
+        assert b._restore_cached_result('key', second_build_dir)
+        assert os.listdir(second_build_dir) == ['myapp_1.0_amd64.deb']
+
+
+def test_result_cache_does_not_share_packages(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        first_build_dir = os.path.join(temporary_dir, 'first')
+        second_build_dir = os.path.join(temporary_dir, 'second')
+        os.makedirs(os.path.join(first_build_dir, defaults.SCRATCH_DIR))
+        os.mkdir(second_build_dir)
+        package = os.path.join(first_build_dir, 'myapp_1.0_amd64.deb')
+        with open(package, 'w') as f:
+            f.write('package')
+
+        b = Builder()
+        b._store_result('key', first_build_dir)
+        b._restore_cached_result('key', second_build_dir)
+        # Packages signed in place after delivery must not alter cache.
+        for build_dir in [first_build_dir, second_build_dir]:
+            with open(os.path.join(build_dir, 'myapp_1.0_amd64.deb'),
+                      'a') as f:
+                f.write(' signed')
+        cached_package = os.path.join(
+            temporary_dir, 'cache', defaults.RESULT_CACHE_SUBDIR, 'key',
+            'myapp_1.0_amd64.deb')
+        with open(cached_package) as f:
+            assert f.read() == 'package'
+
+
+def test_render_template_gives_host_dirs_back_on_failure():
+    b = Builder()
+    b.get_available_profiles()
+    with TemporaryDirectory() as temporary_dir:
+        # Records chown calls instead of doing them.
+        chown_log = os.path.join(temporary_dir, 'chown.log')
+        with open(os.path.join(temporary_dir, 'chown'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\n' % chown_log)
+        os.chmod(os.path.join(temporary_dir, 'chown'), 0o755)
+        for profile_id in ['ubuntu-trusty', 'centos7', 'centos6']:
+            build = _get_dummy_build(profile=profile_id)
+            script = b._render_template(build, {
+                'provisioned': True,
+                'pip_cache_dir': '/vdist/cache/pip',
+                'ccache_mount_dir': '/vdist/ccache'})
+            # Fail right after every host folder is known.
+            host_dirs_end = script.index('\n', script.index(
+                'VDIST_HOST_DIRS+='))
+            failing_script = script[:host_dirs_end] + '\nfalse\n'
+            output = subprocess.Popen(
+                ['bash', '-c', failing_script], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=dict(os.environ, PATH='%s:%s' % (
+                    temporary_dir, os.environ['PATH']))).communicate()[0]
+            assert b'##vdist-exit 1 ' in output
+            with open(chown_log) as f:
+                assert f.read().split() == [
+                    '-R', '%d:%d' % (os.getuid(), os.getgid()),
+                    defaults.SHARED_DIR, '/vdist/cache/pip', '/vdist/ccache']
+            os.remove(chown_log)
+            assert 'chown -R' not in script[host_dirs_end:]
+
+
+def test_render_template_mounted_source():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build(source=directory(path='/var/tmp/vdist'),
+                             mount_source=True)
+    script = b._render_template(build, {
+        'source_mount_dir': '/vdist/source',
+        'source_file_list': '/work/scratch/source_files.list'})
+    assert 'tar -C /vdist/source --null' in script
+    assert (script.index('set -o pipefail') <
+            script.index('tar -C /vdist/source --null') <
+            script.index('set +o pipefail'))
+    assert 'cp -r /work/scratch/vdist .' not in script
+
+
+def test_write_source_list():
+    with TemporaryDirectory() as source_dir:
+        os.mkdir(os.path.join(source_dir, 'package'))
+        for filename in ['setup.py', '.vdistignore',
+                         os.path.join('package', 'module.pyc')]:
+            with open(os.path.join(source_dir, filename), 'w') as f:
+                f.write('*.pyc\n')
+        list_path = os.path.join(source_dir, 'list')
+        Builder._write_source_list(source_dir, list_path)
+        with open(list_path, 'rb') as f:
+            listed = f.read().split(b'\0')
+        assert b'./setup.py' in listed
+        assert b'./package' in listed
+        assert b'./package/module.pyc' not in listed
+
+
+def test_render_template_pooled_shared_dir():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build(source=directory(path='/var/tmp/vdist'))
+    script = b._render_template(build, {'shared_dir': '/work/vdist-ubuntu'})
+    assert 'cp -r /work/vdist-ubuntu/scratch/vdist .' in script
+
+
+def test_get_cleanup_command():
+    build = _get_dummy_build(source=directory(path='/var/tmp/vdist'),
+                             python_basedir='/opt/my app',
+                             working_dir='subdir')
+    command = Builder._get_cleanup_command(build)
+    assert command.startswith("rm -rf '/opt/my app' ")
+    assert '/tmp/vdist' in command
+    assert '/tmp/subdir' in command
+    assert '/tmp/*.deb' in command
+
+
+def test_get_cleanup_command_paths():
+    build = _get_dummy_build(source=directory(path='/var/tmp/vdist'),
+                             compile_python=True, python_version='3.4.4',
+                             python_basedir='/opt/python',
+                             custom_filename='myapp.deb')
+    command = Builder._get_cleanup_command(build)
+    assert command.split() == ['rm', '-rf',
+                               '/opt/python',
+                               '/opt/myapp',
+                               '/tmp/vdist',
+                               '/tmp/myapp.deb',
+                               '/tmp/*.deb',
+                               '/tmp/*.rpm',
+                               '/var/tmp/Python-*',
+                               '$HOME/.pip']
+
+
+def _write_local_profiles(profiles_dir, profile_ids, mtime):
+    profiles_file = os.path.join(profiles_dir, defaults.LOCAL_PROFILES_FILE)
+    with open(profiles_file, 'w') as f:
+        f.write(json.dumps(dict(
+            (profile_id, {'docker_image': 'image', 'script': 'debian.sh'})
+            for profile_id in profile_ids)))
+    os.utime(profiles_file, (mtime, mtime))
+
+
+def test_local_profiles_reloaded_when_changed():
+    with TemporaryDirectory() as profiles_dir:
+        _write_local_profiles(profiles_dir, ['custom-1'], 1000)
+        b = Builder(profiles_dir=profiles_dir)
+        assert 'custom-1' in b.get_available_profiles()
+        _write_local_profiles(profiles_dir, ['custom-2'], 2000)
+        assert 'custom-2' in b.get_available_profiles()
+
+
+def test_template_environment_shared():
+    b = Builder()
+    assert b._get_template_environment() is b._get_template_environment()
+    assert b._get_template_environment().bytecode_cache is not None
+
+
+def test_concurrent_runs_keep_their_build_folders():
+    with TemporaryDirectory() as runs_basedir:
+        legacy_build_dir = os.path.join(runs_basedir, 'myapp-1.0-centos7')
+        os.mkdir(legacy_build_dir)
+        builders = []
+        for _ in range(2):
+            b = Builder()
+            b.runs_basedir = runs_basedir
+            b._create_build_basedir()
+            builders.append(b)
+        first_run_dir = builders[0].build_basedir
+        assert os.path.basename(first_run_dir).startswith(
+            defaults.BUILD_RUN_PREFIX)
+        assert os.path.isdir(first_run_dir)
+        assert not os.path.exists(legacy_build_dir)
+
+        builders[0]._release_build_basedir()
+        third_builder = Builder()
+        third_builder.runs_basedir = runs_basedir
+        trash_dirs = third_builder._remove_stale_runs()
+        assert not os.path.exists(first_run_dir)
+        assert os.path.isdir(builders[1].build_basedir)
+        assert trash_dirs
+        assert all(os.path.basename(trash_dir).startswith(
+            defaults.BUILD_TRASH_PREFIX) for trash_dir in trash_dirs)
+        builders[1]._release_build_basedir()
+
+
+def test_render_template_git_mirror():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build()
+    script = b._render_template(build, {'git_mirror': '/vdist/git/key/m.git'})
+    assert 'git clone --shared /vdist/git/key/m.git vdist' in script
+    assert 'git clone https://github.com/objectified/vdist' not in script
+
+
+def test_render_template_sparse_git_clone():
+    b = Builder()
+    b.get_available_profiles()
+    build = _get_dummy_build(
+        source=git(uri='https://github.com/objectified/vdist', depth=1),
+        working_dir='services/api')
+    assert build.source['sparse_path'] == 'services/api'
+    script = b._render_template(build)
+    assert 'git clone --no-checkout --depth 1 --branch master ' \
+        '--filter=blob:none https://github.com/objectified/vdist vdist' \
+        in script
+    assert 'echo "/services/api/" >> .git/info/sparse-checkout' in script
+    assert '##vdist-clone' in script
+
+    script = b._render_template(_get_dummy_build())
+    assert 'git clone https://github.com/objectified/vdist' in script
+    assert 'sparse-checkout' not in script
+
+
+def test_render_template_wheelhouse(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        b = Builder()
+        b.get_available_profiles()
+        build = _get_dummy_build(pip_args='--index-url https://pypi.example')
+        wheelhouse_context = b._get_wheelhouse_context(build)
+        script = b._render_template(build, wheelhouse_context)
+        wheelhouse_dir = wheelhouse_context['wheelhouse_dir']
+        assert 'WHEELHOUSE=%s/$REQUIREMENTS_HASH/$ABI_TAG' % wheelhouse_dir \
+            in script
+        assert '$PIP_BIN wheel --index-url https://pypi.example ' \
+            '--find-links $WHEELHOUSE' in script
+        assert '$PIP_BIN install --no-index --find-links $WHEELHOUSE' in script
+        # Wheels built with other pip arguments are kept apart.
+        assert b._get_wheelhouse_context(_get_dummy_build()) != \
+            wheelhouse_context
+
+        b = Builder(use_wheelhouse=False)
+        b.get_available_profiles()
+        assert b._get_wheelhouse_context(build) == {}
+        script = b._render_template(build)
+        assert 'WHEELHOUSE' not in script
+
+
+def test_dependencies_cache_context(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        b = Builder()
+        b.get_available_profiles()
+        build = _get_dummy_build(compile_python=True)
+        profile = b._get_profile(build)
+        cache_root, context = b._get_dependencies_cache_context(
+            build, profile, 'image')
+        assert cache_root == os.path.join(temporary_dir, 'cache',
+                                          defaults.DEPENDENCIES_CACHE_SUBDIR)
+        script = b._render_template(build, context)
+        assert 'DEPENDENCIES_CACHE_FILE=%s/$REQUIREMENTS_HASH.tar.gz' % \
+            context['dependencies_cache_dir'] in script
+        # Another interpreter or pip arguments get other environments.
+        for other_build, image_id in [
+                (_get_dummy_build(compile_python=True,
+                                  python_version='3.6.4'), 'image'),
+                (_get_dummy_build(compile_python=True,
+                                  pip_args='--pre'), 'image'),
+                (build, 'other_image')]:
+            assert b._get_dependencies_cache_context(
+                other_build, profile, image_id)[1] != context
+
+        script = b._render_template(build)
+        assert 'DEPENDENCIES_CACHE_FILE' not in script
+
+        # Prebuilt interpreters may live in system folders, like /usr, that
+        # must be neither replaced nor archived.
+        build = _get_dummy_build(compile_python=False, python_basedir='/usr')
+        cache_root, context = b._get_dependencies_cache_context(
+            build, profile, 'image')
+        assert cache_root is None
+        assert context == {}
+        script = b._render_template(build, context)
+        assert 'DEPENDENCIES_CACHE_FILE' not in script
+        assert 'rm -rf $PYTHON_BASEDIR' not in script
+
+
+def test_render_template_parallel_ccache_compile():
+    b = Builder()
+    b.get_available_profiles()
+    context = {'ccache_mount_dir': defaults.CONTAINER_CCACHE_DIR,
+               'configure_cache_file': '/vdist/cache/configure/x/config.cache'}
+    for profile in ['ubuntu-trusty', 'centos7', 'centos6']:
+        build = _get_dummy_build(profile=profile, compile_python=True,
+                                 compile_jobs='4', ccache_dir='~/ccache')
+        assert build.compile_jobs == 4
+        assert build.ccache_dir == os.path.expanduser('~/ccache')
+        script = b._render_template(build, context)
+        assert 'make -j $COMPILE_JOBS' in script
+        assert 'COMPILE_JOBS=4' in script
+        assert 'export CCACHE_DIR=%s' % defaults.CONTAINER_CCACHE_DIR in script
+        assert 'export CC="ccache gcc"' in script
+        assert 'CONFIGURE_CACHE_FILE="%s"' % \
+            context['configure_cache_file'] in script
+        assert 'install -y ccache' in b._render_provision_script(build,
+                                                                 context)
+
+        # Without compile jobs they are taken from container CPU quota.
+        build = _get_dummy_build(profile=profile, compile_python=True)
+        script = b._render_template(build)
+        assert '/sys/fs/cgroup/cpu.max' in script
+        assert 'CCACHE_DIR' not in script
+        assert 'ccache' not in b._render_provision_script(build)
@@ -0,0 +1,154 @@
+import os
+import sys
+
+import vdist.buildmachine as buildmachine
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+
+def test_run_cli_drains_stderr_while_stdout_open():
+    # Fills stderr pipe buffer many times over before writing to stdout.
+    lines = []
+    machine = buildmachine.BuildMachine(line_handlers=[lines.append])
+    result = machine._run_cli(
+        'for i in $(seq 20000); do echo "error line $i" >&2; done; '
+        'echo first; exit 3')
+    assert result.returncode == 3
+    assert result.first_line == 'first'
+    assert len(lines) == 20001
+
+
+def test_run_cli_writes_timestamped_log():
+    with TemporaryDirectory() as log_dir:
+        machine = buildmachine.BuildMachine()
+        machine.log_path = os.path.join(log_dir, 'machine.log')
+        machine._run_cli('echo out; echo err >&2')
+        with open(machine.log_path) as f:
+            log_lines = [line.split(' ', 2)[2].strip() for line in f]
+        assert log_lines[0] == 'command echo out; echo err >&2'
+        assert 'stdout out' in log_lines
+        assert 'stderr err' in log_lines
+        assert log_lines[-1] == 'exit 0'
+
+
+def test_run_cli_splits_long_lines():
+    lines = []
+    machine = buildmachine.BuildMachine(line_handlers=[lines.append])
+    machine._run_cli("head -c %d /dev/zero | tr '\\0' a" %
+                     (buildmachine.MAX_LINE_LENGTH * 2 + 10))
+    assert [len(line) for line in lines] == [
+        buildmachine.MAX_LINE_LENGTH, buildmachine.MAX_LINE_LENGTH, 10]
+
+
+def test_container_pool_reuses_and_recycles():
+    pool = buildmachine.ContainerPool(size=1, max_uses=2)
+    assert pool.checkout('image') is None
+    assert pool.checkin('image', 'c1', 1)
+    assert not pool.checkin('image', 'c2', 1)
+    assert pool.checkout('other') is None
+    assert pool.checkout('image') == ('c1', 1)
+    assert not pool.checkin('image', 'c1', 2)
+    assert pool.checkin('image', 'c3', 1)
+    assert pool.drain() == ['c3']
+    assert pool.checkout('image') is None
+
+
+def test_start_gate_only_before_new_containers():
+    gate_calls = []
+    pool = buildmachine.ContainerPool(size=1)
+    machine = buildmachine.BuildMachine(image='image',
+                                        start_gate=lambda: gate_calls.append(1))
+    machine._start_container = lambda binds: 'c1'
+    machine.enable_pool(pool, '/work/build', 'true')
+    with TemporaryDirectory() as build_dir:
+        machine.start(build_dir)
+        assert gate_calls == [1]
+        pool.checkin(machine._get_pool_key(), 'c1', 1)
+        # Pooled container is already running, so nothing to stagger.
+        machine.start(build_dir)
+        assert machine.container_id == 'c1'
+        assert gate_calls == [1]
+
+
+def test_shutdown_removes_container_at_once():
+    with TemporaryDirectory() as log_dir:
+        fake_docker = os.path.join(log_dir, 'docker')
+        with open(fake_docker, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s/calls\n' % log_dir)
+        os.chmod(fake_docker, 0o755)
+        machine = buildmachine.BuildMachine(docker_cli=fake_docker)
+        machine.container_id = 'c1'
+        machine.shutdown()
+        with open(os.path.join(log_dir, 'calls')) as f:
+            assert f.read().splitlines() == ['rm -f c1']
+        assert machine.teardown_seconds is not None
+        assert machine.container_id is None
+
+
+def test_phase_recorder_times_phases():
+    phases = []
+    machine = buildmachine.BuildMachine(
+        event_handlers=[lambda name, **data: phases.append(data['phase'])])
+    with TemporaryDirectory() as script_dir:
+        script = os.path.join(script_dir, 'script.sh')
+        with open(script, 'w') as f:
+            f.write('vdist_phase() {\n'
+                    '    echo "##vdist-phase $1 $(date +%s.%N)"\n'
+                    '}\n'
+                    'trap \'echo "##vdist-exit $? $(date +%s.%N)"\' EXIT\n'
+                    'vdist_phase fetch\n'
+                    'echo "##vdist-phase bogus"\n'
+                    'sleep 0.1\n'
+                    'vdist_phase compile\n'
+                    'exit 3\n')
+        machine._run_cli('bash %s' % script)
+    recorded = machine.phase_recorder.phases
+    assert phases == ['fetch', 'compile']
+    assert [phase['name'] for phase in recorded] == ['fetch', 'compile']
+    assert recorded[0]['exit_status'] == 0
+    assert recorded[0]['duration'] >= 0.1
+    assert recorded[1]['exit_status'] == 3
+
+
+def test_clone_recorder_reads_marker():
+    recorder = buildmachine.CloneRecorder()
+    recorder('##vdist-clone-ish 1 2 3')
+    recorder('##vdist-clone bogus 1.0 2.0')
+    assert recorder.clone is None
+    recorder('##vdist-clone 2048 100.25 102.75')
+    assert recorder.clone == {'bytes': 2048, 'seconds': 2.5}
+
+
+def test_wheels_recorder_reads_marker():
+    recorder = buildmachine.WheelsRecorder()
+    recorder('##vdist-wheels 3')
+    recorder('##vdist-wheels some 2')
+    assert recorder.wheels is None
+    recorder('##vdist-wheels 3 12')
+    assert recorder.wheels == {'built': 3, 'reused': 12}
+
+
+def test_cache_recorder_reads_marker():
+    recorder = buildmachine.CacheRecorder()
+    recorder('##vdist-cache dependencies')
+    recorder('##vdist-cache dependencies maybe')
+    assert recorder.caches == {}
+    recorder('##vdist-cache dependencies hit')
+    assert recorder.caches == {'dependencies_cache': 'hit'}
+
+
+def test_compile_recorder_reads_marker():
+    recorder = buildmachine.CompileRecorder()
+    recorder('##vdist-compile 4 100.0')
+    recorder('##vdist-compile many 100.0 160.0')
+    assert recorder.compile is None
+    recorder('##vdist-compile 4 100.0 160.5')
+    assert recorder.compile == {'jobs': 4, 'seconds': 60.5,
+                                'ccache_hits': None, 'ccache_misses': None,
+                                'ccache_hit_ratio': None}
+    recorder('##vdist-compile 4 100.0 110.0 300 100')
+    assert recorder.compile['ccache_hits'] == 300
+    assert recorder.compile['ccache_hit_ratio'] == 0.75
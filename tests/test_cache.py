@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import time
+
+import vdist.cache as cache
+import vdist.defaults as defaults
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+
+def _create_file(path, size, age):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+    timestamp = time.time() - age
+    os.utime(path, (timestamp, timestamp))
+
+
+def test_cache_make_key():
+    assert cache.make_key('a', 'b') == cache.make_key('a', 'b')
+    assert cache.make_key('ab', 'c') != cache.make_key('a', 'bc')
+
+
+def test_cache_prune_removes_least_recently_used():
+    with TemporaryDirectory() as cache_dir:
+        _create_file(os.path.join(cache_dir, 'old'), 100, 300)
+        _create_file(os.path.join(cache_dir, 'middle'), 100, 200)
+        _create_file(os.path.join(cache_dir, 'new'), 100, 100)
+        freed = cache.prune(cache_dir, 250)
+        assert freed == 100
+        assert not os.path.exists(os.path.join(cache_dir, 'old'))
+        assert os.path.exists(os.path.join(cache_dir, 'middle'))
+        assert os.path.exists(os.path.join(cache_dir, 'new'))
+
+
+def test_cache_prune_skipped_while_in_use():
+    with TemporaryDirectory() as cache_dir:
+        _create_file(os.path.join(cache_dir, 'old'), 100, 300)
+        lock = cache.CacheLock(cache_dir)
+        lock.acquire()
+        try:
+            assert cache.prune(cache_dir, 0) == 0
+        finally:
+            lock.release()
+        assert cache.prune(cache_dir, 0) == 100
+
+
+def test_pip_cache_counter():
+    counter = cache.PipCacheCounter()
+    assert counter.hit_ratio is None
+    for line in ["Collecting jinja2",
+                 "  Using cached Jinja2-2.7.3.tar.gz",
+                 "Collecting markupsafe",
+                 "  Downloading MarkupSafe-1.0.tar.gz",
+                 "Collecting six",
+                 "  Using cached six-1.10.0-py2.py3-none-any.whl"]:
+        counter(line)
+    assert counter.hits == 2
+    assert counter.misses == 1
+    assert abs(counter.hit_ratio - 2.0 / 3) < 0.001
+
+
+def test_cache_binds_only_build_folders(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        cache_dir = os.path.join(temporary_dir, 'cache')
+        monkeypatch.setattr(defaults, 'CACHE_DIR', cache_dir)
+        binds = cache.get_binds()
+        assert binds[os.path.join(cache_dir, defaults.PIP_CACHE_SUBDIR)] == \
+            '/'.join([defaults.CONTAINER_CACHE_DIR, defaults.PIP_CACHE_SUBDIR])
+        assert cache_dir not in binds
+        # Folders read back by vdist itself are never exposed to builds.
+        for subdir in [defaults.RESULT_CACHE_SUBDIR,
+                       defaults.SOURCE_CACHE_SUBDIR,
+                       defaults.FINGERPRINT_CACHE_SUBDIR]:
+            assert os.path.join(cache_dir, subdir) not in binds
+        assert not any(
+            defaults.TEMPLATE_CACHE_DIR.startswith(host_path)
+            for host_path in binds)
+        assert all(os.path.isdir(host_path) for host_path in binds)
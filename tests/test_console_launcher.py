@@ -4,9 +4,12 @@ import os.path
 import sys
 import tempfile
 
+import pytest
+
 import vdist.builder as builder
 import vdist.console_parser as console_parser
 import vdist.configuration as configuration
+import vdist.scheduler as scheduler
 import vdist.source as source
 import vdist.vdist_launcher as vdist_launcher
 
@@ -184,29 +187,73 @@ def test_configuration_file_read():
         assert "Centos7-package" in configurations
 
 
+def test_add_builds_deduplicates_sections():
+    ubuntu_configuration = configuration.Configuration(
+        UBUNTU_ARGPARSED_ARGUMENTS)
+    ubuntu_copy_arguments = copy.deepcopy(UBUNTU_ARGPARSED_ARGUMENTS)
+    ubuntu_copy_arguments["output_folder"] = "/tmp/vdist_copy"
+    ubuntu_copy_configuration = configuration.Configuration(
+        ubuntu_copy_arguments)
+    centos_arguments = copy.deepcopy(UBUNTU_ARGPARSED_ARGUMENTS)
+    centos_arguments["profile"] = "centos7"
+    centos_configuration = configuration.Configuration(centos_arguments)
+    configurations = {"Ubuntu-package": ubuntu_configuration,
+                      "Ubuntu-copy": ubuntu_copy_configuration,
+                      "Centos7-package": centos_configuration}
+    _builder = builder.Builder()
+    build_configurations = builder._add_builds(_builder, configurations)
+    assert len(_builder.builds) == 2
+    assert len(build_configurations) == 2
+    output_folders = [set(_configuration.output_folder
+                          for _configuration in _configurations)
+                      for _configurations in build_configurations]
+    assert {DUMMY_OUTPUT_FOLDER, "/tmp/vdist_copy"} in output_folders
+
+
+def test_add_builds_unique_build_dirs():
+    _builder = builder.Builder()
+    _builder.add_build(**CORRECT_UBUNTU_PARAMETERS)
+    python2_parameters = copy.deepcopy(CORRECT_UBUNTU_PARAMETERS)
+    python2_parameters["python_version"] = "2.7.13"
+    _builder.add_build(**python2_parameters)
+    dirnames = [build.dirname for build in _builder.builds]
+    assert dirnames == [DUMMY_PACKAGE_NAME, DUMMY_PACKAGE_NAME + "-2"]
+
+
 def test_parse_arguments():
     # Batch mode
     parsed_arguments = console_parser.parse_arguments(["batch", "/etc/passwd"])
     assert parsed_arguments["configuration_file"] == "/etc/passwd"
+    parsed_arguments = console_parser.parse_arguments(["batch", "/etc/passwd",
+                                                       "--jobs", "4"])
+    assert parsed_arguments["jobs"] == 4
     # Manual mode
     parsed_arguments = console_parser.parse_arguments(DUMMY_MANUAL_ARGUMENTS)
     assert parsed_arguments == UBUNTU_ARGPARSED_ARGUMENTS
 
 
-def test_move_package_to_output_folder():
+def test_deliver_package_to_output_folder():
     temporary_directory = _get_temporary_directory_context_manager()
     with temporary_directory() as tempdir:
-        package_folder = os.path.join(tempdir, DUMMY_PACKAGE_NAME)
-        os.mkdir(package_folder)
-        with tempfile.NamedTemporaryFile(prefix=DUMMY_PACKAGE_NAME,
-                                         suffix=DUMMY_PACKAGE_EXTENSION,
-                                         dir=package_folder) as dummy_package:
-            dummy_source_folder, dummy_package_name = os.path.split(dummy_package.name)
-            builder._move_package_to_output_folder(DUMMY_CONFIGURATION,
-                                                   source_folder=tempdir)
-            correct_package = os.path.join(DUMMY_OUTPUT_FOLDER,
-                                           dummy_package_name)
-            assert os.path.isfile(correct_package)
+        build_dir = os.path.join(tempdir, DUMMY_PACKAGE_NAME)
+        os.makedirs(os.path.join(build_dir, "scratch"))
+        dummy_package_name = DUMMY_PACKAGE_NAME + DUMMY_PACKAGE_EXTENSION
+        for filename in [dummy_package_name, "unrelated.txt"]:
+            with open(os.path.join(build_dir, filename), "w") as dummy_file:
+                dummy_file.write("package")
+        with open(os.path.join(build_dir, "scratch", "packages.list"),
+                  "w") as manifest:
+            manifest.write(dummy_package_name + "\n")
+        output_folder = os.path.join(tempdir, "output")
+        vdist_builder = builder.Builder()
+        build = vdist_builder.add_build(
+            **DUMMY_CONFIGURATION.builder_parameters)
+        vdist_builder.add_output_folder(build, output_folder)
+        result = scheduler.BuildResult(build)
+        vdist_builder._deliver_artifacts(build, build_dir, result)
+        assert os.listdir(output_folder) == [dummy_package_name]
+        assert result.report["artifacts"][0]["delivered"] == \
+            [os.path.join(output_folder, dummy_package_name)]
 
 
 def _get_temporary_directory_context_manager():
@@ -229,13 +276,40 @@ def test_build_package_manual():
     _generate_packages(configurations)
 
 
+def test_build_packages_no_report_without_packages():
+    temporary_directory = _get_temporary_directory_context_manager()
+    with temporary_directory() as output_folder:
+        arguments = copy.deepcopy(UBUNTU_ARGPARSED_ARGUMENTS)
+        arguments["profile"] = "nonexistent-profile"
+        arguments["output_folder"] = output_folder
+        results = builder.build_packages(
+            {"Broken": configuration.Configuration(arguments)})
+        assert not results[0].succeeded
+        assert os.listdir(output_folder) == []
+
+
+def test_main_fails_if_any_build_fails():
+    temporary_directory = _get_temporary_directory_context_manager()
+    with temporary_directory() as output_folder:
+        arguments = list(DUMMY_MANUAL_ARGUMENTS)
+        arguments[arguments.index("ubuntu-trusty")] = "nonexistent-profile"
+        arguments[arguments.index(DUMMY_OUTPUT_FOLDER)] = output_folder
+        with pytest.raises(SystemExit) as exit_info:
+            vdist_launcher.main(arguments)
+        assert exit_info.value.code == 1
+
+
 def _generate_packages(configurations):
+    temporary_directory = _get_temporary_directory_context_manager()
     for package_configuration in configurations.values():
-        builder.build_package(package_configuration)
-        correct_output_package = os.path.join(
-            package_configuration.output_folder,
-            _get_correct_package_name(package_configuration))
-        assert os.path.isfile(correct_output_package)
+        # Keep packages and reports out of the working directory.
+        with temporary_directory() as output_folder:
+            package_configuration.output_folder = output_folder
+            builder.build_package(package_configuration)
+            correct_output_package = os.path.join(
+                package_configuration.output_folder,
+                _get_correct_package_name(package_configuration))
+            assert os.path.isfile(correct_output_package)
 
 
 def _get_correct_package_name(_configuration):
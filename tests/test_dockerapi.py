@@ -0,0 +1,266 @@
+import base64
+import json
+import os
+import struct
+import sys
+import threading
+
+import pytest
+
+import vdist.buildmachine as buildmachine
+import vdist.dockerapi as dockerapi
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urllib import unquote
+else:
+    from tempfile import TemporaryDirectory
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import unquote
+
+
+class FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        UnixStreamServer.__init__(self, socket_path, FakeDockerHandler)
+        self.connections = 0
+        self.images = {}
+        # Registry auth headers of every pull.
+        self.pulls = []
+        self.containers = {}
+        self.exec_output = [(1, b'out 1\nout'), (2, b'err 1\n'),
+                            (1, b' 2\n')]
+        self.exec_exit_code = 0
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None):
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('UTF-8'))
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/_ping':
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'OK')
+        elif path.startswith('/images/'):
+            image = path[len('/images/'):-len('/json')]
+            if image in self.server.images:
+                self._send(200, self.server.images[image])
+            else:
+                self._send(404, {'message': 'No such image: %s' % image})
+        elif path.startswith('/exec/'):
+            self._send(200, {'Running': False,
+                             'ExitCode': self.server.exec_exit_code})
+        else:
+            self._send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        body = self._read_body()
+        if path == '/images/create':
+            self.server.pulls.append(self.headers.get('X-Registry-Auth'))
+            params = dict(parameter.split('=', 1) for parameter in
+                          self.path.split('?', 1)[1].split('&'))
+            if params['fromImage'].startswith('private.example.com') and \
+                    self.headers.get('X-Registry-Auth') is None:
+                self._send(401, {'message': 'authentication required'})
+            else:
+                image = '%s:%s' % (unquote(params['fromImage']),
+                                   params['tag'])
+                self.server.images[image] = {'Id': 'sha256:3'}
+                self._send(200, {'status': 'Downloaded'})
+        elif path == '/containers/create':
+            self.server.containers['c1'] = body
+            self._send(201, {'Id': 'c1'})
+        elif path.endswith('/start') and path.startswith('/containers/'):
+            self._send(204)
+        elif path.endswith('/exec'):
+            self._send(201, {'Id': 'e1'})
+        elif path.endswith('/start') and path.startswith('/exec/'):
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'application/vnd.docker.raw-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for stream_type, data in self.server.exec_output:
+                self.wfile.write(struct.pack('>BxxxL', stream_type,
+                                             len(data)) + data)
+            self.close_connection = True
+        elif path == '/commit':
+            self.server.images['vdist-provisioned:abc'] = {
+                'Id': 'sha256:2', 'Config': {'Labels': {'a': '1'}}}
+            self._send(201, {'Id': 'sha256:2'})
+        else:
+            self._send(404, {'message': 'not found'})
+
+    def do_DELETE(self):
+        self.server.containers.pop(self.path.split('?')[0].split('/')[-1])
+        self._send(204)
+
+
+@pytest.fixture
+def docker_server():
+    with TemporaryDirectory() as socket_dir:
+        server = FakeDockerServer(os.path.join(socket_dir, 'docker.sock'))
+        server.images['ubuntu:xenial'] = {'Id': 'sha256:1'}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+
+def _get_client(server):
+    return dockerapi.DockerClient(socket_path=server.server_address)
+
+
+def test_split_image_name():
+    assert dockerapi.split_image_name('ubuntu') == ('ubuntu', 'latest')
+    assert dockerapi.split_image_name('ubuntu:xenial') == ('ubuntu', 'xenial')
+    assert dockerapi.split_image_name('host:5000/ubuntu') == \
+        ('host:5000/ubuntu', 'latest')
+
+
+def test_client_reuses_connections(docker_server):
+    client = _get_client(docker_server)
+    assert client.ping()
+    assert client.inspect_image('ubuntu:xenial')['Id'] == 'sha256:1'
+    assert client.inspect_image('missing') is None
+    assert docker_server.connections == 1
+
+
+def test_client_ping_without_daemon():
+    client = dockerapi.DockerClient(socket_path='/nonexistent/docker.sock')
+    assert not client.ping()
+
+
+def test_api_build_machine_runs_script(docker_server):
+    lines = []
+    with TemporaryDirectory() as build_dir:
+        machine = buildmachine.ApiBuildMachine(
+            _get_client(docker_server), image='ubuntu:xenial',
+            line_handlers=[lines.append])
+        assert machine.get_image_id() == 'sha256:1'
+        machine.start(build_dir, {'/cache': '/vdist/cache'})
+        assert docker_server.containers['c1']['HostConfig']['Binds'] == \
+            ['/cache:/vdist/cache', '%s:/work' % build_dir]
+        machine.run_script('buildscript.sh')
+        machine.commit('vdist-provisioned:abc', labels={'a': '1'})
+        assert machine.get_image_label('vdist-provisioned:abc', 'a') == '1'
+        machine.shutdown()
+    assert sorted(lines) == ['err 1', 'out 1', 'out 2']
+    assert docker_server.containers == {}
+
+
+def test_api_build_machine_script_failure(docker_server):
+    docker_server.exec_exit_code = 2
+    machine = buildmachine.ApiBuildMachine(_get_client(docker_server),
+                                           image='ubuntu:xenial')
+    machine.container_id = 'c1'
+    with pytest.raises(buildmachine.CommandFailedException):
+        machine.run_script('buildscript.sh')
+
+
+def test_api_build_machine_pooled_container(docker_server):
+    pool = buildmachine.ContainerPool(size=1, max_uses=5)
+    with TemporaryDirectory() as build_basedir:
+        for dirname in ['build1', 'build2']:
+            machine = buildmachine.ApiBuildMachine(
+                _get_client(docker_server), image='ubuntu:xenial')
+            machine.enable_pool(pool, '/work/%s' % dirname, 'rm -rf /tmp/x')
+            machine.start(os.path.join(build_basedir, dirname))
+            assert machine._get_script_path('buildscript.sh') == \
+                '/work/%s/scratch/buildscript.sh' % dirname
+            machine.run_script('buildscript.sh')
+            machine.shutdown()
+        assert machine.container_uses == 1
+        assert docker_server.containers['c1']['HostConfig']['Binds'] == \
+            ['%s:/work' % build_basedir]
+    assert pool.drain() == ['c1']
+
+
+def _write_docker_config(config_dir, auths):
+    config_path = os.path.join(config_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'auths': auths}, f)
+    return config_path
+
+
+def test_registry_auth_from_docker_config():
+    assert dockerapi.get_registry('ubuntu') == 'index.docker.io'
+    assert dockerapi.get_registry('private.example.com:5000/app') == \
+        'private.example.com:5000'
+    with TemporaryDirectory() as config_dir:
+        config_path = _write_docker_config(config_dir, {
+            'https://index.docker.io/v1/': {
+                'auth': base64.b64encode(b'hub:secret').decode('ascii')},
+            'private.example.com': {'identitytoken': 'token'}})
+        hub_auth = json.loads(base64.urlsafe_b64decode(
+            dockerapi.get_registry_auth('index.docker.io', config_path)))
+        assert hub_auth == {'username': 'hub', 'password': 'secret',
+                            'serveraddress': 'https://index.docker.io/v1/'}
+        private_auth = json.loads(base64.urlsafe_b64decode(
+            dockerapi.get_registry_auth('private.example.com',
+                                        config_path)))
+        assert private_auth['identitytoken'] == 'token'
+        assert dockerapi.get_registry_auth('other.example.com',
+                                           config_path) is None
+    assert dockerapi.get_registry_auth('private.example.com',
+                                       '/nonexistent/config.json') is None
+
+
+def test_client_pull_sends_registry_auth(docker_server, monkeypatch):
+    with TemporaryDirectory() as config_dir:
+        _write_docker_config(config_dir, {'private.example.com': {
+            'auth': base64.b64encode(b'user:secret').decode('ascii')}})
+        monkeypatch.setenv('DOCKER_CONFIG', config_dir)
+        client = _get_client(docker_server)
+        client.pull_image('private.example.com/app:1.0')
+        assert client.inspect_image('private.example.com/app:1.0')
+        registry_auth = docker_server.pulls[-1]
+        assert json.loads(base64.urlsafe_b64decode(registry_auth)) == {
+            'username': 'user', 'password': 'secret',
+            'serveraddress': 'private.example.com'}
+
+        client.pull_image('ubuntu:trusty')
+        assert docker_server.pulls[-1] is None
+
+
+def test_api_build_machine_pull_falls_back_to_cli(docker_server,
+                                                  monkeypatch):
+    monkeypatch.setenv('DOCKER_CONFIG', '/nonexistent')
+    commands = []
+    machine = buildmachine.ApiBuildMachine(
+        _get_client(docker_server), image='private.example.com/app:1.0')
+    monkeypatch.setattr(machine, '_run_cli', commands.append)
+    assert machine.get_image_id() is None
+    assert commands == ['docker pull private.example.com/app:1.0']
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+import vdist.defaults as defaults
+import vdist.gitmirror as gitmirror
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+
+def _git(*args):
+    subprocess.check_output(('git', '-c', 'user.name=vdist',
+                             '-c', 'user.email=vdist@localhost') + args)
+
+
+def _commit(repository_dir, filename):
+    with open(os.path.join(repository_dir, filename), 'w') as f:
+        f.write(filename)
+    _git('-C', repository_dir, 'add', filename)
+    _git('-C', repository_dir, 'commit', '-q', '-m', filename)
+
+
+def test_mirror_updated_once_per_run(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        repository_dir = os.path.join(temporary_dir, 'repository')
+        _git('init', '-q', repository_dir)
+        _commit(repository_dir, 'setup.py')
+
+        mirrors = gitmirror.GitMirrors()
+        assert mirrors.update(repository_dir) == 'cloned'
+        assert mirrors.update(repository_dir) == 'reused'
+        _commit(repository_dir, 'README.md')
+        assert gitmirror.GitMirrors().update(repository_dir) == 'fetched'
+
+        clone_dir = os.path.join(temporary_dir, 'clone')
+        _git('clone', '-q', '--shared',
+             gitmirror.get_host_path(repository_dir), clone_dir)
+        assert os.path.isfile(os.path.join(clone_dir, 'README.md'))
+
+
+def test_mirror_unavailable(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR',
+                            os.path.join(temporary_dir, 'cache'))
+        mirrors = gitmirror.GitMirrors()
+        missing_repository = os.path.join(temporary_dir, 'missing')
+        assert mirrors.update(missing_repository) is None
+        assert mirrors.update(missing_repository) is None
+        assert not os.path.exists(gitmirror.get_host_path(missing_repository))
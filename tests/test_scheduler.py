@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+from vdist.scheduler import BuildScheduler
+
+
+class DummyBuild(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _get_builds(number):
+    return [DummyBuild('build-%d' % i) for i in range(number)]
+
+
+def test_scheduler_respects_max_jobs():
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def target(build, result):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    scheduler = BuildScheduler(max_jobs=2, start_delay=0)
+    results = scheduler.run(_get_builds(6), target)
+    assert peak[0] == 2
+    assert all(result.succeeded for result in results)
+
+
+def test_scheduler_keeps_build_order():
+    started = []
+
+    def target(build, result):
+        started.append(build.name)
+        assert threading.current_thread().name == build.name
+
+    builds = _get_builds(5)
+    scheduler = BuildScheduler(max_jobs=1, start_delay=0)
+    results = scheduler.run(builds, target)
+    assert started == [build.name for build in builds]
+    assert [result.build for result in results] == builds
+
+
+def test_scheduler_captures_failures():
+    def target(build, result):
+        if build.name == 'build-1':
+            raise RuntimeError('boom')
+
+    scheduler = BuildScheduler(start_delay=0)
+    results = scheduler.run(_get_builds(3), target)
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert isinstance(results[1].error, RuntimeError)
+    assert results[1].duration is not None
+
+
+def test_scheduler_staggers_starts():
+    starts = []
+
+    def target(build, result):
+        # Like build machines do before starting a container.
+        scheduler.wait_start_slot()
+        starts.append(time.time())
+
+    scheduler = BuildScheduler(start_delay=0.1)
+    scheduler.run(_get_builds(3), target)
+    starts.sort()
+    assert starts[2] - starts[0] >= 0.19
+
+
+def test_scheduler_does_not_delay_builds_without_containers():
+    # E.g. builds served from result cache.
+    scheduler = BuildScheduler(max_jobs=1, start_delay=10)
+    start_time = time.time()
+    results = scheduler.run(_get_builds(3), lambda build, result: None)
+    assert all(result.succeeded for result in results)
+    assert time.time() - start_time < 5
+
+
+def test_scheduler_invalid_max_jobs():
+    with pytest.raises(ValueError):
+        BuildScheduler(max_jobs=0)
+
+
+def test_result_saved_as_json():
+    import json
+    import tempfile
+
+    scheduler = BuildScheduler(start_delay=0)
+    results = scheduler.run(_get_builds(1),
+                            lambda build, result: result.report.update(
+                                {'phases': [{'name': 'setup'}]}))
+    with tempfile.NamedTemporaryFile(suffix='.json') as f:
+        results[0].save(f.name)
+        saved = json.load(open(f.name))
+    assert saved['build'] == 'build-0'
+    assert saved['succeeded']
+    assert saved['report']['phases'] == [{'name': 'setup'}]
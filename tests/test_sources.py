@@ -18,3 +18,14 @@ def test_source_type_git_directory():
     s = git_directory(path='/foo/bar/', branch='foo')
     assert s['branch'] == 'foo'
     assert s['path'] == '/foo/bar'
+
+
+def test_source_type_git_shallow_sparse():
+    s = git(uri='https://github.com/objectified/vdist')
+    assert s['depth'] is None
+    assert s['sparse_path'] is None
+
+    s = git(uri='https://github.com/objectified/vdist', depth='1',
+            sparse_path='services/api')
+    assert s['depth'] == 1
+    assert s['sparse_path'] == 'services/api'
@@ -0,0 +1,219 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import vdist.defaults as defaults
+import vdist.sourcetree as sourcetree
+
+if sys.version_info[0] != 3:
+    from testing_tools import TemporaryDirectory
+else:
+    from tempfile import TemporaryDirectory
+
+
+@pytest.fixture
+def cache_dir(monkeypatch):
+    with TemporaryDirectory() as temporary_dir:
+        monkeypatch.setattr(defaults, 'CACHE_DIR', temporary_dir)
+        yield temporary_dir
+
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_fingerprint_directory(cache_dir):
+    with TemporaryDirectory() as source_dir:
+        os.mkdir(os.path.join(source_dir, 'package'))
+        _write(os.path.join(source_dir, 'setup.py'), 'setup()')
+        _write(os.path.join(source_dir, 'package', '__init__.py'), '')
+        first_fingerprint = sourcetree.fingerprint_directory(source_dir)
+        assert first_fingerprint == sourcetree.fingerprint_directory(
+            source_dir)
+
+        _write(os.path.join(source_dir, 'package', '__init__.py'), 'a = 1')
+        second_fingerprint = sourcetree.fingerprint_directory(source_dir)
+        assert second_fingerprint != first_fingerprint
+
+        os.chmod(os.path.join(source_dir, 'setup.py'), 0o755)
+        assert sourcetree.fingerprint_directory(source_dir) != \
+            second_fingerprint
+
+
+def test_fingerprint_directory_concurrently(cache_dir):
+    with TemporaryDirectory() as source_dir:
+        _write(os.path.join(source_dir, 'setup.py'), 'setup()')
+        expected = sourcetree.fingerprint_directory(source_dir)
+        fingerprints = []
+        errors = []
+
+        def fingerprint_many():
+            try:
+                for _ in range(20):
+                    fingerprints.append(
+                        sourcetree.fingerprint_directory(source_dir))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fingerprint_many)
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert fingerprints == [expected] * 100
+        fingerprint_dir = os.path.join(cache_dir,
+                                       defaults.FINGERPRINT_CACHE_SUBDIR)
+        # Neither temporary index files are left behind.
+        assert [filename for filename in os.listdir(fingerprint_dir)
+                if not filename.endswith('.json')] == \
+            [defaults.CACHE_LOCK_FILE]
+
+
+def test_fingerprint_directory_excluded_dirs(cache_dir):
+    with TemporaryDirectory() as source_dir:
+        os.mkdir(os.path.join(source_dir, '.git'))
+        _write(os.path.join(source_dir, 'setup.py'), 'setup()')
+        fingerprint = sourcetree.fingerprint_directory(
+            source_dir, excluded_dirs=('.git', ))
+        _write(os.path.join(source_dir, '.git', 'HEAD'), 'ref: master')
+        assert fingerprint == sourcetree.fingerprint_directory(
+            source_dir, excluded_dirs=('.git', ))
+
+
+def test_ignore_rules():
+    rules = sourcetree.IgnoreRules(['# comment',
+                                    '',
+                                    '*.pyc',
+                                    'node_modules/',
+                                    '/build',
+                                    'docs/**/*.png',
+                                    '!important.pyc'])
+    assert rules.is_ignored('module.pyc')
+    assert rules.is_ignored('package/module.pyc')
+    assert not rules.is_ignored('important.pyc')
+    assert rules.is_ignored('node_modules', is_dir=True)
+    assert rules.is_ignored('frontend/node_modules', is_dir=True)
+    assert not rules.is_ignored('node_modules', is_dir=False)
+    assert rules.is_ignored('build', is_dir=True)
+    assert not rules.is_ignored('package/build', is_dir=True)
+    assert rules.is_ignored('docs/logo.png')
+    assert rules.is_ignored('docs/images/big/logo.png')
+    assert not rules.is_ignored('logo.png')
+
+
+def test_sync_and_link_tree(cache_dir):
+    with TemporaryDirectory() as temporary_dir:
+        source_dir = os.path.join(temporary_dir, 'source')
+        mirror_dir = os.path.join(temporary_dir, 'mirror')
+        scratch_dir = os.path.join(temporary_dir, 'scratch')
+        os.makedirs(os.path.join(source_dir, 'package'))
+        os.makedirs(os.path.join(source_dir, 'node_modules', 'left-pad'))
+        _write(os.path.join(source_dir, '.vdistignore'), 'node_modules/\n')
+        _write(os.path.join(source_dir, 'setup.py'), 'setup()')
+        _write(os.path.join(source_dir, 'package', '__init__.py'), '')
+        _write(os.path.join(source_dir, 'package', 'old.py'), '')
+        rules = sourcetree.IgnoreRules.from_directory(source_dir)
+
+        stats = sourcetree.sync_tree(source_dir, mirror_dir, rules)
+        assert stats.copied_files == 4
+        assert not os.path.exists(os.path.join(mirror_dir, 'node_modules'))
+
+        os.remove(os.path.join(source_dir, 'package', 'old.py'))
+        _write(os.path.join(source_dir, 'setup.py'), 'setup(name="a")')
+        stats = sourcetree.sync_tree(source_dir, mirror_dir, rules)
+        assert stats.copied_files == 1
+        assert stats.reused_files == 2
+        assert stats.removed_files == 1
+        assert not os.path.exists(os.path.join(mirror_dir, 'package',
+                                               'old.py'))
+
+        sourcetree.link_tree(mirror_dir, scratch_dir)
+        with open(os.path.join(scratch_dir, 'setup.py')) as f:
+            assert f.read() == 'setup(name="a")'
+        assert os.path.samefile(os.path.join(scratch_dir, 'setup.py'),
+                                os.path.join(mirror_dir, 'setup.py'))
+
+        # Linked files keep their contents when mirror is updated.
+        _write(os.path.join(source_dir, 'setup.py'), 'setup(name="b")')
+        sourcetree.sync_tree(source_dir, mirror_dir, rules)
+        with open(os.path.join(scratch_dir, 'setup.py')) as f:
+            assert f.read() == 'setup(name="a")'
+
+
+def _git(*args):
+    subprocess.check_output(('git', '-c', 'user.name=vdist',
+                             '-c', 'user.email=vdist@localhost') + args)
+
+
+def _create_git_repository(repository_dir):
+    _git('init', '-q', repository_dir)
+    os.mkdir(os.path.join(repository_dir, 'service'))
+    _write(os.path.join(repository_dir, 'setup.py'), 'setup()')
+    _write(os.path.join(repository_dir, 'service', 'setup.py'), 'setup()')
+    _git('-C', repository_dir, 'add', '.')
+    _git('-C', repository_dir, 'commit', '-q', '-m', 'First')
+    _git('-C', repository_dir, 'branch', 'release')
+    # Neither uncommitted changes nor other branches get exported.
+    _write(os.path.join(repository_dir, 'uncommitted.py'), '')
+
+
+def test_export_git_tree():
+    with TemporaryDirectory() as temporary_dir:
+        repository_dir = os.path.join(temporary_dir, 'repository')
+        _create_git_repository(repository_dir)
+        target_dir = os.path.join(temporary_dir, 'export')
+        stats = sourcetree.export_git_tree(repository_dir, 'release',
+                                           target_dir)
+        assert sorted(os.listdir(target_dir)) == ['service', 'setup.py']
+        assert stats.exported_files == 2
+        assert stats.exported_bytes == len('setup()') * 2
+
+        target_dir = os.path.join(temporary_dir, 'export_service')
+        sourcetree.export_git_tree(repository_dir, 'release', target_dir,
+                                   path='service')
+        assert os.listdir(target_dir) == ['service']
+
+        with pytest.raises(sourcetree.GitExportException):
+            sourcetree.export_git_tree(repository_dir, 'missing', target_dir)
+
+
+def test_export_git_tree_remote_branch():
+    with TemporaryDirectory() as temporary_dir:
+        origin_dir = os.path.join(temporary_dir, 'origin')
+        _create_git_repository(origin_dir)
+        repository_dir = os.path.join(temporary_dir, 'repository')
+        _git('clone', '-q', origin_dir, repository_dir)
+        # Only known as origin/release, as it was never checked out.
+        assert sourcetree.resolve_git_branch(repository_dir, 'release') == \
+            'origin/release'
+        assert sourcetree.resolve_git_branch(origin_dir, 'release') == \
+            'release'
+        target_dir = os.path.join(temporary_dir, 'export')
+        sourcetree.export_git_tree(
+            repository_dir,
+            sourcetree.resolve_git_branch(repository_dir, 'release'),
+            target_dir)
+        assert sorted(os.listdir(target_dir)) == ['service', 'setup.py']
+        assert sourcetree.fingerprint({'type': 'git_directory',
+                                       'path': repository_dir,
+                                       'branch': 'release'}) is not None
+
+
+def test_fingerprint_git_directory(cache_dir):
+    with TemporaryDirectory() as temporary_dir:
+        repository_dir = os.path.join(temporary_dir, 'repository')
+        _create_git_repository(repository_dir)
+        source = {'type': 'git_directory', 'path': repository_dir,
+                  'branch': 'release'}
+        first_fingerprint = sourcetree.fingerprint(source)
+        _write(os.path.join(repository_dir, 'setup.py'), 'setup(name="x")')
+        assert sourcetree.fingerprint(source) == first_fingerprint
+        _git('-C', repository_dir, 'commit', '-q', '-a', '-m', 'Second')
+        _git('-C', repository_dir, 'branch', '-f', 'release')
+        assert sourcetree.fingerprint(source) != first_fingerprint
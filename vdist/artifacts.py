@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import vdist.defaults as defaults
+
+# Block size used when copying and hashing packages.
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def get_packages(build_dir):
+    """Return paths of packages generated in build_dir.
+
+    Profile templates list every package they leave in build folder in a
+    manifest at scratch folder. Build folders without a manifest (restored
+    from result cache or built by custom templates that do not write one)
+    are taken as holding only packages as regular files.
+    """
+    manifest_path = os.path.join(build_dir, defaults.SCRATCH_DIR,
+                                 defaults.SCRATCH_MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return [os.path.join(build_dir, filename)
+                for filename in sorted(os.listdir(build_dir))
+                if os.path.isfile(os.path.join(build_dir, filename))]
+    packages = []
+    with open(manifest_path) as f:
+        for line in f:
+            package = os.path.join(build_dir, os.path.basename(line.strip()))
+            if line.strip() and package not in packages:
+                packages.append(package)
+    return packages
+
+
+def _get_temporary_path(target_path):
+    # Packages are written aside and renamed in place, so nobody watching
+    # output folder ever sees an incomplete one.
+    folder, filename = os.path.split(target_path)
+    return os.path.join(folder, '.%s.%s' % (filename, uuid.uuid4().hex))
+
+
+def _link(source_path, target_path):
+    temporary_path = _get_temporary_path(target_path)
+    try:
+        os.link(source_path, temporary_path)
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                       errno.ENOTSUP):
+            return False
+        raise
+    os.rename(temporary_path, target_path)
+    return True
+
+
+def _copy_and_hash(source_file, target_file):
+    # Single pass: every block is hashed while it is in memory to be
+    # written.
+    digest = hashlib.sha256()
+    buffer = bytearray(COPY_BLOCK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read_bytes = source_file.readinto(buffer)
+        if not read_bytes:
+            break
+        digest.update(view[:read_bytes])
+        target_file.write(view[:read_bytes])
+    return digest.hexdigest()
+
+
+def _copy_in_kernel(source_file, target_file):
+    # Data does not go through user space, so it cannot be hashed on the
+    # way. Only used once package hash is known.
+    source_fd = source_file.fileno()
+    target_fd = target_file.fileno()
+    try:
+        while True:
+            if hasattr(os, 'copy_file_range'):
+                copied_bytes = os.copy_file_range(source_fd, target_fd,
+                                                  COPY_BLOCK_SIZE)
+            else:
+                copied_bytes = os.sendfile(target_fd, source_fd, None,
+                                           COPY_BLOCK_SIZE)
+            if not copied_bytes:
+                return
+    except (AttributeError, OSError):
+        # Python 2, or a filesystem not supporting them. Carry on from
+        # current offsets.
+        shutil.copyfileobj(source_file, target_file, COPY_BLOCK_SIZE)
+
+
+def _copy(source_path, target_path, sha256=None):
+    # Returns hash of copied data, computed while copying unless it was
+    # already known.
+    temporary_path = _get_temporary_path(target_path)
+    try:
+        with open(source_path, 'rb') as source_file:
+            with open(temporary_path, 'wb') as target_file:
+                if sha256 is None:
+                    sha256 = _copy_and_hash(source_file, target_file)
+                else:
+                    _copy_in_kernel(source_file, target_file)
+        shutil.copystat(source_path, temporary_path)
+        os.rename(temporary_path, target_path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return sha256
+
+
+def _hash_file(file_pathname):
+    digest = hashlib.sha256()
+    with open(file_pathname, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def deliver(package_path, output_folders):
+    """Place package in every output folder and return its manifest entry.
+
+    Package is hard linked when output folder is in the same filesystem than
+    build folder, so no data is copied at all. Otherwise it is copied and
+    hashed in the same pass.
+    """
+    logger = logging.getLogger('Delivery')
+    start_time = time.time()
+    filename = os.path.basename(package_path)
+    sha256 = None
+    methods = []
+    delivered = []
+    for output_folder in output_folders:
+        if not os.path.isdir(output_folder):
+            try:
+                os.makedirs(output_folder)
+            except OSError:
+                # Another build created it meanwhile.
+                if not os.path.isdir(output_folder):
+                    raise
+        target_path = os.path.join(output_folder, filename)
+        if _link(package_path, target_path):
+            methods.append('link')
+        else:
+            sha256 = _copy(package_path, target_path, sha256)
+            methods.append('copy')
+        delivered.append(os.path.abspath(target_path))
+    if sha256 is None:
+        sha256 = _hash_file(package_path)
+    entry = {'name': filename,
+             'size': os.path.getsize(package_path),
+             'sha256': sha256,
+             'delivered': delivered,
+             'methods': methods,
+             'seconds': round(time.time() - start_time, 3)}
+    for target_path, method in zip(delivered, methods):
+        logger.info('Package delivered (%s): %s' % (method, target_path))
+    return entry
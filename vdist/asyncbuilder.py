@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import asyncio
+import concurrent.futures
+
+import vdist.builder as builder
+import vdist.scheduler as scheduler
+
+# Needs Python 3.5 or later. Python 2 users can keep using Builder.build().
+
+
+class AsyncBuilder(object):
+    """Runs builds of a Builder from an asyncio event loop.
+
+    Every build gets a future that resolves to its BuildResult once it
+    finishes, whether it succeeded or not, so callers can act on each build
+    as soon as it is done. Builds still run in worker threads (at most
+    max_jobs of them) because docker commands are blocking.
+
+    Once every build is done, resources kept among them are released and
+    build reports are written, whether build() is awaited or not.
+
+    Usage:
+        async_builder = AsyncBuilder(Builder(max_jobs=2))
+        async_builder.add_build(...)
+        async_builder.add_listener(print)
+        async_builder.start()
+        for next_result in async_builder.as_completed():
+            result = await next_result
+        await async_builder.build()
+    """
+
+    def __init__(self, vdist_builder=None, loop=None):
+        self.builder = vdist_builder or builder.Builder()
+        self.loop = loop
+        self.futures = {}
+        self.listeners = []
+        self._executor = None
+        self._finished = None
+        self.builder.add_listener(self._forward_event)
+
+    def add_build(self, **kwargs):
+        return self.builder.add_build(**kwargs)
+
+    def add_listener(self, callback):
+        """Have callback(event) called in event loop with every BuildEvent.
+
+        Callback can be a coroutine function too.
+        """
+        self.listeners.append(callback)
+
+    def _forward_event(self, event):
+        # Builds emit their events from worker threads.
+        self.loop.call_soon_threadsafe(self._dispatch_event, event)
+
+    def _dispatch_event(self, event):
+        for callback in self.listeners:
+            outcome = callback(event)
+            if asyncio.iscoroutine(outcome):
+                asyncio.ensure_future(outcome, loop=self.loop)
+
+    def start(self):
+        """Start running builds and return a dict of futures by build."""
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        builds = list(self.builder.builds)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.builder.scheduler.get_workers_number(
+                len(builds)) or 1)
+        self.builder.prepare()
+        for build in builds:
+            self.futures[build] = self.loop.run_in_executor(
+                self._executor, self.builder.scheduler.execute,
+                self.builder.run_build, scheduler.BuildResult(build))
+        self._finished = asyncio.ensure_future(self._finish(), loop=self.loop)
+        return self.futures
+
+    async def _finish(self):
+        results = await asyncio.gather(*self.futures.values())
+        try:
+            await self.loop.run_in_executor(self._executor,
+                                            self.builder.finish, results)
+        finally:
+            self._executor.shutdown(wait=False)
+        return results
+
+    def as_completed(self):
+        """Iterator of awaitables giving BuildResults as builds finish."""
+        return asyncio.as_completed(list(self.futures.values()))
+
+    def cancel(self, build):
+        """Cancel a pending or running build.
+
+        Its future still resolves to a BuildResult whose error is a
+        BuildCancelledException.
+        """
+        self.builder.cancel(build)
+
+    async def build(self):
+        """Run every build and return their results, in order they were
+        added."""
+        if self._finished is None:
+            self.start()
+        return await self._finished
@@ -5,46 +5,86 @@ import os
 import shutil
 import re
 import json
+import tempfile
 import threading
+import time
 
 import sys
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
+import vdist.artifacts as artifacts
 import vdist.configuration as configuration
 import vdist.defaults as defaults
 import vdist.buildmachine as buildmachine
+import vdist.cache as cache
+import vdist.dockerapi as dockerapi
+import vdist.gitmirror as gitmirror
+import vdist.scheduler as scheduler
+import vdist.sourcetree as sourcetree
+
+# Provisioning section of profile templates is rendered alone into a script
+# with this header to create provisioning snapshots. Setup block, if present,
+# is rendered before provisioning because it prepares the environment that
+# provisioning commands use.
+PROVISION_SCRIPT_HEADER = "#!/bin/bash -x\nset -e\n"
+PROVISION_SCRIPT_BLOCKS = ('setup', 'provision')
+PROVISION_SECONDS_LABEL = "vdist.provision_seconds"
+DOCKER_BACKENDS = ("auto", "api", "cli")
+
+
+def build_package(_configuration, max_jobs=defaults.MAX_JOBS,
+                  use_result_cache=True, rebuild=False):
+    return build_packages({"Default project": _configuration},
+                          max_jobs=max_jobs,
+                          use_result_cache=use_result_cache,
+                          rebuild=rebuild)
+
+
+def build_packages(configurations, max_jobs=defaults.MAX_JOBS,
+                   use_result_cache=True, rebuild=False):
+    # Every configuration is built in the same Builder run so they are
+    # scheduled together instead of one after another. Packages are
+    # delivered to output folders as soon as each build finishes.
+    builder = Builder(max_jobs=max_jobs,
+                      use_result_cache=use_result_cache,
+                      rebuild=rebuild)
+    build_configurations = _add_builds(builder, configurations)
+    for build, _configurations in zip(builder.builds, build_configurations):
+        for _configuration in _configurations:
+            builder.add_output_folder(build, _configuration.output_folder)
+    results = builder.build()
+    for result, _configurations in zip(results, build_configurations):
+        # Reports go along with delivered packages. Those of builds without
+        # any stay in their build folder logs, where they broke.
+        if not result.report.get('artifacts'):
+            continue
+        for _configuration in _configurations:
+            _create_output_folder(_configuration)
+            result.save(os.path.join(_configuration.output_folder,
+                                     '%s.report.json' % result.build.dirname))
+    return results
+
+
+def _add_builds(builder, configurations):
+    # Sections with identical build parameters are built only once. Returns
+    # a list, aligned with builder.builds, with the configurations whose
+    # output folders should receive each build packages.
+    build_configurations = []
+    build_index = {}
+    for section in sorted(configurations):
+        _configuration = configurations[section]
+        key = _get_build_key(_configuration)
+        if key in build_index:
+            build_configurations[build_index[key]].append(_configuration)
+        else:
+            build_index[key] = len(build_configurations)
+            build_configurations.append([_configuration, ])
+            builder.add_build(**_configuration.builder_parameters)
+    return build_configurations
 
 
-def build_package(_configuration):
-    _create_package(_configuration)
-    _move_package_to_output_folder(_configuration)
-
-
-def _create_package(_configuration):
-    builder = Builder()
-    builder.add_build(**_configuration.builder_parameters)
-    builder.build()
-
-
-def _move_package_to_output_folder(_configuration,
-                                   source_folder=defaults.BUILD_BASEDIR):
-    _create_output_folder(_configuration)
-    package_folder = _get_generated_package_folder(_configuration,
-                                                   source_folder)
-    _move_generated_packages(_configuration, package_folder)
-
-
-def _move_generated_packages(_configuration, package_folder):
-    for file in os.listdir(package_folder):
-        # Only copy files with extension as they are likely the generated
-        # package.
-        if os.path.splitext(file)[1] != "":
-            file_pathname = os.path.join(package_folder, file)
-            shutil.copy(file_pathname, _configuration.output_folder)
-
-
-def _get_generated_package_folder(_configuration, source_folder):
-    return os.path.join(source_folder, _get_package_folder_name(_configuration))
+def _get_build_key(_configuration):
+    return json.dumps(_configuration.builder_parameters, sort_keys=True)
 
 
 def _create_output_folder(_configuration):
@@ -59,11 +99,6 @@ def _create_folder(_configuration):
         os.makedirs(_configuration.output_folder)
 
 
-def _get_package_folder_name(_configuration):
-    package_folder = "{app}-{version}-{profile}".format(**_configuration.builder_parameters)
-    return package_folder
-
-
 class BuildProfile(object):
 
     def __init__(self, **kwargs):
@@ -107,16 +142,18 @@ class Build(object):
                  working_dir='', python_basedir=None,
                  compile_python=True,
                  python_version=defaults.PYTHON_VERSION,
+                 compile_jobs=None,
+                 ccache_dir=None,
                  requirements_path='/requirements.txt',
                  after_install=None,
                  before_install=None,
                  after_remove=None,
                  before_remove=None,
                  after_upgrade=None,
-                 before_upgrade=None):
+                 before_upgrade=None,
+                 mount_source=False):
         self.app = app
         self.version = version.format(**os.environ)
-        self.source = source
         self.use_local_pip_conf = use_local_pip_conf
         if package_install_root is None:
             self.package_install_root = defaults.PACKAGE_INSTALL_ROOT.format(**os.environ)
@@ -127,13 +164,28 @@ class Build(object):
         else:
             self.package_tmp_root = package_tmp_root.format(**os.environ)
         self.working_dir = working_dir.format(**os.environ)
+        if source['type'] == 'git' and not source.get('sparse_path') and \
+                self.working_dir:
+            # Only working_dir gets packaged, so only it is checked out.
+            source = dict(source, sparse_path=self.working_dir)
+        self.source = source
         self.requirements_path = requirements_path.format(**os.environ)
         if python_basedir is None:
             self.python_basedir = "/".join([defaults.PYTHON_BASEDIR, app]).format(**os.environ)
         else:
             self.python_basedir = python_basedir.format(**os.environ)
         self.compile_python = compile_python
+        # Local sources are bind mounted read only instead of copied.
+        self.mount_source = mount_source
         self.python_version = python_version.format(**os.environ)
+        # None compiles python with as many jobs as CPUs the build container
+        # may use.
+        self.compile_jobs = int(compile_jobs) if compile_jobs else None
+        if ccache_dir:
+            self.ccache_dir = os.path.abspath(os.path.expanduser(
+                ccache_dir.format(**os.environ)))
+        else:
+            self.ccache_dir = None
         if custom_filename:
             self.custom_filename = custom_filename.format(**os.environ)
         else:
@@ -158,6 +210,10 @@ class Build(object):
         else:
             self.name = name
 
+        # Folder name for this build under build basedir. Builder changes it
+        # if another build already uses it.
+        self.dirname = self.get_safe_dirname()
+
     def __str__(self):
         return str(self.__dict__)
 
@@ -206,21 +262,128 @@ class Builder(object):
     def __init__(
             self,
             profiles_dir=defaults.LOCAL_PROFILES_DIR,
-            machine_logs=True):
+            machine_logs=True,
+            max_jobs=defaults.MAX_JOBS,
+            start_delay=defaults.BUILD_START_DELAY,
+            provision_snapshots=True,
+            pip_cache_max_size=defaults.PIP_CACHE_MAX_SIZE,
+            dependencies_cache_max_size=defaults.DEPENDENCIES_CACHE_MAX_SIZE,
+            package_lists_ttl=defaults.PACKAGE_LISTS_TTL,
+            use_result_cache=True,
+            rebuild=False,
+            use_git_mirrors=True,
+            use_wheelhouse=True,
+            docker_backend=defaults.DOCKER_BACKEND,
+            docker_cli=defaults.DOCKER_CLI,
+            container_pool_size=defaults.CONTAINER_POOL_SIZE,
+            container_max_uses=defaults.CONTAINER_MAX_USES):
         logging.basicConfig(format='%(asctime)s %(levelname)s '
                             '[%(threadName)s] %(name)s %(message)s',
                             level=logging.INFO)
         self.logger = logging.getLogger('Builder')
 
-        self.build_basedir = defaults.BUILD_BASEDIR
+        # Every run gets its own locked folder under runs_basedir, so
+        # concurrent vdist processes do not remove each other builds.
+        self.runs_basedir = defaults.BUILD_BASEDIR
+        self.build_basedir = None
+        self._run_lock = None
         self.profiles = {}
         self.builds = []
+        # Folders where packages of each build are delivered as soon as it
+        # finishes.
+        self.output_folders = {}
 
         self.machine_logs = machine_logs
         self.local_profiles_dir = profiles_dir
+        self.provision_snapshots = provision_snapshots
+        self.pip_cache_max_size = pip_cache_max_size
+        self.dependencies_cache_max_size = dependencies_cache_max_size
+        self.package_lists_ttl = package_lists_ttl
+        # Rebuild ignores cached results but still stores new ones.
+        self.use_result_cache = use_result_cache
+        self.rebuild = rebuild
+        self.use_git_mirrors = use_git_mirrors
+        self.git_mirrors = gitmirror.GitMirrors()
+        self.use_wheelhouse = use_wheelhouse
+        if docker_backend not in DOCKER_BACKENDS:
+            raise ValueError('docker_backend must be one of: %s' %
+                             ', '.join(DOCKER_BACKENDS))
+        self.docker_backend = docker_backend
+        self.docker_cli = docker_cli
+        self._docker_client = None
+        self._loaded_profile_files = None
+        self._template_environment = None
+        self._template_environment_lock = threading.Lock()
+
+        self.listeners = []
+        self._running_machines = {}
+        self._cancelled = set()
+        self._running_lock = threading.Lock()
+
+        self.container_pool = None
+        if container_pool_size > 0:
+            self.container_pool = buildmachine.ContainerPool(
+                size=container_pool_size, max_uses=container_max_uses)
+
+        self.scheduler = scheduler.BuildScheduler(max_jobs=max_jobs,
+                                                  start_delay=start_delay)
 
     def add_build(self, **kwargs):
-        self.builds.append(Build(**kwargs))
+        build = Build(**kwargs)
+        build.dirname = self._get_unique_dirname(build.dirname)
+        self.builds.append(build)
+        return build
+
+    def add_output_folder(self, build, output_folder):
+        """Have build packages delivered to output_folder once it succeeds."""
+        self.output_folders.setdefault(build, []).append(output_folder)
+
+    def add_listener(self, callback):
+        """Have callback(event) called with every BuildEvent.
+
+        Callbacks are called from the thread running the build, so they
+        should return quickly.
+        """
+        self.listeners.append(callback)
+
+    def _emit(self, name, build, **data):
+        event = scheduler.BuildEvent(name, build, time.time(), data)
+        for callback in self.listeners:
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception('Build event listener failed: %s' %
+                                      name)
+
+    def cancel(self, build):
+        """Stop build as soon as possible.
+
+        Pending builds fail as soon as they start and running ones get their
+        container removed, so both end with a BuildCancelledException.
+        """
+        with self._running_lock:
+            self._cancelled.add(build)
+            build_machine = self._running_machines.get(build)
+        if build_machine is not None and \
+                build_machine.container_id is not None:
+            self.logger.info('Cancelling build: %s' % build.name)
+            build_machine.container_failed = True
+            build_machine.remove_container(build_machine.container_id)
+
+    def _check_cancelled(self, build):
+        with self._running_lock:
+            if build in self._cancelled:
+                raise BuildCancelledException('build cancelled: %s' %
+                                              build.name)
+
+    def _get_unique_dirname(self, dirname):
+        used_dirnames = set(build.dirname for build in self.builds)
+        unique_dirname = dirname
+        suffix = 2
+        while unique_dirname in used_dirnames:
+            unique_dirname = '%s-%d' % (dirname, suffix)
+            suffix += 1
+        return unique_dirname
 
     def _create_vdist_dir(self):
         vdist_path = os.path.join(os.path.expanduser('~'), '.vdist')
@@ -243,56 +406,391 @@ class Builder(object):
 
                 self.profiles[profile_id] = profile
 
-    def _load_profiles(self):
+    def _get_profile_files(self):
         internal_profiles = os.path.join(
             os.path.dirname(__file__),
             'profiles', 'internal_profiles.json')
-        self._add_profiles_from_file(internal_profiles)
-
         local_profiles = os.path.join(
             self.local_profiles_dir, defaults.LOCAL_PROFILES_FILE)
-        if os.path.isfile(local_profiles):
-            self._add_profiles_from_file(local_profiles)
-
-    def _render_template(self, build):
-        internal_template_dir = os.path.join(
-            os.path.dirname(__file__), 'profiles')
-
-        local_template_dir = os.path.abspath(self.local_profiles_dir)
-
-        env = Environment(loader=FileSystemLoader(
-            [internal_template_dir, local_template_dir]))
+        return [profile_file
+                for profile_file in [internal_profiles, local_profiles]
+                if os.path.isfile(profile_file)]
 
+    def _load_profiles(self):
+        # Profile files are only read again when any of them has changed.
+        loaded_profile_files = [(profile_file, os.path.getmtime(profile_file))
+                                for profile_file in self._get_profile_files()]
+        if loaded_profile_files == self._loaded_profile_files:
+            return
+        for profile_file, _ in loaded_profile_files:
+            self._add_profiles_from_file(profile_file)
+        self._loaded_profile_files = loaded_profile_files
+
+    def _get_template_environment(self):
+        # Every build shares this environment, so each template is compiled
+        # once. Jinja checks template mtimes to recompile changed ones, and
+        # compiled templates are kept (keyed by their source checksum) for
+        # next runs, out of cache folders mounted into build containers.
+        with self._template_environment_lock:
+            if self._template_environment is None:
+                internal_template_dir = os.path.join(
+                    os.path.dirname(__file__), 'profiles')
+
+                local_template_dir = os.path.abspath(self.local_profiles_dir)
+
+                bytecode_cache_dir = cache.create_dir(
+                    defaults.TEMPLATE_CACHE_DIR)
+                self._template_environment = Environment(
+                    loader=FileSystemLoader([internal_template_dir,
+                                             local_template_dir]),
+                    bytecode_cache=FileSystemBytecodeCache(
+                        bytecode_cache_dir))
+        return self._template_environment
+
+    def _get_profile(self, build):
         if build.profile not in self.profiles:
             raise BuildProfileNotFoundException(
                 'profile not found: %s' % build.profile)
+        return self.profiles[build.profile]
+
+    def _get_template_source(self, profile):
+        env = self._get_template_environment()
+        source, _, _ = env.loader.get_source(env, profile.script)
+        return source
+
+    def _get_template(self, build):
+        env = self._get_template_environment()
 
-        profile = self.profiles[build.profile]
+        profile = self._get_profile(build)
         template_name = profile.script
-        template = env.get_template(template_name)
+        return env.get_template(template_name)
 
+    @staticmethod
+    def _get_template_variables(build, template_context=None):
+        shared_dir = (template_context or {}).get('shared_dir',
+                                                  defaults.SHARED_DIR)
         scratch_dir = os.path.join(
-            defaults.SHARED_DIR,
+            shared_dir,
             defaults.SCRATCH_DIR
         )
 
         # local uid and gid are needed to correctly set permissions
         # on the created artifacts after the build completes
-        return template.render(
+        variables = dict(
             local_uid=os.getuid(),
             local_gid=os.getgid(),
             project_root=build.get_project_root_from_source(),
-            shared_dir=defaults.SHARED_DIR,
+            shared_dir=shared_dir,
             scratch_dir=scratch_dir,
-            **build.__dict__
+            manifest_file=os.path.join(scratch_dir,
+                                       defaults.SCRATCH_MANIFEST_NAME),
         )
+        variables.update(build.__dict__)
+        if template_context:
+            variables.update(template_context)
+        return variables
+
+    def _render_template(self, build, template_context=None):
+        template = self._get_template(build)
+        return template.render(
+            **self._get_template_variables(build, template_context))
+
+    def _render_provision_script(self, build, template_context=None):
+        # Only templates with a "provision" block can be snapshotted.
+        template = self._get_template(build)
+        if 'provision' not in template.blocks:
+            return None
+        variables = self._get_template_variables(build, template_context)
+        variables['provisioned'] = False
+        context = template.new_context(variables)
+        sections = [''.join(template.blocks[block](context))
+                    for block in PROVISION_SCRIPT_BLOCKS
+                    if block in template.blocks]
+        return PROVISION_SCRIPT_HEADER + ''.join(sections)
+
+    @staticmethod
+    def _get_snapshot_image(image_id, provision_script):
+        key = cache.make_key(image_id, provision_script)
+        return '%s:%s' % (defaults.SNAPSHOT_REPOSITORY, key[:16])
+
+    def _get_provisioning_key(self, build):
+        # Libraries installed while provisioning (like build_deps) decide
+        # which python modules get compiled and what configure finds.
+        provision_script = self._render_provision_script(build)
+        if provision_script is None:
+            provision_script = ' '.join(build.build_deps)
+        return cache.make_key(provision_script)
+
+    def _get_python_cache_key(self, build, profile, image_id):
+        # Compiled interpreters depend on the image they were compiled in,
+        # its provisioning, python version, install prefix and configure
+        # flags (the last ones are part of the profile template).
+        if not build.compile_python:
+            return None
+        return cache.make_key(image_id,
+                              self._get_provisioning_key(build),
+                              build.python_version,
+                              build.python_basedir,
+                              self._get_template_source(profile))
+
+    def _get_python_cache_context(self, build, profile, image_id, result):
+        key = self._get_python_cache_key(build, profile, image_id)
+        if key is None:
+            return {}
+        cache_dir = cache.create_dir(
+            cache.get_host_path(defaults.PYTHON_CACHE_SUBDIR, key))
+        if os.path.isfile(os.path.join(cache_dir, defaults.PYTHON_CACHE_FILE)):
+            status = 'hit'
+        else:
+            status = 'miss'
+        self.logger.info('Python interpreter cache %s: %s' % (status, key))
+        result.report['python_cache'] = status
+        # Configure results only depend on image, its provisioning and
+        # python version.
+        configure_key = cache.make_key(image_id,
+                                       self._get_provisioning_key(build),
+                                       build.python_version)
+        cache.create_dir(cache.get_host_path(defaults.CONFIGURE_CACHE_SUBDIR,
+                                             configure_key))
+        return {
+            'python_cache_dir': cache.get_container_path(
+                defaults.PYTHON_CACHE_SUBDIR, key),
+            'python_cache_file': cache.get_container_path(
+                defaults.PYTHON_CACHE_SUBDIR, key, defaults.PYTHON_CACHE_FILE),
+            'configure_cache_file': cache.get_container_path(
+                defaults.CONFIGURE_CACHE_SUBDIR, configure_key,
+                defaults.CONFIGURE_CACHE_FILE)
+        }
+
+    def _get_dependencies_cache_context(self, build, profile, image_id):
+        # Python environments with dependencies installed are kept apart for
+        # every interpreter and pip arguments, and then for every
+        # requirements file content inside containers, where it is read.
+        python_key = self._get_python_cache_key(build, profile, image_id)
+        if python_key is None:
+            # Interpreter comes with the image, so python_basedir may be a
+            # system folder (like /usr) that is not vdist's to replace.
+            return None, {}
+        cache_parts = (defaults.DEPENDENCIES_CACHE_SUBDIR,
+                       cache.make_key(python_key, build.pip_args))
+        cache_root = cache.create_dir(
+            cache.get_host_path(defaults.DEPENDENCIES_CACHE_SUBDIR))
+        cache.prune(cache_root, self.dependencies_cache_max_size)
+        cache.create_dir(cache.get_host_path(*cache_parts))
+        return cache_root, {'dependencies_cache_dir':
+                            cache.get_container_path(*cache_parts)}
+
+    def _get_pip_cache_context(self, build):
+        # Wheels built in one profile may not work in another, so pip cache
+        # is kept apart for every profile and python version.
+        cache_parts = (defaults.PIP_CACHE_SUBDIR, build.profile,
+                       build.python_version)
+        cache_dir = cache.create_dir(cache.get_host_path(*cache_parts))
+        cache.prune(cache_dir, self.pip_cache_max_size)
+        return cache_dir, {'pip_cache_dir': cache.get_container_path(
+            *cache_parts)}
+
+    def _get_package_cache_context(self, profile):
+        # Downloaded OS packages depend on base image distribution, so every
+        # image gets its own package cache.
+        cache_parts = (defaults.PACKAGE_CACHE_SUBDIR,
+                       re.sub(r'[^A-Za-z0-9\.\-]', '_', profile.docker_image))
+        cache.create_dir(cache.get_host_path(*cache_parts))
+        return {'package_cache_dir': cache.get_container_path(*cache_parts),
+                'package_lists_ttl': self.package_lists_ttl}
+
+    def _get_wheelhouse_context(self, build):
+        # Wheelhouse is further split by requirements and python ABI inside
+        # containers, only they know them.
+        if not self.use_wheelhouse:
+            return {}
+        cache_parts = (defaults.WHEELHOUSE_SUBDIR,
+                       cache.make_key(build.pip_args)[:16])
+        cache.create_dir(cache.get_host_path(*cache_parts))
+        return {'wheelhouse_dir': cache.get_container_path(*cache_parts)}
+
+    def _report_compile(self, compile_recorder, result):
+        if compile_recorder.compile is None:
+            return
+        result.report['python_compile'] = compile_recorder.compile
+        message = 'Python compiled in %.1f seconds with %d jobs' % (
+            compile_recorder.compile['seconds'],
+            compile_recorder.compile['jobs'])
+        if compile_recorder.compile['ccache_hit_ratio'] is not None:
+            message += ', ccache hit ratio: %.0f%%' % (
+                compile_recorder.compile['ccache_hit_ratio'] * 100)
+        self.logger.info(message)
+
+    def _report_caches(self, cache_recorder, result):
+        for name, status in sorted(cache_recorder.caches.items()):
+            result.report[name] = status
+            self.logger.info('%s %s' % (name.replace('_', ' ').capitalize(),
+                                        status))
+
+    def _report_wheels(self, wheels_recorder, result):
+        if wheels_recorder.wheels is None:
+            return
+        result.report['wheelhouse'] = wheels_recorder.wheels
+        self.logger.info('Dependency wheels: %d built, %d reused' %
+                         (wheels_recorder.wheels['built'],
+                          wheels_recorder.wheels['reused']))
+
+    def _report_clone(self, clone_recorder, build, result):
+        if clone_recorder.clone is None:
+            return
+        result.report['source_clone'] = clone_recorder.clone
+        self.logger.info('Cloned %s in %.1f seconds: %d bytes transferred' %
+                         (build.source['uri'], clone_recorder.clone['seconds'],
+                          clone_recorder.clone['bytes']))
+
+    def _get_git_mirror_context(self, build, result):
+        # Remote git sources are cloned from a mirror in host cache, fetched
+        # once per run for all builds using the same repository.
+        if not self.use_git_mirrors or build.source['type'] != 'git':
+            return {}
+        state = self.git_mirrors.update(build.source['uri'])
+        result.report['git_mirror'] = state or 'unavailable'
+        if state is None:
+            return {}
+        return {'git_mirror': gitmirror.get_container_path(
+            build.source['uri'])}
+
+    def _report_pip_cache(self, pip_cache_counter, result):
+        result.report['pip_cache_hits'] = pip_cache_counter.hits
+        result.report['pip_cache_misses'] = pip_cache_counter.misses
+        result.report['pip_cache_hit_ratio'] = pip_cache_counter.hit_ratio
+        if pip_cache_counter.hit_ratio is not None:
+            self.logger.info('Pip cache hit ratio: %.0f%% (%d of %d)' %
+                             (pip_cache_counter.hit_ratio * 100,
+                              pip_cache_counter.hits,
+                              pip_cache_counter.hits +
+                              pip_cache_counter.misses))
 
-    def _clean_build_basedir(self):
-        if os.path.exists(self.build_basedir):
-            shutil.rmtree(self.build_basedir)
+    @staticmethod
+    def _get_result_cache_key(build, image_id, build_dir,
+                              provision_script=None):
+        # Packaging scripts are part of the source tree, so they are
+        # included in the source fingerprint.
+        source_fingerprint = sourcetree.fingerprint(build.source)
+        if source_fingerprint is None:
+            return None
+        build_script_path = os.path.join(build_dir, defaults.SCRATCH_DIR,
+                                         defaults.SCRATCH_BUILDSCRIPT_NAME)
+        with open(build_script_path) as f:
+            build_script = f.read()
+        return cache.make_key(source_fingerprint, image_id, build_script,
+                              provision_script or '')
+
+    def _restore_cached_result(self, key, build_dir):
+        cached_result_dir = cache.get_host_path(defaults.RESULT_CACHE_SUBDIR,
+                                                key)
+        if not os.path.isdir(cached_result_dir):
+            return False
+        # Restored packages are copied, not linked: they are hard linked
+        # later to output folders, where users may sign or edit them in
+        # place.
+        for filename in os.listdir(cached_result_dir):
+            shutil.copy2(os.path.join(cached_result_dir, filename),
+                         os.path.join(build_dir, filename))
+        return True
+
+    def _store_result(self, key, build_dir):
+        packages = artifacts.get_packages(build_dir)
+        if not packages:
+            return
+        results_dir = cache.create_dir(
+            cache.get_host_path(defaults.RESULT_CACHE_SUBDIR))
+        # Fill a temporary folder and rename it at the end, so other builds
+        # never get an incomplete result.
+        temporary_dir = tempfile.mkdtemp(prefix='.%s.' % key,
+                                         dir=results_dir)
+        # Copied for the same reason than in _restore_cached_result(): a
+        # cached package must never share its inode with a delivered one.
+        for package in packages:
+            shutil.copy2(package, os.path.join(
+                temporary_dir, os.path.basename(package)))
+        cached_result_dir = os.path.join(results_dir, key)
+        if os.path.isdir(cached_result_dir):
+            shutil.rmtree(cached_result_dir)
+        try:
+            os.rename(temporary_dir, cached_result_dir)
+        except OSError:
+            # Another build stored the same result meanwhile.
+            shutil.rmtree(temporary_dir)
+
+    def _remove_stale_runs(self):
+        # Folders of finished runs (and of plain builds from vdist versions
+        # without run folders) are renamed aside at once, so they are out of
+        # the way, and deleted in background.
+        trash_dirs = []
+        for entry in os.listdir(self.runs_basedir):
+            entry_path = os.path.join(self.runs_basedir, entry)
+            if entry.startswith(defaults.BUILD_NEW_RUN_PREFIX) or \
+                    not os.path.isdir(entry_path):
+                continue
+            if entry.startswith(defaults.BUILD_TRASH_PREFIX):
+                # Left by a process that exited before deleting it.
+                trash_dirs.append(entry_path)
+                continue
+            run_lock = cache.CacheLock(entry_path)
+            if not run_lock.acquire(shared=False, blocking=False):
+                # Run still going on.
+                continue
+            trash_dir = tempfile.mkdtemp(prefix=defaults.BUILD_TRASH_PREFIX,
+                                         dir=self.runs_basedir)
+            try:
+                os.rename(entry_path, os.path.join(trash_dir, entry))
+                trash_dirs.append(trash_dir)
+            except OSError:
+                # Another vdist process got rid of it first.
+                os.rmdir(trash_dir)
+            finally:
+                run_lock.release()
+        if trash_dirs:
+            self.logger.info('Removing %d stale build folders in background' %
+                             len(trash_dirs))
+            thread = threading.Thread(target=self._remove_dirs,
+                                      args=(trash_dirs, ),
+                                      name='stale-builds-cleaner')
+            # Whatever is left when vdist exits is deleted next run.
+            thread.daemon = True
+            thread.start()
+        return trash_dirs
+
+    @staticmethod
+    def _remove_dirs(paths):
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
 
     def _create_build_basedir(self):
-        os.mkdir(self.build_basedir)
+        # Run folder gets locked before it gets its final name, so other
+        # vdist processes never take it as stale.
+        cache.create_dir(self.runs_basedir)
+        self._remove_stale_runs()
+        new_run_dir = tempfile.mkdtemp(
+            prefix='%s%s-' % (defaults.BUILD_NEW_RUN_PREFIX,
+                              time.strftime('%Y%m%d%H%M%S')),
+            dir=self.runs_basedir)
+        self._run_lock = cache.CacheLock(new_run_dir)
+        self._run_lock.acquire(shared=False)
+        self.build_basedir = os.path.join(
+            self.runs_basedir,
+            defaults.BUILD_RUN_PREFIX +
+            os.path.basename(new_run_dir)[len(defaults.BUILD_NEW_RUN_PREFIX):])
+        os.rename(new_run_dir, self.build_basedir)
+        self.logger.info('Build folder for this run: %s' % self.build_basedir)
+
+    def _release_build_basedir(self):
+        # Run folder is kept for inspection until next vdist run.
+        if self._run_lock is not None:
+            self._run_lock.release()
+            self._run_lock = None
+
+    @staticmethod
+    def _reclaim_scratch_dir(build_dir):
+        # Everything needed from scratch is already in packages.
+        shutil.rmtree(os.path.join(build_dir, defaults.SCRATCH_DIR),
+                      ignore_errors=True)
 
     @staticmethod
     def _write_build_script(path, script):
@@ -300,11 +798,12 @@ class Builder(object):
             f.write(script)
         os.chmod(path, 0o777)
 
-    def _populate_scratch_dir(self, scratch_dir, build):
+    def _populate_scratch_dir(self, scratch_dir, build, template_context=None,
+                              result=None):
         # write rendered build script to scratch dir
         self._write_build_script(
             os.path.join(scratch_dir, defaults.SCRATCH_BUILDSCRIPT_NAME),
-            self._render_template(build)
+            self._render_template(build, template_context)
         )
 
         # copy local ~/.pip if necessary
@@ -319,17 +818,73 @@ class Builder(object):
             if not os.path.exists(build.source['path']):
                 raise ValueError(
                     'path does not exist: %s' % build.source['path'])
+            elif build.source['type'] == 'git_directory':
+                self._export_git_source(build, scratch_dir, result)
+            elif build.mount_source:
+                self._write_source_list(
+                    build.source['path'].rstrip('/'),
+                    os.path.join(scratch_dir,
+                                 defaults.SCRATCH_SOURCE_LIST_NAME))
             else:
                 subdir = os.path.basename(build.source['path'])
-                shutil.copytree(
-                    build.source['path'].rstrip('/'),
-                    os.path.join(scratch_dir, subdir)
-                )
+                self._copy_source(build.source['path'].rstrip('/'),
+                                  os.path.join(scratch_dir, subdir))
 
-    def _create_build_dir(self, build):
-        subdir_name = build.get_safe_dirname()
-
-        build_dir = os.path.join(self.build_basedir, subdir_name)
+    @staticmethod
+    def _write_source_list(source_dir, list_path):
+        # Files to copy from mounted source, so .vdistignore is honored
+        # inside container too. NUL separated, as tar --null expects.
+        ignore_rules = sourcetree.IgnoreRules.from_directory(source_dir)
+        with open(list_path, 'wb') as f:
+            for relative_dirpath, dirnames, filenames in sourcetree.walk(
+                    source_dir, ignore_rules):
+                for name in dirnames + filenames:
+                    f.write(sourcetree.to_bytes(
+                        os.path.join('.', relative_dirpath, name)))
+                    f.write(b'\0')
+
+    def _export_git_source(self, build, scratch_dir, result=None):
+        # Only files of requested branch (under working_dir, if set) are
+        # taken, straight from git objects.
+        start_time = time.time()
+        stats = sourcetree.export_git_tree(
+            build.source['path'],
+            sourcetree.resolve_git_branch(build.source['path'],
+                                          build.source['branch']),
+            os.path.join(scratch_dir, build.get_project_root_from_source()),
+            path=build.working_dir)
+        seconds = time.time() - start_time
+        self.logger.info('Source exported from git in %.1f seconds: %s' %
+                         (seconds, stats))
+        if result is not None:
+            result.report['source_export'] = {
+                'files': stats.exported_files,
+                'bytes': stats.exported_bytes,
+                'seconds': round(seconds, 3)}
+
+    def _copy_source(self, source_dir, target_dir):
+        # An up to date copy of every source is kept in cache, only changed
+        # files are copied there on each build, and scratch dir gets hard
+        # links to it. Files excluded by a .vdistignore file are not copied.
+        start_time = time.time()
+        mirror_root = cache.get_host_path(
+            defaults.SOURCE_CACHE_SUBDIR,
+            cache.make_key(os.path.abspath(source_dir)))
+        mirror_lock = cache.CacheLock(mirror_root)
+        mirror_lock.acquire(shared=False)
+        try:
+            mirror_dir = os.path.join(mirror_root, 'tree')
+            stats = sourcetree.sync_tree(
+                source_dir, mirror_dir,
+                sourcetree.IgnoreRules.from_directory(source_dir))
+            sourcetree.link_tree(mirror_dir, target_dir)
+        finally:
+            mirror_lock.release()
+        self.logger.info('Source copied to scratch in %.1f seconds: %s' %
+                         (time.time() - start_time, stats))
+
+    def _create_build_dir(self, build, template_context=None, result=None):
+        build_dir = os.path.join(self.build_basedir, build.dirname)
 
         if os.path.exists(build_dir):
             shutil.rmtree(build_dir)
@@ -341,58 +896,341 @@ class Builder(object):
         os.mkdir(scratch_dir)
 
         # write necessary stuff to scratch_dir
-        self._populate_scratch_dir(scratch_dir, build)
+        self._populate_scratch_dir(scratch_dir, build, template_context,
+                                   result)
 
         return build_dir
 
-    def run_build(self, build):
-        profile = self.profiles[build.profile]
+    def _resolve_docker_backend(self):
+        if self.docker_backend == 'cli' or self._docker_client is not None:
+            return
+        docker_client = dockerapi.DockerClient()
+        if self.docker_backend == 'auto' and \
+                (docker_client.socket_path is None or
+                 not docker_client.ping()):
+            self.logger.info('Docker API not available, using docker CLI')
+            self.docker_backend = 'cli'
+            return
+        self.docker_backend = 'api'
+        self._docker_client = docker_client
+
+    def _create_build_machine(self, image=None, insecure_registry=False,
+                              line_handlers=None, event_handlers=None):
+        self._resolve_docker_backend()
+        kwargs = dict(machine_logs=self.machine_logs,
+                      image=image,
+                      insecure_registry=insecure_registry,
+                      line_handlers=line_handlers,
+                      event_handlers=event_handlers,
+                      start_gate=self.scheduler.wait_start_slot)
+        if self._docker_client is None:
+            return buildmachine.BuildMachine(docker_cli=self.docker_cli,
+                                             **kwargs)
+        # Every build machine shares the client, and so its connections.
+        return buildmachine.ApiBuildMachine(self._docker_client, **kwargs)
+
+    def _can_use_container_pool(self, build, provision_script):
+        # Only containers coming from a provisioning snapshot are equal
+        # enough to be shared. Builds using a prebuilt python modify it, and
+        # mounted sources are a bind of their own, so they get a new
+        # container.
+        return self.container_pool is not None and \
+            provision_script is not None and \
+            build.compile_python and \
+            not build.mount_source
 
-        build_dir = self._create_build_dir(build)
+    @staticmethod
+    def _get_cleanup_command(build):
+        # Removes everything a build leaves in its container, so next build
+        # using it starts from the same state.
+        project_root = build.get_project_root_from_source()
+        paths = [build.python_basedir,
+                 os.path.join(build.package_install_root, build.app),
+                 os.path.join(build.package_tmp_root, project_root)]
+        if build.working_dir:
+            paths.append(os.path.join(build.package_tmp_root,
+                                      build.working_dir))
+        if build.custom_filename:
+            paths.append(os.path.join(build.package_tmp_root,
+                                      build.custom_filename))
+        arguments = [buildmachine.shell_quote(path) for path in paths]
+        arguments.extend(['%s/*.%s' % (
+            buildmachine.shell_quote(build.package_tmp_root), extension)
+            for extension in ('deb', 'rpm')])
+        # Python sources and compile trees, of any python version.
+        arguments.append('%s/Python-*' % defaults.CONTAINER_PYTHON_SOURCE_DIR)
+        arguments.append('$HOME/.pip')
+        return 'rm -rf %s' % ' '.join(arguments)
 
-        self.logger.info('launching docker image: %s' % profile.docker_image)
+    @staticmethod
+    def _get_log_path(build_dir):
+        # Logs go to a subdirectory so they are not taken as packages.
+        log_dir = os.path.join(build_dir, defaults.BUILD_LOG_DIR)
+        if not os.path.isdir(log_dir):
+            os.mkdir(log_dir)
+        return os.path.join(log_dir, defaults.BUILD_LOG_NAME)
+
+    def run_build(self, build, result=None):
+        if result is None:
+            result = scheduler.BuildResult(build)
+
+        self._check_cancelled(build)
+        self._emit('phase_changed', build, phase='preparing')
+        profile = self._get_profile(build)
+
+        pip_cache_counter = cache.PipCacheCounter()
+        clone_recorder = buildmachine.CloneRecorder()
+        wheels_recorder = buildmachine.WheelsRecorder()
+        cache_recorder = buildmachine.CacheRecorder()
+        compile_recorder = buildmachine.CompileRecorder()
+        build_machine = self._create_build_machine(
+            profile.docker_image, profile.insecure_registry,
+            line_handlers=[pip_cache_counter, clone_recorder,
+                           wheels_recorder, cache_recorder,
+                           compile_recorder],
+            event_handlers=[
+                lambda name, **data: self._emit(name, build, **data)])
+        image_id = build_machine.get_image_id() or profile.docker_image
+
+        template_context = {}
+        template_context.update(
+            self._get_python_cache_context(build, profile, image_id, result))
+        pip_cache_dir, pip_cache_context = self._get_pip_cache_context(build)
+        template_context.update(pip_cache_context)
+        dependencies_cache_dir, dependencies_cache_context = \
+            self._get_dependencies_cache_context(build, profile, image_id)
+        template_context.update(dependencies_cache_context)
+        template_context.update(self._get_package_cache_context(profile))
+        template_context.update(self._get_wheelhouse_context(build))
+        template_context.update(self._get_git_mirror_context(build, result))
+
+        provision_script = None
+        if self.provision_snapshots:
+            provision_script = self._render_provision_script(
+                build, template_context)
+        if provision_script is not None:
+            # Build script skips provisioning section, it is run apart or
+            # it is already done in snapshot.
+            template_context['provisioned'] = True
+
+        extra_binds = cache.get_binds()
+        if 'git_mirror' in template_context:
+            extra_binds.update(gitmirror.get_binds())
+        if build.compile_python and build.ccache_dir:
+            extra_binds[cache.create_dir(build.ccache_dir)] = \
+                defaults.CONTAINER_CCACHE_DIR
+            template_context['ccache_mount_dir'] = \
+                defaults.CONTAINER_CCACHE_DIR
+        # Git directories are always exported from git instead.
+        if build.mount_source and build.source['type'] == 'directory':
+            extra_binds[os.path.abspath(build.source['path'])] = \
+                '%s:ro' % defaults.CONTAINER_SOURCE_DIR
+            template_context['source_mount_dir'] = \
+                defaults.CONTAINER_SOURCE_DIR
+            template_context['source_file_list'] = '/'.join([
+                defaults.SHARED_DIR, defaults.SCRATCH_DIR,
+                defaults.SCRATCH_SOURCE_LIST_NAME])
+
+        if self._can_use_container_pool(build, provision_script):
+            template_context['shared_dir'] = '/'.join([defaults.SHARED_DIR,
+                                                       build.dirname])
+            build_machine.enable_pool(self.container_pool,
+                                      template_context['shared_dir'],
+                                      self._get_cleanup_command(build))
+
+        build_dir = self._create_build_dir(build, template_context, result)
+        result.build_dir = build_dir
+        build_machine.log_path = self._get_log_path(build_dir)
+        result.report['log_file'] = build_machine.log_path
+
+        result_cache_key = None
+        if self.use_result_cache:
+            result_cache_key = self._get_result_cache_key(
+                build, image_id, build_dir, provision_script)
+        if result_cache_key is None:
+            result.report['result_cache'] = 'disabled'
+        elif not self.rebuild and \
+                self._restore_cached_result(result_cache_key, build_dir):
+            self.logger.info('Result cache hit: %s. Skipping build.' %
+                             result_cache_key)
+            result.report['result_cache'] = 'hit'
+            self.logger.info('*** Resulting OS packages are in: %s ***' %
+                             build_dir)
+            self._deliver_artifacts(build, build_dir, result)
+            self._reclaim_scratch_dir(build_dir)
+            return result
+        else:
+            self.logger.info('Result cache miss: %s' % result_cache_key)
+            result.report['result_cache'] = 'miss'
 
-        build_machine = buildmachine.BuildMachine(
-            machine_logs=self.machine_logs,
-            image=profile.docker_image,
-            insecure_registry=profile.insecure_registry
-        )
+        self.logger.info('launching docker image: %s' % profile.docker_image)
 
         self.logger.info('Running build machine for: %s' % build.name)
-        build_machine.launch(build_dir=build_dir)
-
-        self.logger.info('Shutting down build machine: %s' % build.name)
-        build_machine.shutdown()
+        # Keep pip cache from being pruned while this build uses it.
+        pip_cache_lock = cache.CacheLock(pip_cache_dir)
+        pip_cache_lock.acquire()
+        dependencies_cache_lock = None
+        if dependencies_cache_dir is not None:
+            dependencies_cache_lock = cache.CacheLock(dependencies_cache_dir)
+            dependencies_cache_lock.acquire()
+        with self._running_lock:
+            self._running_machines[build] = build_machine
+        try:
+            self._check_cancelled(build)
+            if provision_script is None:
+                build_machine.start(build_dir=build_dir,
+                                    extra_binds=extra_binds)
+                self._run_build_script(build_machine, build)
+            else:
+                self._write_build_script(
+                    os.path.join(build_dir, defaults.SCRATCH_DIR,
+                                 defaults.SCRATCH_PROVISIONSCRIPT_NAME),
+                    provision_script)
+                self._launch_from_snapshot(
+                    build_machine, build, build_dir, extra_binds,
+                    self._get_snapshot_image(image_id, provision_script),
+                    result)
+        except buildmachine.CommandFailedException:
+            # A cancelled build fails because its container is gone.
+            self._check_cancelled(build)
+            raise
+        finally:
+            with self._running_lock:
+                self._running_machines.pop(build, None)
+            if build_machine.container_pool is not None:
+                result.report['container_reused'] = \
+                    build_machine.container_uses > 0
+            self.logger.info('Shutting down build machine: %s' % build.name)
+            build_machine.shutdown()
+            result.report['phases'] = build_machine.phase_recorder.phases
+            if build_machine.teardown_seconds is not None:
+                result.report['teardown_seconds'] = \
+                    build_machine.teardown_seconds
+            pip_cache_lock.release()
+            if dependencies_cache_lock is not None:
+                dependencies_cache_lock.release()
+            self._report_caches(cache_recorder, result)
+            self._report_compile(compile_recorder, result)
+            self._report_pip_cache(pip_cache_counter, result)
+            self._report_clone(clone_recorder, build, result)
+            self._report_wheels(wheels_recorder, result)
+
+        if result_cache_key is not None:
+            self._store_result(result_cache_key, build_dir)
 
         self.logger.info('*** Resulting OS packages are in: %s ***' % build_dir)
+        self._deliver_artifacts(build, build_dir, result)
+        self._reclaim_scratch_dir(build_dir)
+        return result
+
+    def _deliver_artifacts(self, build, build_dir, result):
+        result.report['artifacts'] = []
+        output_folders = self.output_folders.get(build, [])
+        for package in artifacts.get_packages(build_dir):
+            entry = artifacts.deliver(package, output_folders)
+            result.report['artifacts'].append(entry)
+            self._emit('artifact_ready', build, path=package,
+                       sha256=entry['sha256'], delivered=entry['delivered'])
+
+    def _run_build_script(self, build_machine, build):
+        self._emit('phase_changed', build, phase='building')
+        build_machine.run_script(defaults.SCRATCH_BUILDSCRIPT_NAME)
+
+    def _launch_from_snapshot(self, build_machine, build, build_dir,
+                              extra_binds, snapshot_image, result):
+        if build_machine.image_exists(snapshot_image):
+            saved_seconds = build_machine.get_image_label(
+                snapshot_image, PROVISION_SECONDS_LABEL)
+            self.logger.info('Provisioning snapshot hit: %s (saves %s '
+                             'seconds)' % (snapshot_image, saved_seconds))
+            result.report['provisioning_snapshot'] = 'hit'
+            if saved_seconds is not None:
+                result.report['provisioning_saved_seconds'] = float(
+                    saved_seconds)
+            build_machine.image = snapshot_image
+            build_machine.start(build_dir=build_dir,
+                                extra_binds=extra_binds)
+            self._run_build_script(build_machine, build)
+        else:
+            self.logger.info('Provisioning snapshot miss: %s' % snapshot_image)
+            result.report['provisioning_snapshot'] = 'miss'
+            build_machine.start(build_dir=build_dir,
+                                extra_binds=extra_binds)
+            self._emit('phase_changed', build, phase='provisioning')
+            start_time = time.time()
+            build_machine.run_script(defaults.SCRATCH_PROVISIONSCRIPT_NAME)
+            provision_seconds = round(time.time() - start_time, 1)
+            result.report['provisioning_seconds'] = provision_seconds
+            build_machine.commit(
+                snapshot_image,
+                labels={PROVISION_SECONDS_LABEL: provision_seconds})
+            # Container is now just like a fresh one from snapshot, so it can
+            # be pooled with them.
+            build_machine.image = snapshot_image
+            self._run_build_script(build_machine, build)
 
     def get_available_profiles(self):
         self._load_profiles()
         return self.profiles
 
-    def build(self):
+    def prepare(self):
+        """Get everything ready to run builds added so far."""
         self._create_vdist_dir()
         self._load_profiles()
-        self._clean_build_basedir()
-        self._create_build_basedir()
 
         if len(self.builds) < 1:
             raise NoBuildsFoundException()
 
-        threads = []
+        self._create_build_basedir()
+        # Mirrors are fetched again on every run.
+        self.git_mirrors = gitmirror.GitMirrors()
 
+        # Done once, before builds run in parallel and ask for it.
+        self._resolve_docker_backend()
         for build in self.builds:
-            ## TODO: Try if there's any improvement using multiprocessing.
-            t = threading.Thread(
-                name=build.name,
-                target=self.run_build,
-                args=(build,)
-            )
-            threads.append(t)
-            t.start()
+            self._emit('queued', build)
+
+    def finish(self, results):
+        """Release resources kept among builds and log their results."""
+        self._drain_container_pool()
+        for result in results:
+            if result.build_dir is None:
+                continue
+            log_dir = os.path.join(result.build_dir, defaults.BUILD_LOG_DIR)
+            if os.path.isdir(log_dir):
+                result.save(os.path.join(log_dir, defaults.BUILD_REPORT_NAME))
+        self._release_build_basedir()
+        self._log_results(results)
 
-        for t in threads:
-            t.join()
+    def build(self):
+        self.prepare()
+        results = []
+        try:
+            results = self.scheduler.run(self.builds, self.run_build)
+        finally:
+            self.finish(results)
+        return results
+
+    def _drain_container_pool(self):
+        if self.container_pool is None:
+            return
+        build_machine = self._create_build_machine()
+        for container_id in self.container_pool.drain():
+            build_machine.remove_container(container_id)
+
+    def _log_results(self, results):
+        result_cache_states = [result.report.get('result_cache')
+                               for result in results]
+        self.logger.info('Result cache: %d hits, %d misses' %
+                         (result_cache_states.count('hit'),
+                          result_cache_states.count('miss')))
+        for result in results:
+            if result.succeeded:
+                self.logger.info('Build %s succeeded in %.1f seconds' %
+                                 (result.build.name, result.duration))
+            else:
+                self.logger.error('Build %s failed: %s' %
+                                  (result.build.name, result.error))
 
 
 class BuildProfileNotFoundException(Exception):
@@ -405,3 +1243,7 @@ class TemplateNotFoundException(Exception):
 
 class NoBuildsFoundException(Exception):
     pass
+
+
+class BuildCancelledException(Exception):
+    pass
@@ -1,17 +1,59 @@
 from __future__ import absolute_import
 
-import itertools
+import collections
+import datetime
 import logging
 import os
+import select
 import subprocess
+import sys
+import threading
+import time
 
 import vdist.defaults as defaults
+import vdist.dockerapi as dockerapi
+
+if sys.version_info[0] == 3:
+    from shlex import quote as shell_quote
+else:
+    from pipes import quote as shell_quote
+
+CliResult = collections.namedtuple('CliResult', ['returncode', 'first_line'])
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 64 * 1024
+EXEC_POLL_INTERVAL = 0.05
+# Markers printed by profile templates: "<marker> <value> <epoch seconds>".
+PHASE_MARKER = '##vdist-phase'
+EXIT_MARKER = '##vdist-exit'
+CLONE_MARKER = '##vdist-clone'
+WHEELS_MARKER = '##vdist-wheels'
+CACHE_MARKER = '##vdist-cache'
+COMPILE_MARKER = '##vdist-compile'
+
+
+def _wait_readable(fds):
+    # poll() has no limit on descriptor numbers, unlike select(), which
+    # matters when many builds run side by side. Not every platform has it.
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN | select.POLLHUP |
+                            select.POLLERR)
+        return [fd for fd, _ in poller.poll()]
+    readable, _, _ = select.select(fds, [], [])
+    return readable
+
+
+def _get_timestamp():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
 
 
 class BuildMachine(object):
 
     def __init__(self, machine_logs=True, image=None, insecure_registry=False,
-                 docker_cli='docker'):
+                 docker_cli=defaults.DOCKER_CLI, line_handlers=None,
+                 event_handlers=None, start_gate=None):
         self.logger = logging.getLogger('BuildMachine')
 
         self.machine_logs = machine_logs
@@ -23,6 +65,28 @@ class BuildMachine(object):
 
         self.insecure_registry = insecure_registry
 
+        # Callables that get every output line, to gather build statistics.
+        self.line_handlers = line_handlers or []
+        # Callables that get handler(name, **data) on container changes.
+        self.event_handlers = event_handlers or []
+        # Called before starting a new container, to stagger starts so
+        # docker daemon is not flooded with them.
+        self.start_gate = start_gate
+        self.phase_recorder = PhaseRecorder(
+            on_phase=lambda phase: self._emit('phase_changed', phase=phase))
+        self.line_handlers.append(self.phase_recorder)
+
+        # Where to keep a timestamped copy of every command output.
+        self.log_path = None
+
+        self.shared_dir = defaults.SHARED_DIR
+        self.binds = {}
+        self.container_pool = None
+        self.cleanup_command = None
+        self.container_uses = 0
+        self.container_failed = False
+        self.teardown_seconds = None
+
     def _run_cli(self, cmd):
         self.logger.info('Running command: "%s"' % cmd)
         p = subprocess.Popen(
@@ -33,24 +97,46 @@ class BuildMachine(object):
             stderr=subprocess.PIPE
         )
 
-        media = [p.stdout, p.stderr]
-        first_line = self._read_from_media(media)
+        output = _CommandOutput(self, cmd)
+        returncode = None
+        try:
+            self._read_from_media({p.stdout: 'stdout', p.stderr: 'stderr'},
+                                  output)
+            p.stdout.close()
+            p.stderr.close()
+            returncode = p.wait()
+        finally:
+            output.close(returncode)
 
-        p.stdout.close()
-        p.stderr.close()
-        p.wait()
+        if returncode != 0:
+            self.logger.debug('Command exited with code %d: "%s"' %
+                              (returncode, cmd))
+        first_line = output.first_lines.get('stdout') or \
+            output.first_lines.get('stderr')
+        return CliResult(returncode, first_line)
 
-        return first_line
+    @staticmethod
+    def _read_from_media(media, output):
+        # Both pipes are drained at once, as they get data, so a command
+        # writing a lot to one of them can not stall waiting for us to empty
+        # the other.
+        stream_names = dict((stream.fileno(), name)
+                            for stream, name in media.items())
+        open_fds = list(stream_names)
+        while open_fds:
+            for fd in _wait_readable(open_fds):
+                chunk = os.read(fd, READ_CHUNK_SIZE)
+                if not chunk:
+                    open_fds.remove(fd)
+                    continue
+                output.feed(stream_names[fd], chunk)
 
-    def _read_from_media(self, media):
-        first_line = None
-        for input_to_read in media:
-            for line in iter(input_to_read.readline, b''):
-                line = str(line.decode("UTF-8")).strip()
-                if not first_line:
-                    first_line = line
-                self.logger.info(line)
-        return first_line
+    @staticmethod
+    def _get_binds(build_dir, extra_binds=None):
+        binds = {build_dir: defaults.SHARED_DIR}
+        if extra_binds:
+            binds.update(extra_binds)
+        return binds
 
     @staticmethod
     def _binds_to_shell_volumes(binds):
@@ -60,29 +146,488 @@ class BuildMachine(object):
             vol_list = ['-v %s:%s' % (k, v) for k, v in binds.iteritems()]
         return ' '.join(vol_list)
 
-    def launch(self, build_dir, extra_binds=None):
-        binds = {build_dir: defaults.SHARED_DIR}
-        if extra_binds:
-            binds = list(itertools.chain(binds.items(), extra_binds.items()))
-        path_to_command = os.path.join(
-            defaults.SHARED_DIR,
-            defaults.SCRATCH_DIR,
-            defaults.SCRATCH_BUILDSCRIPT_NAME
-        )
+    def get_image_id(self):
+        # Image must be locally available to know its id, so pull it if
+        # it is not already there.
+        image_id = self._inspect_image(self.image, '{{.Id}}')
+        if not image_id:
+            self.logger.info('Pulling image: %s' % self.image)
+            self._run_cli('%s pull %s' % (self.docker_cli, self.image))
+            image_id = self._inspect_image(self.image, '{{.Id}}')
+        return image_id
+
+    def image_exists(self, image):
+        return self._inspect_image(image, '{{.Id}}') is not None
+
+    def get_image_label(self, image, label):
+        value = self._inspect_image(
+            image, '{{index .Config.Labels "%s"}}' % label)
+        if value == '<no value>':
+            return None
+        return value
+
+    def _inspect_image(self, image, format_string):
+        result = self._run_cli("%s inspect --type=image --format '%s' %s" %
+                               (self.docker_cli, format_string, image))
+        if result.returncode != 0:
+            return None
+        return result.first_line
+
+    def _get_script_path(self, script_name):
+        return '/'.join([self.shared_dir,
+                         defaults.SCRATCH_DIR,
+                         script_name])
+
+    def enable_pool(self, container_pool, shared_dir, cleanup_command):
+        # Pooled containers get every build dir mounted at once, so this
+        # build works at its own shared_dir below them. Cleanup command
+        # removes whatever this build leaves in container before it is
+        # handed to next build.
+        self.container_pool = container_pool
+        self.shared_dir = shared_dir
+        self.cleanup_command = cleanup_command
+
+    def _get_pool_key(self):
+        return self.image, tuple(sorted(self.binds.items()))
+
+    def start(self, build_dir, extra_binds=None):
+        if self.container_pool is None:
+            self.binds = self._get_binds(build_dir, extra_binds)
+        else:
+            self.binds = self._get_binds(os.path.dirname(build_dir),
+                                         extra_binds)
+            pooled_container = self.container_pool.checkout(
+                self._get_pool_key())
+            if pooled_container is not None:
+                self.container_id, self.container_uses = pooled_container
+                self.logger.info('Reusing pooled container: %s' %
+                                 self.container_id)
+                self._emit('container_started',
+                           container_id=self.container_id, reused=True)
+                return
+        if self.start_gate is not None:
+            self.start_gate()
         self.logger.info('Starting container: %s' % self.image)
-        self.container_id = self._run_cli(
+        self.container_id = self._start_container(self.binds)
+        self.container_uses = 0
+        self._emit('container_started', container_id=self.container_id,
+                   reused=False)
+
+    def _emit(self, name, **data):
+        for handler in self.event_handlers:
+            handler(name, **data)
+
+    def _start_container(self, binds):
+        result = self._run_cli(
             '%s run -d -ti %s %s bash' %
             (self.docker_cli,
              self._binds_to_shell_volumes(binds),
              self.image))
+        if result.returncode != 0:
+            raise CommandFailedException(
+                'container could not be started: %s' % result.first_line)
+        return result.first_line
 
-        self._run_cli(
+    def run_script(self, script_name):
+        returncode = self._exec([self._get_script_path(script_name)])
+        if returncode != 0:
+            # Whatever the script left behind is unknown, so this
+            # container must not be reused.
+            self.container_failed = True
+            raise CommandFailedException(
+                '%s exited with code %d' % (script_name, returncode))
+
+    def _exec(self, command):
+        result = self._run_cli(
             '%s exec %s %s' %
-            (self.docker_cli, self.container_id, path_to_command))
+            (self.docker_cli, self.container_id,
+             ' '.join([shell_quote(arg) for arg in command])))
+        return result.returncode
+
+    def commit(self, image, labels=None):
+        self.logger.info('Committing container %s to image: %s' %
+                         (self.container_id, image))
+        changes = ''
+        if labels:
+            changes = ' '.join(["--change 'LABEL %s=%s'" % (k, v)
+                                for k, v in sorted(labels.items())])
+        result = self._run_cli('%s commit %s %s %s' %
+                               (self.docker_cli, changes,
+                                self.container_id, image))
+        if result.returncode != 0:
+            raise CommandFailedException(
+                'container could not be committed: %s' % result.first_line)
+
+    def launch(self, build_dir, extra_binds=None):
+        self.start(build_dir, extra_binds)
+        self.run_script(defaults.SCRATCH_BUILDSCRIPT_NAME)
 
     def shutdown(self):
-        self.logger.info('Stopping container: %s' % self.container_id)
-        self._run_cli('%s stop %s' % (self.docker_cli, self.container_id))
+        if self.container_id is None:
+            return
+
+        if self.container_pool is not None and self._release_to_pool():
+            self.container_id = None
+            return
+
+        # Interactive bash running as PID 1 ignores SIGTERM, so a graceful
+        # stop would always wait for docker stop timeout before killing it.
+        # Container is thrown away anyway, so it is killed and removed at
+        # once.
+        start_time = time.time()
+        self.remove_container(self.container_id)
+        self.teardown_seconds = round(time.time() - start_time, 2)
+        self.logger.info('Container %s removed in %.2f seconds' %
+                         (self.container_id, self.teardown_seconds))
+        self.container_id = None
+
+    def _release_to_pool(self):
+        if self.container_failed:
+            self.logger.info('Recycling container after failed build: %s' %
+                             self.container_id)
+            return False
+        try:
+            cleaned = self._exec(['bash', '-c', self.cleanup_command]) == 0
+        except CommandFailedException:
+            cleaned = False
+        if not cleaned:
+            self.logger.warning('Container could not be cleaned, recycling '
+                                'it: %s' % self.container_id)
+            return False
+        return self.container_pool.checkin(self._get_pool_key(),
+                                           self.container_id,
+                                           self.container_uses + 1)
+
+    def remove_container(self, container_id):
+        self.logger.info('Removing container: %s' % container_id)
+        self._run_cli('%s rm -f %s' % (self.docker_cli, container_id))
+
+
+class ApiBuildMachine(BuildMachine):
+    """BuildMachine that talks to Docker Engine API instead of docker CLI."""
+
+    def __init__(self, docker_client, **kwargs):
+        BuildMachine.__init__(self, **kwargs)
+        self.docker_client = docker_client
+
+    def get_image_id(self):
+        image = self.docker_client.inspect_image(self.image)
+        if image is None:
+            self.logger.info('Pulling image: %s' % self.image)
+            try:
+                self.docker_client.pull_image(self.image)
+            except dockerapi.DockerApiException as e:
+                # Docker CLI may reach registries API can't, like those
+                # whose credentials are kept by credential helpers.
+                self.logger.warning('Pulling image through API failed, '
+                                    'trying docker CLI: %s' % e)
+                self._run_cli('%s pull %s' % (self.docker_cli, self.image))
+            image = self.docker_client.inspect_image(self.image)
+        if image is None:
+            return None
+        return image['Id']
+
+    def image_exists(self, image):
+        return self.docker_client.inspect_image(image) is not None
+
+    def get_image_label(self, image, label):
+        image = self.docker_client.inspect_image(image)
+        if image is None:
+            return None
+        labels = (image.get('Config') or {}).get('Labels') or {}
+        return labels.get(label)
+
+    def _start_container(self, binds):
+        try:
+            container_id = self.docker_client.create_container(
+                self.image,
+                ['%s:%s' % (k, v) for k, v in sorted(binds.items())],
+                ['bash'])
+        except dockerapi.DockerApiException as e:
+            raise CommandFailedException(
+                'container could not be created: %s' % e)
+        try:
+            self.docker_client.start_container(container_id)
+        except dockerapi.DockerApiException as e:
+            self.remove_container(container_id)
+            raise CommandFailedException(
+                'container could not be started: %s' % e)
+        return container_id
+
+    def _exec(self, command):
+        self.logger.info('Running command: "%s"' % ' '.join(command))
+        output = _CommandOutput(self, 'exec %s' % ' '.join(command))
+        returncode = None
+        try:
+            exec_id = self.docker_client.create_exec(self.container_id,
+                                                     command)
+            for stream_name, data in self.docker_client.start_exec(exec_id):
+                output.feed(stream_name, data)
+            returncode = self._wait_exec(exec_id)
+        except dockerapi.DockerApiException as e:
+            self.container_failed = True
+            raise CommandFailedException(
+                '%s could not be run: %s' % (command[0], e))
+        finally:
+            output.close(returncode)
+        return returncode
+
+    def _wait_exec(self, exec_id):
+        # Output stream can end a bit before daemon notices the process is
+        # gone, exit code is only there after that.
+        exec_info = self.docker_client.inspect_exec(exec_id)
+        while exec_info['Running']:
+            time.sleep(EXEC_POLL_INTERVAL)
+            exec_info = self.docker_client.inspect_exec(exec_id)
+        return exec_info['ExitCode']
+
+    def commit(self, image, labels=None):
+        self.logger.info('Committing container %s to image: %s' %
+                         (self.container_id, image))
+        try:
+            self.docker_client.commit_container(self.container_id, image,
+                                                labels)
+        except dockerapi.DockerApiException as e:
+            raise CommandFailedException(
+                'container could not be committed: %s' % e)
+
+    def remove_container(self, container_id):
+        self.logger.info('Removing container: %s' % container_id)
+        try:
+            self.docker_client.remove_container(container_id)
+        except dockerapi.DockerApiException as e:
+            self.logger.warning('Container %s could not be removed: %s' %
+                                (container_id, e))
+
+
+class PhaseRecorder(object):
+    """Times build phases from markers in the output of profile scripts.
+
+    Each phase lasts until next one starts, or until the script exits, which
+    also gives the exit status of its last phase.
+    """
+
+    def __init__(self, on_phase=None):
+        self.phases = []
+        self.on_phase = on_phase
+
+    def __call__(self, line):
+        if not line.startswith('##vdist-'):
+            return
+        fields = line.split()
+        if len(fields) != 3:
+            return
+        marker, value, timestamp = fields
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            return
+        if marker == PHASE_MARKER:
+            self._end_phase(timestamp, 0)
+            self.phases.append({'name': value,
+                                'start': timestamp,
+                                'duration': None,
+                                'exit_status': None})
+            if self.on_phase is not None:
+                self.on_phase(value)
+        elif marker == EXIT_MARKER:
+            try:
+                self._end_phase(timestamp, int(value))
+            except ValueError:
+                return
+
+    def _end_phase(self, timestamp, exit_status):
+        if self.phases and self.phases[-1]['duration'] is None:
+            phase = self.phases[-1]
+            phase['duration'] = round(timestamp - phase['start'], 3)
+            phase['exit_status'] = exit_status
+
+
+class CloneRecorder(object):
+    """Gets size and duration of git clones from markers printed by profile
+    scripts as '##vdist-clone <bytes> <start time> <end time>'."""
+
+    def __init__(self):
+        self.clone = None
+
+    def __call__(self, line):
+        if not line.startswith(CLONE_MARKER):
+            return
+        fields = line.split()
+        if len(fields) != 4 or fields[0] != CLONE_MARKER:
+            return
+        try:
+            self.clone = {'bytes': int(fields[1]),
+                          'seconds': round(float(fields[3]) -
+                                           float(fields[2]), 3)}
+        except ValueError:
+            return
+
+
+class WheelsRecorder(object):
+    """Gets how many dependency wheels were built and how many reused from
+    markers printed by profile scripts as '##vdist-wheels <built> <reused>'.
+    """
+
+    def __init__(self):
+        self.wheels = None
+
+    def __call__(self, line):
+        if not line.startswith(WHEELS_MARKER):
+            return
+        fields = line.split()
+        if len(fields) != 3 or fields[0] != WHEELS_MARKER:
+            return
+        try:
+            self.wheels = {'built': int(fields[1]),
+                           'reused': int(fields[2])}
+        except ValueError:
+            return
+
+
+class CacheRecorder(object):
+    """Gets status of caches only known inside containers from markers
+    printed by profile scripts as '##vdist-cache <name> <hit|miss>'."""
+
+    def __init__(self):
+        # Named like report entries, e.g. 'dependencies_cache'.
+        self.caches = {}
+
+    def __call__(self, line):
+        if not line.startswith(CACHE_MARKER):
+            return
+        fields = line.split()
+        if len(fields) != 3 or fields[0] != CACHE_MARKER or \
+                fields[2] not in ('hit', 'miss'):
+            return
+        self.caches['%s_cache' % fields[1]] = fields[2]
+
+
+class CompileRecorder(object):
+    """Gets jobs, duration and ccache hits and misses of python compilations
+    from markers printed by profile scripts as
+    '##vdist-compile <jobs> <start time> <end time> [<hits> <misses>]'."""
+
+    def __init__(self):
+        self.compile = None
+
+    def __call__(self, line):
+        if not line.startswith(COMPILE_MARKER):
+            return
+        fields = line.split()
+        if len(fields) not in (4, 6) or fields[0] != COMPILE_MARKER:
+            return
+        try:
+            compile_ = {'jobs': int(fields[1]),
+                        'seconds': round(float(fields[3]) -
+                                         float(fields[2]), 3),
+                        'ccache_hits': None,
+                        'ccache_misses': None,
+                        'ccache_hit_ratio': None}
+            if len(fields) == 6:
+                compile_['ccache_hits'] = int(fields[4])
+                compile_['ccache_misses'] = int(fields[5])
+        except ValueError:
+            return
+        calls = (compile_['ccache_hits'] or 0) + \
+            (compile_['ccache_misses'] or 0)
+        if calls:
+            compile_['ccache_hit_ratio'] = \
+                float(compile_['ccache_hits']) / calls
+        self.compile = compile_
+
+
+class ContainerPool(object):
+    """Started containers kept to be reused by later builds.
+
+    Containers are pooled by image and binds, up to size idle containers for
+    each, and are recycled once they have run max_uses builds.
+    """
+
+    def __init__(self, size=defaults.CONTAINER_POOL_SIZE,
+                 max_uses=defaults.CONTAINER_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def checkout(self, key):
+        with self._lock:
+            containers = self._idle.get(key)
+            if not containers:
+                return None
+            return containers.pop()
+
+    def checkin(self, key, container_id, uses):
+        if uses >= self.max_uses:
+            return False
+        with self._lock:
+            containers = self._idle.setdefault(key, [])
+            if len(containers) >= self.size:
+                return False
+            containers.append((container_id, uses))
+            return True
+
+    def drain(self):
+        with self._lock:
+            container_ids = [container_id
+                             for containers in self._idle.values()
+                             for container_id, _ in containers]
+            self._idle = {}
+        return container_ids
+
+
+class _CommandOutput(object):
+    # Splits output of a command in lines and hands them to logger, build log
+    # file and line handlers. Memory use is bounded: only what is read from
+    # a stream until its last newline is kept, up to MAX_LINE_LENGTH.
+
+    def __init__(self, build_machine, command):
+        self.build_machine = build_machine
+        self.first_lines = {}
+        self._partial_lines = {}
+        self._log_file = None
+        if build_machine.log_path is not None:
+            self._log_file = open(build_machine.log_path, 'a')
+        self._write_log_line(_get_timestamp(), 'command', command)
+
+    def feed(self, stream_name, data):
+        # Every line in a chunk arrived at once, so they share timestamp.
+        timestamp = _get_timestamp()
+        lines = (self._partial_lines.get(stream_name, b'') + data).split(b'\n')
+        partial_line = lines.pop()
+        while len(partial_line) >= MAX_LINE_LENGTH:
+            lines.append(partial_line[:MAX_LINE_LENGTH])
+            partial_line = partial_line[MAX_LINE_LENGTH:]
+        self._partial_lines[stream_name] = partial_line
+        for line in lines:
+            self._handle_line(timestamp, stream_name, line)
+
+    def close(self, returncode):
+        timestamp = _get_timestamp()
+        for stream_name, partial_line in sorted(self._partial_lines.items()):
+            if partial_line:
+                self._handle_line(timestamp, stream_name, partial_line)
+        self._partial_lines = {}
+        if returncode is not None:
+            self._write_log_line(timestamp, 'exit', str(returncode))
+        if self._log_file is not None:
+            self._log_file.close()
+
+    def _handle_line(self, timestamp, stream_name, line):
+        line = line.decode("UTF-8", "replace").strip()
+        if stream_name not in self.first_lines and line:
+            self.first_lines[stream_name] = line
+        self.build_machine.logger.info(line)
+        self._write_log_line(timestamp, stream_name, line)
+        for handler in self.build_machine.line_handlers:
+            handler(line)
+
+    def _write_log_line(self, timestamp, stream_name, line):
+        if self._log_file is None:
+            return
+        self._log_file.write('%s %s %s\n' % (timestamp, stream_name, line))
+
 
-        self.logger.info('Removing container: %s' % self.container_id)
-        self._run_cli('%s rm -f %s' % (self.docker_cli, self.container_id))
+class CommandFailedException(Exception):
+    pass
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+
+import vdist.defaults as defaults
+
+
+def make_key(*values):
+    """Return a stable hash of given values to be used as a cache key."""
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(str(value).encode("UTF-8"))
+        # Separator to avoid ("ab", "c") and ("a", "bc") giving same key.
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_host_path(*parts):
+    """Path of a cache entry at host side."""
+    return os.path.join(defaults.CACHE_DIR, *parts)
+
+
+def get_container_path(*parts):
+    """Path of a cache entry inside build containers."""
+    return "/".join((defaults.CONTAINER_CACHE_DIR, ) + parts)
+
+
+def get_binds():
+    """Binds needed to make host cache available inside build containers.
+
+    Only cache folders written by builds are mounted.
+    """
+    # Create them beforehand or docker would create them owned by root.
+    return {create_dir(get_host_path(subdir)): get_container_path(subdir)
+            for subdir in defaults.CONTAINER_CACHE_SUBDIRS}
+
+
+def create_dir(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another build may have created it meanwhile.
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+class CacheLock(object):
+    """Advisory lock over a cache folder, shared among processes and threads.
+
+    Builds using a cache hold a shared lock while their container runs, so
+    maintenance tasks (like pruning) can take an exclusive one only when
+    nobody else is using that cache.
+    """
+
+    def __init__(self, cache_dir):
+        self.lock_path = os.path.join(create_dir(cache_dir),
+                                      defaults.CACHE_LOCK_FILE)
+        self._lock_file = None
+
+    def acquire(self, shared=True, blocking=True):
+        lock_file = open(self.lock_path, 'a')
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), operation)
+        except (IOError, OSError):
+            lock_file.close()
+            if blocking:
+                raise
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def _get_cached_files(cache_dir):
+    cached_files = []
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename == defaults.CACHE_LOCK_FILE:
+                continue
+            file_pathname = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(file_pathname)
+            except OSError:
+                continue
+            last_use = max(stat.st_atime, stat.st_mtime)
+            cached_files.append((last_use, stat.st_size, file_pathname))
+    return cached_files
+
+
+def prune(cache_dir, max_size):
+    """Remove least recently used files until cache_dir fits in max_size.
+
+    Pruning is skipped if any build is using the cache at that moment.
+    Returns freed bytes.
+    """
+    logger = logging.getLogger('Cache')
+    lock = CacheLock(cache_dir)
+    if not lock.acquire(shared=False, blocking=False):
+        return 0
+    freed = 0
+    try:
+        cached_files = sorted(_get_cached_files(cache_dir))
+        size = sum(file_size for _, file_size, _ in cached_files)
+        for _, file_size, file_pathname in cached_files:
+            if size <= max_size:
+                break
+            try:
+                os.remove(file_pathname)
+            except OSError:
+                # Probably a file left by a container, owned by root.
+                continue
+            size -= file_size
+            freed += file_size
+    finally:
+        lock.release()
+    if freed:
+        logger.info('Pruned %d bytes from %s' % (freed, cache_dir))
+    return freed
+
+
+class PipCacheCounter(object):
+    """Counts pip downloads served from cache in a build output."""
+
+    _HIT = re.compile(r'^\s*Using cached ')
+    _MISS = re.compile(r'^\s*Downloading ')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, line):
+        if self._HIT.match(line):
+            self.hits += 1
+        elif self._MISS.match(line):
+            self.misses += 1
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return None
+        return float(self.hits) / total
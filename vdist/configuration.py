@@ -14,10 +14,10 @@ LISTABLE_ARGUMENTS = {"source_git", "source_git_directory", "runtime_deps",
                       "build_deps"}
 LONG_TEXT_ARGUMENTS = {"fpm_args", "pip_args"}
 PROCESSABLE_ARGUMENTS = {"output_folder", "source_directory", "compile_python",
-                         "fpm_args"}
+                         "fpm_args", "mount_source"}
 SCRIPTS_ARGUMENTS = {"after_install", "before_install", "after_remove",
                      "before_remove", "after_upgrade", "before_upgrade"}
-USELESS_ARGUMENTS = {"mode"}
+USELESS_ARGUMENTS = {"mode", "jobs", "no_cache", "rebuild"}
 PROCESSABLE_ARGUMENTS |= LISTABLE_ARGUMENTS
 PROCESSABLE_ARGUMENTS |= LONG_TEXT_ARGUMENTS
 
@@ -33,6 +33,7 @@ class Configuration(object):
         self._process_long_text_arguments(arguments)
         self._process_source_directory_argument(arguments)
         self._process_compile_python_argument(arguments)
+        self._process_mount_source_argument(arguments)
 
     def _process_source_directory_argument(self, arguments):
         if "source_directory" in arguments.keys():
@@ -45,15 +46,20 @@ class Configuration(object):
             self.builder_parameters["compile_python"] = bool(
                 arguments["compile_python"])
 
+    def _process_mount_source_argument(self, arguments):
+        if "mount_source" in arguments.keys():
+            self.builder_parameters["mount_source"] = _is_true(
+                arguments["mount_source"])
+
     def _process_listable_arguments(self, arguments):
         argument_keys = set(arguments.keys())
         listable_arguments_found = LISTABLE_ARGUMENTS.intersection(argument_keys)
         for argument in listable_arguments_found:
             generated_list = _create_list(arguments[argument])
             if argument == "source_git":
+                # Optional depth and sparse path may follow branch.
                 self.builder_parameters["source"] = source.git(
-                    generated_list[0],
-                    generated_list[1])
+                    *generated_list[:4])
             if argument == "source_git_directory":
                 self.builder_parameters["source"] = source.git_directory(
                     generated_list[0],
@@ -75,6 +81,12 @@ def _create_list(_list):
                                                   for element in _list.split(",")]
 
 
+def _is_true(value):
+    if isinstance(value, bool):
+        return value
+    return value.strip().lower() in ("true", "yes", "on", "1")
+
+
 def _remove_cr(text):
     # Removes carriage returns from given text.
     # Great reference:
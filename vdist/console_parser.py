@@ -10,6 +10,17 @@ def _check_is_file(_string):
                                          "not exists.".format(_string))
 
 
+def _check_is_positive(_string):
+    try:
+        value = int(_string)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("{0} is not a positive "
+                                         "number.".format(_string))
+    return value
+
+
 def parse_arguments(args=None):
     arg_parser = argparse.ArgumentParser(description="A tool that lets you "
                                                      "create OS packages from "
@@ -35,6 +46,29 @@ def parse_arguments(args=None):
                                      default=None,
                                      type=_check_is_file,
                                      metavar="CONFIGURATION FILENAME")
+    automatic_subparser.add_argument("-j", "--jobs",
+                                     required=False,
+                                     type=_check_is_positive,
+                                     help="Maximum number of builds running "
+                                          "at the same time. (Defaults to "
+                                          "all of them)",
+                                     metavar="JOBS")
+    automatic_subparser.add_argument("--no-cache",
+                                     required=False,
+                                     dest="no_cache",
+                                     help="Don't reuse packages from "
+                                          "previous identical builds nor "
+                                          "store new ones.",
+                                     action="store_const",
+                                     const=True)
+    automatic_subparser.add_argument("--rebuild",
+                                     required=False,
+                                     help="Build every package again even "
+                                          "if an identical one was built "
+                                          "before. Results are still "
+                                          "cached.",
+                                     action="store_const",
+                                     const=True)
     manual_subparser = subparsers.add_parser("manual",
                                              help="Manual configuration. "
                                                   "Parameters are going to be "
@@ -122,10 +156,29 @@ def parse_arguments(args=None):
                                   action="store_const",
                                   const="True",
                                   default="False")
+    manual_subparser.add_argument("-m", "--mount_source",
+                                  required=False,
+                                  help="Mount local source folder read only "
+                                       "into build container instead of "
+                                       "copying it.",
+                                  action="store_const",
+                                  const="True")
     manual_subparser.add_argument("-V", "--python_version",
                                   required=False,
                                   help="Python version to package.",
                                   metavar="PYTHON_VERSION")
+    manual_subparser.add_argument("--compile_jobs",
+                                  required=False,
+                                  help="Parallel jobs used to compile "
+                                       "Python. (Defaults to CPUs available "
+                                       "to build container)",
+                                  metavar="COMPILE_JOBS")
+    manual_subparser.add_argument("--ccache_dir",
+                                  required=False,
+                                  help="Host folder where ccache keeps "
+                                       "objects compiled for Python, to be "
+                                       "reused by next compilations.",
+                                  metavar="CCACHE_DIR")
     manual_subparser.add_argument("-t", "--requirements_path",
                                   required=False,
                                   help="Path to your pip requirements file, "
@@ -7,10 +7,83 @@ LOCAL_PROFILES_DIR = 'buildprofiles'
 LOCAL_PROFILES_FILE = 'profiles.json'
 VDIST_USERDIR = os.path.join(os.path.expanduser('~'), '.vdist')
 BUILD_BASEDIR = os.path.join(VDIST_USERDIR, 'dist')
+# Prefixes of folders under BUILD_BASEDIR for each vdist run, for runs being
+# created and for stale runs being deleted.
+BUILD_RUN_PREFIX = 'run-'
+BUILD_NEW_RUN_PREFIX = '.new-'
+BUILD_TRASH_PREFIX = '.trash-'
+CACHE_DIR = os.path.join(VDIST_USERDIR, 'cache')
+CONTAINER_CACHE_DIR = '/vdist/cache'
+CONTAINER_SOURCE_DIR = '/vdist/source'
+CONTAINER_GIT_DIR = '/vdist/git'
+CONTAINER_CCACHE_DIR = '/vdist/ccache'
+# Where profile templates download and compile python, inside containers.
+CONTAINER_PYTHON_SOURCE_DIR = '/var/tmp'
+SCRATCH_SOURCE_LIST_NAME = 'source_files.list'
+PYTHON_CACHE_SUBDIR = 'python'
+PYTHON_CACHE_FILE = 'python.tar.gz'
+CONFIGURE_CACHE_SUBDIR = 'configure'
+CONFIGURE_CACHE_FILE = 'config.cache'
+SNAPSHOT_REPOSITORY = 'vdist-provisioned'
+CACHE_LOCK_FILE = '.vdist.lock'
+PIP_CACHE_SUBDIR = 'pip'
+# Pip cache size cap per profile and python version, in bytes.
+PIP_CACHE_MAX_SIZE = 2 * 1024 ** 3
+# Dependency wheels shared by builds with same python ABI, whatever their
+# profile.
+WHEELHOUSE_SUBDIR = 'wheels'
+DEPENDENCIES_CACHE_SUBDIR = 'dependencies'
+# Cap for all python environments kept with dependencies installed, in bytes.
+DEPENDENCIES_CACHE_MAX_SIZE = 4 * 1024 ** 3
+PACKAGE_CACHE_SUBDIR = 'packages'
+FINGERPRINT_CACHE_SUBDIR = 'fingerprints'
+RESULT_CACHE_SUBDIR = 'results'
+SOURCE_CACHE_SUBDIR = 'sources'
+GIT_CACHE_SUBDIR = 'git'
+# Only these cache folders are mounted into build containers. The rest (like
+# results, sources or fingerprints) are only used by vdist at host side, so
+# code run by builds can't tamper with them.
+CONTAINER_CACHE_SUBDIRS = (PYTHON_CACHE_SUBDIR, CONFIGURE_CACHE_SUBDIR,
+                           PIP_CACHE_SUBDIR, WHEELHOUSE_SUBDIR,
+                           DEPENDENCIES_CACHE_SUBDIR, PACKAGE_CACHE_SUBDIR)
+# Compiled profile templates are loaded and run by vdist, so they are kept
+# out of CACHE_DIR.
+TEMPLATE_CACHE_DIR = os.path.join(VDIST_USERDIR, 'jinja')
+# File at source root with patterns, in gitignore format, of files that
+# should not be copied to builds.
+IGNORE_FILE = '.vdistignore'
+# Minutes OS package lists are reused before being refreshed again.
+PACKAGE_LISTS_TTL = 60
 SCRATCH_BUILDSCRIPT_NAME = 'buildscript.sh'
+SCRATCH_PROVISIONSCRIPT_NAME = 'provision.sh'
+# Templates list every package they generate in this scratch file.
+SCRATCH_MANIFEST_NAME = 'packages.list'
+BUILD_LOG_DIR = 'logs'
+BUILD_LOG_NAME = 'machine.log'
+BUILD_REPORT_NAME = 'report.json'
 SCRATCH_DIR = 'scratch'
 SHARED_DIR = '/work'
 PACKAGE_INSTALL_ROOT = PYTHON_BASEDIR
 PACKAGE_TMP_ROOT = '/tmp'
 
 PYTHON3_INTERPRETER = True if sys.version_info[0] == 3 else False
+
+# Maximum number of builds running at the same time. None means one worker
+# per build.
+MAX_JOBS = None
+# Seconds to wait between consecutive container starts so docker daemon is
+# not flooded with container creations.
+BUILD_START_DELAY = 1
+
+# Docker backend: 'api' talks to Docker Engine API socket, 'cli' runs docker
+# command and 'auto' uses API when its socket is available.
+DOCKER_BACKEND = 'auto'
+DOCKER_CLI = 'docker'
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_POOL_SIZE = 4
+
+# Idle containers kept per image to be reused by next builds (0 disables
+# container pool) and number of builds a pooled container runs before being
+# replaced by a new one.
+CONTAINER_POOL_SIZE = 0
+CONTAINER_MAX_USES = 10
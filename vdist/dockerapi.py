@@ -0,0 +1,314 @@
+from __future__ import absolute_import
+
+import base64
+import json
+import os
+import socket
+import struct
+import sys
+
+import vdist.defaults as defaults
+
+if sys.version_info[0] == 3:
+    import http.client as httplib
+    import queue
+    from urllib.parse import quote, urlencode
+else:
+    import httplib
+    import Queue as queue
+    from urllib import quote, urlencode
+
+# Exec output comes multiplexed in frames with an 8 bytes header: stream
+# type, 3 padding bytes and payload length.
+FRAME_HEADER = struct.Struct('>BxxxL')
+STREAM_NAMES = {1: 'stdout', 2: 'stderr'}
+# Names Docker Hub goes by in docker config files.
+DOCKER_HUB_HOSTS = ('index.docker.io', 'docker.io', 'registry-1.docker.io')
+
+
+def get_socket_path():
+    # Honor DOCKER_HOST as docker CLI does. Only Unix sockets are supported,
+    # so any other kind of host means we can not use this client.
+    docker_host = os.environ.get('DOCKER_HOST')
+    if not docker_host:
+        return defaults.DOCKER_SOCKET
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return None
+
+
+def split_image_name(image):
+    # Registry hosts can have a port, so only a colon after last slash
+    # separates a tag.
+    repository, _, tag = image.rpartition(':')
+    if not repository or '/' in tag:
+        return image, 'latest'
+    return repository, tag
+
+
+def get_registry(repository):
+    # As docker does, first component of repository is a registry only if
+    # it looks like a host, otherwise image comes from Docker Hub.
+    first, _, rest = repository.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        return first
+    return DOCKER_HUB_HOSTS[0]
+
+
+def _get_host(address):
+    # Docker config keys can be either hosts or URLs.
+    host = address.split('://', 1)[-1].split('/', 1)[0]
+    if host in DOCKER_HUB_HOSTS:
+        return DOCKER_HUB_HOSTS[0]
+    return host
+
+
+def get_config_path():
+    config_dir = os.environ.get('DOCKER_CONFIG',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.docker'))
+    return os.path.join(config_dir, 'config.json')
+
+
+def get_registry_auth(registry, config_path=None):
+    """X-Registry-Auth header value with credentials for registry stored by
+    docker login in docker config, or None if there are none.
+
+    Credentials kept by credential helpers are not supported.
+    """
+    try:
+        with open(config_path or get_config_path()) as f:
+            auths = json.load(f).get('auths') or {}
+    except (IOError, OSError, ValueError):
+        return None
+    registry = _get_host(registry)
+    for address, entry in sorted(auths.items()):
+        if _get_host(address) != registry:
+            continue
+        if entry.get('identitytoken'):
+            auth = {'identitytoken': entry['identitytoken'],
+                    'serveraddress': address}
+        elif entry.get('auth'):
+            username, _, password = base64.b64decode(
+                entry['auth']).decode('UTF-8').partition(':')
+            auth = {'username': username, 'password': password,
+                    'serveraddress': address}
+        else:
+            continue
+        return base64.urlsafe_b64encode(
+            json.dumps(auth).encode('UTF-8')).decode('ascii')
+    return None
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ConnectionPool(object):
+
+    def __init__(self, socket_path, max_size=defaults.DOCKER_POOL_SIZE):
+        self.socket_path = socket_path
+        self._idle = queue.LifoQueue(max_size)
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path)
+
+    def put(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class DockerClient(object):
+
+    def __init__(self, socket_path=None, pool_size=defaults.DOCKER_POOL_SIZE):
+        self.socket_path = socket_path or get_socket_path()
+        self.pool = ConnectionPool(self.socket_path, pool_size)
+
+    def _open(self, method, path, params=None, body=None, headers=None):
+        url = quote(path, safe='/:')
+        if params:
+            url += '?' + urlencode(params)
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('UTF-8')
+            headers['Content-Type'] = 'application/json'
+        while True:
+            connection = self.pool.get()
+            # Docker daemon may have closed an idle connection meanwhile,
+            # in that case just try again with a new one.
+            reused = connection.sock is not None
+            try:
+                connection.request(method, url, data, headers)
+                return connection, connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+
+    def _request(self, method, path, params=None, body=None):
+        connection, response = self._open(method, path, params, body)
+        data = response.read()
+        if response.will_close:
+            connection.close()
+        self.pool.put(connection)
+        if response.status >= 400:
+            raise DockerApiException(response.status,
+                                     '%s %s: %s' % (method, path,
+                                                    _get_message(data)))
+        return data
+
+    def _request_json(self, method, path, params=None, body=None):
+        data = self._request(method, path, params, body)
+        if not data:
+            return None
+        return json.loads(data.decode('UTF-8'))
+
+    def ping(self):
+        try:
+            return self._request('GET', '/_ping') == b'OK'
+        except (DockerApiException, httplib.HTTPException, socket.error):
+            return False
+
+    def inspect_image(self, image):
+        try:
+            return self._request_json('GET', '/images/%s/json' % image)
+        except DockerApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def pull_image(self, image):
+        repository, tag = split_image_name(image)
+        # Daemon knows nothing about docker CLI logins, so credentials are
+        # sent along.
+        headers = {}
+        registry_auth = get_registry_auth(get_registry(repository))
+        if registry_auth is not None:
+            headers['X-Registry-Auth'] = registry_auth
+        connection, response = self._open(
+            'POST', '/images/create',
+            params=[('fromImage', repository), ('tag', tag)],
+            headers=headers)
+        try:
+            if response.status >= 400:
+                raise DockerApiException(
+                    response.status, 'pull %s: %s' %
+                    (image, _get_message(response.read())))
+            # Pull progress comes as a stream of JSON objects, an error
+            # can be reported in any of them.
+            for line in iter(response.readline, b''):
+                progress = json.loads(line.decode('UTF-8'))
+                if 'error' in progress:
+                    raise DockerApiException(
+                        response.status, 'pull %s: %s' %
+                        (image, progress['error']))
+        finally:
+            connection.close()
+
+    def create_container(self, image, binds, command):
+        container = self._request_json(
+            'POST', '/containers/create',
+            body={'Image': image,
+                  'Cmd': command,
+                  'Tty': True,
+                  'OpenStdin': True,
+                  'HostConfig': {'Binds': binds}})
+        return container['Id']
+
+    def start_container(self, container_id):
+        self._request('POST', '/containers/%s/start' % container_id)
+
+    def remove_container(self, container_id, force=True):
+        self._request('DELETE', '/containers/%s' % container_id,
+                      params=[('force', int(force))])
+
+    def commit_container(self, container_id, image, labels=None):
+        repository, tag = split_image_name(image)
+        params = [('container', container_id),
+                  ('repo', repository),
+                  ('tag', tag)]
+        if labels:
+            params.extend([('changes', 'LABEL %s=%s' % (k, v))
+                           for k, v in sorted(labels.items())])
+        return self._request_json('POST', '/commit', params=params)['Id']
+
+    def create_exec(self, container_id, command):
+        exec_instance = self._request_json(
+            'POST', '/containers/%s/exec' % container_id,
+            body={'AttachStdout': True,
+                  'AttachStderr': True,
+                  'Cmd': command})
+        return exec_instance['Id']
+
+    def start_exec(self, exec_id):
+        # Yields (stream name, data) tuples as command writes them.
+        connection, response = self._open(
+            'POST', '/exec/%s/start' % exec_id,
+            body={'Detach': False, 'Tty': False})
+        try:
+            if response.status >= 400:
+                raise DockerApiException(
+                    response.status, 'exec %s: %s' %
+                    (exec_id, _get_message(response.read())))
+            while True:
+                header = _read_exactly(response, FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                stream_type, length = FRAME_HEADER.unpack(header)
+                yield (STREAM_NAMES.get(stream_type, 'stdout'),
+                       _read_exactly(response, length))
+        finally:
+            # Raw streams end when daemon closes connection, so it can not
+            # go back to the pool.
+            connection.close()
+
+    def inspect_exec(self, exec_id):
+        return self._request_json('GET', '/exec/%s/json' % exec_id)
+
+    def close(self):
+        self.pool.close()
+
+
+def _read_exactly(response, length):
+    data = b''
+    while len(data) < length:
+        chunk = response.read(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _get_message(data):
+    try:
+        return json.loads(data.decode('UTF-8'))['message']
+    except (ValueError, KeyError, TypeError):
+        return data.decode('UTF-8', 'replace').strip()
+
+
+class DockerApiException(Exception):
+
+    def __init__(self, status, message):
+        super(DockerApiException, self).__init__(message)
+        self.status = status
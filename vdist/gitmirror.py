@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import vdist.cache as cache
+import vdist.defaults as defaults
+
+MIRROR_DIRNAME = 'mirror.git'
+
+
+def get_key(uri):
+    return cache.make_key(uri)
+
+
+def get_host_path(uri):
+    return os.path.join(cache.get_host_path(defaults.GIT_CACHE_SUBDIR,
+                                            get_key(uri)),
+                        MIRROR_DIRNAME)
+
+
+def get_container_path(uri):
+    return '/'.join([defaults.CONTAINER_GIT_DIR, get_key(uri),
+                     MIRROR_DIRNAME])
+
+
+def get_binds():
+    """Bind to make mirrors available, read only, inside build containers."""
+    git_dir = cache.create_dir(cache.get_host_path(defaults.GIT_CACHE_SUBDIR))
+    return {git_dir: '%s:ro' % defaults.CONTAINER_GIT_DIR}
+
+
+def _run_git(args):
+    # Never wait for credentials nobody is going to type.
+    environment = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    try:
+        subprocess.check_output(['git'] + args, stderr=subprocess.STDOUT,
+                                env=environment)
+    except subprocess.CalledProcessError as e:
+        raise GitMirrorException('git %s failed: %s' %
+                                 (' '.join(args),
+                                  e.output.decode('UTF-8', 'replace').strip()))
+    except OSError as e:
+        raise GitMirrorException('git could not be run: %s' % e)
+
+
+class GitMirrors(object):
+    """Bare mirrors of remote git sources, kept in host cache.
+
+    A mirror is brought up to date at most once per vdist run, however many
+    builds use it: cloned the first time and incrementally fetched later on.
+    Builds clone from it sharing its objects, so they download nothing.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('GitMirrors')
+        self._states = {}
+        self._lock = threading.Lock()
+        self._uri_locks = {}
+
+    def update(self, uri):
+        """Get mirror of uri up to date, unless already done in this run.
+
+        Returns 'cloned', 'fetched' or 'reused' (already updated in this
+        run), or None if mirror could not be updated.
+        """
+        with self._lock:
+            uri_lock = self._uri_locks.setdefault(uri, threading.Lock())
+        with uri_lock:
+            if uri in self._states:
+                # Already done, unless it failed.
+                return 'reused' if self._states[uri] else None
+            state = self._update(uri)
+            self._states[uri] = state
+            return state
+
+    def _update(self, uri):
+        mirror_dir = get_host_path(uri)
+        mirror_root = os.path.dirname(mirror_dir)
+        # Other vdist processes may be updating this mirror too.
+        mirror_lock = cache.CacheLock(mirror_root)
+        mirror_lock.acquire(shared=False)
+        start_time = time.time()
+        try:
+            if os.path.isdir(mirror_dir):
+                # Objects are only added, so builds of other runs cloning
+                # from this mirror at the same time are not disturbed.
+                _run_git(['--git-dir', mirror_dir, 'fetch', '--prune',
+                          '--quiet', 'origin'])
+                state = 'fetched'
+            else:
+                self._clone(uri, mirror_dir)
+                state = 'cloned'
+        except GitMirrorException as e:
+            self.logger.warning('Git mirror of %s not available, builds will '
+                                'clone it themselves: %s' % (uri, e))
+            return None
+        finally:
+            mirror_lock.release()
+        self.logger.info('Git mirror of %s %s in %.1f seconds' %
+                         (uri, state, time.time() - start_time))
+        return state
+
+    @staticmethod
+    def _clone(uri, mirror_dir):
+        # Cloned aside and renamed at the end, so an interrupted clone is
+        # never taken as a mirror.
+        temporary_dir = tempfile.mkdtemp(dir=os.path.dirname(mirror_dir))
+        try:
+            temporary_mirror_dir = os.path.join(temporary_dir, MIRROR_DIRNAME)
+            _run_git(['clone', '--mirror', '--quiet', uri,
+                      temporary_mirror_dir])
+            # Garbage collection could remove objects that clones sharing
+            # them still use.
+            _run_git(['--git-dir', temporary_mirror_dir, 'config',
+                      'gc.auto', '0'])
+            os.rename(temporary_mirror_dir, mirror_dir)
+        finally:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+class GitMirrorException(Exception):
+    pass
@@ -5,9 +5,56 @@ PYTHON_BASEDIR="{{python_basedir}}"
 # Fail on error.
 set -e
 
-# Install general prerequisites.
-apt-get update
-apt-get install ruby-dev build-essential git python-virtualenv curl libssl-dev libsqlite3-dev libgdbm-dev libreadline-dev libbz2-dev libncurses5-dev tk-dev python3 python3-pip -y
+{% block setup %}
+# Print phase markers, vdist reads them to time every step of the build.
+vdist_phase() {
+    echo "##vdist-phase $1 $(date +%s.%N)"
+}
+# Host folders this script writes to. They are given back to local user on
+# every exit, failed builds included, so they can be pruned or removed
+# without root.
+VDIST_HOST_DIRS=({% if package_cache_dir %}{{package_cache_dir}}{% endif %})
+vdist_exit() {
+    local exit_status=$1
+    if [ -n "${VDIST_HOST_DIRS[*]}" ]; then
+        chown -R {{local_uid}}:{{local_gid}} "${VDIST_HOST_DIRS[@]}" || true
+    fi
+    echo "##vdist-exit $exit_status $(date +%s.%N)"
+}
+trap 'vdist_exit $?' EXIT
+vdist_phase setup
+
+{% if package_cache_dir %}
+# Keep downloaded packages and package lists in a host cache shared by every
+# build of this image. Apt calls are serialized through a lock so concurrent
+# builds don't corrupt that cache.
+PACKAGE_CACHE_DIR="{{package_cache_dir}}"
+mkdir -p $PACKAGE_CACHE_DIR/archives/partial $PACKAGE_CACHE_DIR/lists/partial
+rm -f /etc/apt/apt.conf.d/docker-clean
+echo "Dir::Cache::Archives \"$PACKAGE_CACHE_DIR/archives/\";" > /etc/apt/apt.conf.d/90vdist-cache
+echo "Dir::State::Lists \"$PACKAGE_CACHE_DIR/lists/\";" >> /etc/apt/apt.conf.d/90vdist-cache
+APT_GET="flock $PACKAGE_CACHE_DIR/lock apt-get"
+{% else %}
+APT_GET="apt-get"
+{% endif %}
+{% endblock %}
+
+{% block provision %}{% if not provisioned %}
+vdist_phase provision
+
+# Provisioning section. vdist snapshots the container once this
+# section finishes, so next builds with the same provisioning skip it.
+
+# Install general prerequisites. Package lists are refreshed only if cached
+# ones are older than {{package_lists_ttl}} minutes.
+LISTS_STAMP="$PACKAGE_CACHE_DIR/lists.stamp"
+if [ -z "$PACKAGE_CACHE_DIR" ] || [ -z "$(find $LISTS_STAMP -mmin -{{package_lists_ttl}} 2>/dev/null)" ]; then
+    $APT_GET update
+    if [ -n "$PACKAGE_CACHE_DIR" ]; then
+        touch $LISTS_STAMP
+    fi
+fi
+$APT_GET install ruby-dev build-essential git python-virtualenv curl libssl-dev libsqlite3-dev libgdbm-dev libreadline-dev libbz2-dev libncurses5-dev tk-dev python3 python3-pip -y
 
 # Only install when needed, to save time with
 # pre-provisioned containers.
@@ -17,24 +64,114 @@ fi
 
 {% if build_deps %}
 # Install build dependencies.
-apt-get install -y {{build_deps|join(' ')}}
+$APT_GET install -y {{build_deps|join(' ')}}
 {% endif %}
 
+{% if compile_python and ccache_dir %}
+# Install ccache to reuse objects compiled for python by previous builds.
+$APT_GET install -y ccache
+{% endif %}
+{% endif %}{% endblock %}
+
+VDIST_HOST_DIRS+=({{shared_dir}}{% for host_dir in [pip_cache_dir, wheelhouse_dir, dependencies_cache_dir, ccache_mount_dir, python_cache_dir] if host_dir %} {{host_dir}}{% endfor %})
+
 {% if compile_python %}
+vdist_phase python
+
 # Download and compile what is going to be the Python we are going to use
 # as our portable python environment.
-    echo "deb-src http://archive.ubuntu.com/ubuntu/ xenial main restricted" >> /etc/apt/sources.list
-    apt-get update && apt-get build-dep python -y
-    apt-get install libssl-dev -y
-
-    cd /var/tmp
-    curl -O https://www.python.org/ftp/python/$PYTHON_VERSION/Python-$PYTHON_VERSION.tgz
-    tar xzvf Python-$PYTHON_VERSION.tgz
-    cd Python-$PYTHON_VERSION
-    ./configure --prefix=$PYTHON_BASEDIR --with-ensurepip=install
-    make && make install
+    # Reuse an interpreter compiled by a previous build when host cache has it.
+    PYTHON_CACHE_FILE="{{python_cache_file}}"
+    if [ -n "$PYTHON_CACHE_FILE" ] && [ -f "$PYTHON_CACHE_FILE" ]; then
+        echo "Python interpreter cache hit: $PYTHON_CACHE_FILE"
+        mkdir -p $PYTHON_BASEDIR
+        tar xzf $PYTHON_CACHE_FILE -C $PYTHON_BASEDIR
+    else
+        echo "Python interpreter cache miss: $PYTHON_CACHE_FILE"
+        # Compilation dependencies are only needed when not reusing a
+        # cached interpreter.
+        DEB_SRC="deb-src http://archive.ubuntu.com/ubuntu/ xenial main restricted"
+        grep -qx "$DEB_SRC" /etc/apt/sources.list || echo "$DEB_SRC" >> /etc/apt/sources.list
+        $APT_GET update && $APT_GET build-dep python -y
+        $APT_GET install libssl-dev -y
+        cd /var/tmp
+        curl -O https://www.python.org/ftp/python/$PYTHON_VERSION/Python-$PYTHON_VERSION.tgz
+        tar xzvf Python-$PYTHON_VERSION.tgz
+        cd Python-$PYTHON_VERSION
+        COMPILE_START=$(date +%s.%N)
+        {% if compile_jobs %}
+        COMPILE_JOBS={{compile_jobs}}
+        {% else %}
+        # As many compile jobs as CPUs this container may use, given its CPU
+        # quota if any.
+        COMPILE_JOBS=$(nproc)
+        CPU_QUOTA=""
+        if [ -f /sys/fs/cgroup/cpu.max ]; then
+            read CPU_QUOTA CPU_PERIOD < /sys/fs/cgroup/cpu.max
+        elif [ -f /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then
+            CPU_QUOTA=$(cat /sys/fs/cgroup/cpu/cpu.cfs_quota_us)
+            CPU_PERIOD=$(cat /sys/fs/cgroup/cpu/cpu.cfs_period_us)
+        fi
+        if [[ "$CPU_QUOTA" =~ ^[0-9]+$ ]]; then
+            QUOTA_JOBS=$(( (CPU_QUOTA + CPU_PERIOD - 1) / CPU_PERIOD ))
+            if [ $QUOTA_JOBS -lt $COMPILE_JOBS ]; then
+                COMPILE_JOBS=$QUOTA_JOBS
+            fi
+        fi
+        {% endif %}
+        {% if ccache_mount_dir %}
+        # Objects compiled by previous builds are reused from host ccache
+        # folder, even when they were compiled for another python_basedir.
+        vdist_ccache_stats() {
+            # Print hits and misses so far, for newer and older ccache versions.
+            ccache --print-stats 2>/dev/null | awk '/^(direct|preprocessed)_cache_hit/ {h += $2} /^cache_miss/ {m += $2} END {if (!NR) exit 1; print h + 0, m + 0}' || \
+                ccache -s | awk '/^cache hit \(/ {h += $NF} /^cache miss/ {m += $NF} END {print h + 0, m + 0}'
+        }
+        CCACHE_BEFORE=""
+        if command -v ccache > /dev/null; then
+            export CCACHE_DIR={{ccache_mount_dir}}
+            export CC="ccache gcc"
+            CCACHE_BEFORE=$(vdist_ccache_stats)
+        else
+            echo "ccache not found, compiling python without it."
+        fi
+        {% endif %}
+        CONFIGURE_ARGS=(--prefix=$PYTHON_BASEDIR --with-ensurepip=install)
+        # Configure results are cached for this image and python version. If
+        # cached ones don't fit this build configure fails, so it is run again
+        # from scratch.
+        CONFIGURE_CACHE_FILE="{{configure_cache_file}}"
+        if [ -n "$CONFIGURE_CACHE_FILE" ] && [ -f "$CONFIGURE_CACHE_FILE" ]; then
+            cp $CONFIGURE_CACHE_FILE config.cache
+        fi
+        ./configure --cache-file=config.cache "${CONFIGURE_ARGS[@]}" || \
+            (rm -f config.cache && ./configure --cache-file=config.cache "${CONFIGURE_ARGS[@]}")
+        if [ -n "$CONFIGURE_CACHE_FILE" ]; then
+            cp config.cache $CONFIGURE_CACHE_FILE.$HOSTNAME
+            mv -f $CONFIGURE_CACHE_FILE.$HOSTNAME $CONFIGURE_CACHE_FILE
+            chown {{local_uid}}:{{local_gid}} $CONFIGURE_CACHE_FILE
+        fi
+        make -j $COMPILE_JOBS && make install
+        CCACHE_COUNTS=""
+        {% if ccache_mount_dir %}
+        if [ -n "$CCACHE_BEFORE" ]; then
+            read CCACHE_HITS CCACHE_MISSES <<< "$CCACHE_BEFORE"
+            read CCACHE_HITS_AFTER CCACHE_MISSES_AFTER <<< "$(vdist_ccache_stats)"
+            CCACHE_COUNTS="$((CCACHE_HITS_AFTER - CCACHE_HITS)) $((CCACHE_MISSES_AFTER - CCACHE_MISSES))"
+        fi
+        {% endif %}
+        echo "##vdist-compile $COMPILE_JOBS $COMPILE_START $(date +%s.%N) $CCACHE_COUNTS"
+        if [ -n "$PYTHON_CACHE_FILE" ]; then
+            # Write to a temporary name first so concurrent builds never see
+            # a half written file.
+            tar czf $PYTHON_CACHE_FILE.$HOSTNAME -C $PYTHON_BASEDIR .
+            mv -f $PYTHON_CACHE_FILE.$HOSTNAME $PYTHON_CACHE_FILE
+        fi
+    fi
 {% endif %}
 
+vdist_phase source
+
 # Create temporary folder to place our application files.
 if [ ! -d {{package_tmp_root}} ]; then
     mkdir -p {{package_tmp_root}}
@@ -45,19 +182,50 @@ cd {{package_tmp_root}}
 {% if source.type == 'git' %}
     # Place application files inside temporary folder after dowloading it from
     # git repository.
+    {% if git_mirror %}
+    # Clone from mirror kept by vdist in host cache, sharing its objects
+    # instead of downloading the whole history again. Mirror belongs to
+    # another user, so newer git versions need to be told to trust it.
+    git config --global --add safe.directory '*'
+    git clone --shared{% if source.sparse_path %} --no-checkout{% endif %} {{git_mirror}} {{project_root}}
+    {% elif source.depth or source.sparse_path %}
+    # Download as little as possible: only last commits and, with a sparse
+    # path, only contents of files under it. Git versions too old for that
+    # get a full clone instead.
+    CLONE_START=$(date +%s.%N)
+    git clone --no-checkout{% if source.depth %} --depth {{source.depth}} --branch {{source.branch}}{% endif %}{% if source.sparse_path %} --filter=blob:none{% endif %} {{source.uri}} {{project_root}} || \
+        (rm -rf {{project_root}} && git clone --no-checkout {{source.uri}} {{project_root}})
+    {% else %}
     git clone {{source.uri}}
+    {% endif %}
     cd {{project_root}}
+    {% if source.sparse_path %}
+    git config core.sparseCheckout true
+    echo "/{{source.sparse_path.strip('/')}}/" >> .git/info/sparse-checkout
+    {% endif %}
     git checkout {{source.branch}}
+    {% if not git_mirror and (source.depth or source.sparse_path) %}
+    # Contents of sparse path files are downloaded by checkout, so it is
+    # timed too.
+    echo "##vdist-clone $(du -sb .git | cut -f1) $CLONE_START $(date +%s.%N)"
+    {% endif %}
 
 {% elif source.type in ['directory', 'git_directory'] %}
     # Place application files inside temporary folder after copying it from
-    # local folder.
+    # local folder. Git directories are already exported by vdist from the
+    # requested branch, without any git data.
+    {% if source_mount_dir %}
+    # Source folder is mounted read only, copy just the files listed by vdist.
+    mkdir -p {{project_root}}
+    # A failure reading the source must fail the build too, not leave it
+    # with a partial source tree.
+    set -o pipefail
+    tar -C {{source_mount_dir}} --null --no-recursion -T {{source_file_list}} -cf - | tar -C {{project_root}} -xf -
+    set +o pipefail
+    {% else %}
     cp -r {{scratch_dir}}/{{project_root}} .
-    cd {{package_tmp_root}}/{{project_root}}
-
-    {% if source.type == 'git_directory' %}
-        git checkout {{source.branch}}
     {% endif %}
+    cd {{package_tmp_root}}/{{project_root}}
 
 {% else %}
 
@@ -99,12 +267,73 @@ else
     PIP_BIN="$PYTHON_BASEDIR/bin/pip3"
 fi
 
+vdist_phase dependencies
+
+{% if pip_cache_dir %}
+# Share pip downloads and built wheels with other builds of this profile.
+export PIP_CACHE_DIR={{pip_cache_dir}}
+mkdir -p $PIP_CACHE_DIR
+{% endif %}
+
 # Install package python dependencies inside our portable python environment.
 if [ -f "$PWD{{requirements_path}}" ]; then
-    $PIP_BIN install -U pip setuptools
-    $PIP_BIN install {{pip_args}} -r $PWD{{requirements_path}}
+    REQUIREMENTS_HASH=$(sha256sum $PWD{{requirements_path}} | cut -c1-16)
+    dependencies_restored=false
+    {% if dependencies_cache_dir %}
+    # A python environment with these dependencies already installed may be
+    # kept in host cache by a previous build. Then only the application
+    # itself is installed.
+    DEPENDENCIES_CACHE_FILE={{dependencies_cache_dir}}/$REQUIREMENTS_HASH.tar.gz
+    if [ -f "$DEPENDENCIES_CACHE_FILE" ]; then
+        echo "##vdist-cache dependencies hit"
+        rm -rf $PYTHON_BASEDIR
+        mkdir -p $PYTHON_BASEDIR
+        tar xzf $DEPENDENCIES_CACHE_FILE -C $PYTHON_BASEDIR
+        dependencies_restored=true
+    else
+        echo "##vdist-cache dependencies miss"
+    fi
+    {% endif %}
+    if ! $dependencies_restored; then
+        $PIP_BIN install -U pip setuptools{% if wheelhouse_dir %} wheel{% endif %}
+        {% if wheelhouse_dir %}
+        # Dependency wheels are built once for every python version, platform
+        # and glibc, whatever the profile, and kept in host cache for next runs
+        # of these requirements. Builds sharing them wait for the first one to
+        # build them.
+        ABI_TAG=$($PYTHON_BIN -c "import platform, sys, sysconfig; print('-'.join(['%d.%d' % sys.version_info[:2], str(sysconfig.get_config_var('SOABI')), sysconfig.get_platform()] + list(platform.libc_ver())))")
+        WHEELHOUSE={{wheelhouse_dir}}/$REQUIREMENTS_HASH/$ABI_TAG
+        mkdir -p $WHEELHOUSE
+        if (
+            # Errors are not fatal here, as they are inside a condition.
+            flock 9 || exit 1
+            WHEELS_BEFORE=$(ls $WHEELHOUSE | grep -c '\.whl$' || true)
+            if [ ! -f $WHEELHOUSE/complete ]; then
+                $PIP_BIN wheel {{pip_args}} --find-links $WHEELHOUSE -w $WHEELHOUSE -r $PWD{{requirements_path}} || exit 1
+                touch $WHEELHOUSE/complete
+            fi
+            WHEELS_AFTER=$(ls $WHEELHOUSE | grep -c '\.whl$' || true)
+            echo "##vdist-wheels $((WHEELS_AFTER - WHEELS_BEFORE)) $WHEELS_BEFORE"
+        ) 9>$WHEELHOUSE/.vdist.lock; then
+            $PIP_BIN install --no-index --find-links $WHEELHOUSE -r $PWD{{requirements_path}}
+        else
+            echo "Dependency wheels could not be built, installing them directly."
+            $PIP_BIN install {{pip_args}} -r $PWD{{requirements_path}}
+        fi
+        {% else %}
+        $PIP_BIN install {{pip_args}} -r $PWD{{requirements_path}}
+        {% endif %}
+        {% if dependencies_cache_dir %}
+        # Write to a temporary name first so concurrent builds never see
+        # a half written file.
+        tar czf $DEPENDENCIES_CACHE_FILE.$HOSTNAME -C $PYTHON_BASEDIR .
+        mv -f $DEPENDENCIES_CACHE_FILE.$HOSTNAME $DEPENDENCIES_CACHE_FILE
+        {% endif %}
+    fi
 fi
 
+vdist_phase install
+
 # If we have an installer, install our application inside our portable python
 # environment.
 if [ -f "setup.py" ]; then
@@ -116,9 +345,13 @@ fi
 
 cd /
 
+vdist_phase package
+
+{% if source.type != 'git_directory' %}
 # Get rid of VCS info
 find {{package_tmp_root}} -type d -name '.git' -print0 | xargs -0 rm -rf
 find {{package_tmp_root}} -type d -name '.svn' -print0 | xargs -0 rm -rf
+{% endif %}
 
 # If setup==true then we have installed our application inside our portable python
 # environment, so we package that environment.
@@ -128,7 +361,6 @@ if $setup; then
     {% else %}
         fpm -s dir -t deb -n {{app}} -p {{package_tmp_root}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} $PYTHON_BASEDIR
     {% endif %}
-    cp {{package_tmp_root}}/*deb {{shared_dir}}
 # If setup==false then our application is in a different folder than our
 # portable python environment. So we package both: our application folder and
 # the one with our python package environment. In this case packager should use
@@ -142,7 +374,11 @@ else
     {% else %}
         fpm -s dir -t deb -n {{app}} -p {{package_tmp_root}} -v {{version}} {% for dep in runtime_deps %} --depends {{dep}} {% endfor %} {{fpm_args}} {{package_install_root}}/{{project_root}} $PYTHON_BASEDIR
     {% endif %}
-    cp {{package_tmp_root}}/*deb {{shared_dir}}
 fi
 
-chown -R {{local_uid}}:{{local_gid}} {{shared_dir}}
+# Packages are listed in a manifest so vdist knows exactly which files to
+# deliver.
+for package in {{package_tmp_root}}/*deb; do
+    cp $package {{shared_dir}}
+    basename $package >> {{manifest_file}}
+done
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+
+# The Queue module has been renamed to queue in Python 3
+if sys.version_info[0] == 3:
+    import queue
+else:
+    import Queue as queue
+
+import vdist.defaults as defaults
+
+
+# Progress notifications about a build: name is one of "queued",
+# "phase_changed", "container_started" or "artifact_ready", data holds
+# details of each of them (phase, container_id, path...).
+BuildEvent = collections.namedtuple('BuildEvent',
+                                    ['name', 'build', 'time', 'data'])
+
+
+class BuildResult(object):
+
+    def __init__(self, build):
+        self.build = build
+        self.succeeded = False
+        self.error = None
+        self.build_dir = None
+        self.start_time = None
+        self.end_time = None
+        # Free form statistics about the build (cache hits, timings, etc).
+        self.report = {}
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def as_dict(self):
+        return {'build': self.build.name,
+                'succeeded': self.succeeded,
+                'error': None if self.error is None else str(self.error),
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'duration': self.duration,
+                'report': self.report}
+
+    def save(self, path):
+        """Write this result, report included, as a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+class BuildScheduler(object):
+    """Runs builds through a bounded pool of worker threads.
+
+    Builds are taken from a FIFO queue in the order they were given, so at
+    most max_jobs builds run at once. Builds starting a container call
+    wait_start_slot() right before, so consecutive container starts are
+    separated by at least start_delay seconds, while builds starting none
+    (like those served from result cache) never wait.
+    """
+
+    def __init__(self, max_jobs=defaults.MAX_JOBS,
+                 start_delay=defaults.BUILD_START_DELAY):
+        self.logger = logging.getLogger('BuildScheduler')
+
+        if max_jobs is not None and max_jobs < 1:
+            raise ValueError('max_jobs must be a positive number: %s' %
+                             max_jobs)
+        self.max_jobs = max_jobs
+        self.start_delay = start_delay
+
+        self._start_lock = threading.Lock()
+        self._last_start = None
+
+    def get_workers_number(self, builds_number):
+        if self.max_jobs is None:
+            return builds_number
+        return min(self.max_jobs, builds_number)
+
+    def wait_start_slot(self):
+        with self._start_lock:
+            if self._last_start is not None:
+                remaining = self._last_start + self.start_delay - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+            self._last_start = time.time()
+
+    def _run_one(self, target, result):
+        # Worker threads are renamed after the build they are running, so
+        # log lines keep being identified by build name.
+        current_thread = threading.current_thread()
+        worker_name = current_thread.name
+        current_thread.name = result.build.name
+        result.start_time = time.time()
+        try:
+            target(result.build, result)
+            result.succeeded = True
+        except Exception as e:
+            result.error = e
+            self.logger.exception('Build failed: %s' % result.build.name)
+        finally:
+            result.end_time = time.time()
+            current_thread.name = worker_name
+
+    def execute(self, target, result):
+        """Run target(build, result) for a single build, in current thread."""
+        self._run_one(target, result)
+        return result
+
+    def _worker(self, pending, target):
+        while True:
+            try:
+                result = pending.get_nowait()
+            except queue.Empty:
+                return
+            self.execute(target, result)
+
+    def run(self, builds, target):
+        """Run target(build, result) for every build.
+
+        Returns a list of BuildResult in the same order builds were given.
+        """
+        results = [BuildResult(build) for build in builds]
+        pending = queue.Queue()
+        for result in results:
+            pending.put(result)
+
+        workers = []
+        for worker_number in range(self.get_workers_number(len(results))):
+            t = threading.Thread(
+                name='worker-%d' % worker_number,
+                target=self._worker,
+                args=(pending, target)
+            )
+            workers.append(t)
+            t.start()
+
+        for t in workers:
+            t.join()
+
+        return results
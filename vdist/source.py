@@ -1,7 +1,12 @@
-def git(uri=None, branch='master'):
+def git(uri=None, branch='master', depth=None, sparse_path=None):
+    # depth limits history cloned to that many commits, and sparse_path
+    # checks out (and downloads contents of) only files under that path.
     if uri.endswith('.git'):
         uri = uri[:-4]
-    return dict(type='git', uri=uri, branch=branch)
+    if depth:
+        depth = int(depth)
+    return dict(type='git', uri=uri, branch=branch, depth=depth or None,
+                sparse_path=sparse_path or None)
 
 
 def directory(path=None):
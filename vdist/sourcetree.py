@@ -0,0 +1,495 @@
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+
+import vdist.cache as cache
+import vdist.defaults as defaults
+
+# Block size used when reading files to hash them.
+READ_BLOCK_SIZE = 1024 * 1024
+# Linux ioctl to make a copy on write clone of a file (btrfs, xfs...).
+FICLONE = 0x40049409
+
+
+def to_bytes(text):
+    if defaults.PYTHON3_INTERPRETER:
+        # Undecodable file names are kept as surrogates by os.walk().
+        return text.encode('UTF-8', 'surrogateescape')
+    return text
+
+
+def _hash_file(file_pathname):
+    digest = hashlib.sha256()
+    with open(file_pathname, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _HashIndex(object):
+    """Remembers file hashes between runs, so only files whose size or
+    modification time changed are read again.
+
+    Index is locked from load() to release(), as a source tree may be
+    fingerprinted by several builds at the same time.
+    """
+
+    def __init__(self, root):
+        index_dir = cache.create_dir(
+            cache.get_host_path(defaults.FINGERPRINT_CACHE_SUBDIR))
+        self.index_path = os.path.join(index_dir,
+                                       '%s.json' % cache.make_key(root))
+        self.lock = cache.CacheLock(index_dir)
+        self.entries = {}
+        self.used_entries = {}
+
+    def load(self):
+        self.lock.acquire(shared=False)
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def release(self):
+        self.lock.release()
+
+    def get_hash(self, file_pathname, file_stat):
+        signature = [file_stat.st_size, file_stat.st_mtime, file_stat.st_ino]
+        entry = self.entries.get(file_pathname)
+        if entry is not None and entry[0] == signature:
+            file_hash = entry[1]
+        else:
+            file_hash = _hash_file(file_pathname)
+        self.used_entries[file_pathname] = [signature, file_hash]
+        return file_hash
+
+    def save(self):
+        # Entries of removed files are dropped.
+        file_descriptor, temporary_path = tempfile.mkstemp(
+            prefix='.', dir=os.path.dirname(self.index_path))
+        try:
+            with os.fdopen(file_descriptor, 'w') as f:
+                json.dump(self.used_entries, f)
+            os.rename(temporary_path, self.index_path)
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+
+class IgnoreRules(object):
+    """Exclusion rules with gitignore syntax, usually read from a
+    .vdistignore file at source root.
+
+    Patterns without a slash match at any level, patterns with a slash are
+    relative to source root, a trailing slash matches only directories, "**"
+    matches any number of directories and "!" re-includes a previously
+    excluded path.
+    """
+
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            rule = self._parse_pattern(pattern)
+            if rule is not None:
+                self.rules.append(rule)
+
+    @classmethod
+    def from_directory(cls, path):
+        ignore_file = os.path.join(path, defaults.IGNORE_FILE)
+        if not os.path.isfile(ignore_file):
+            return cls()
+        with open(ignore_file) as f:
+            return cls(f.read().splitlines())
+
+    @staticmethod
+    def _translate(pattern):
+        regex = ''
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+                end = pattern.index(']', i + 1)
+                char_class = pattern[i + 1:end].replace('\\', '\\\\')
+                if char_class.startswith('!'):
+                    char_class = '^' + char_class[1:]
+                regex += '[%s]' % char_class
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    def _parse_pattern(self, pattern):
+        pattern = pattern.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return None
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\'):
+            pattern = pattern[1:]
+        directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            prefix = ''
+            pattern = pattern.lstrip('/')
+        else:
+            prefix = '(?:.*/)?'
+        regex = re.compile('^%s%s$' % (prefix, self._translate(pattern)))
+        return regex, negated, directory_only
+
+    def is_ignored(self, relative_path, is_dir=False):
+        ignored = False
+        for regex, negated, directory_only in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                ignored = not negated
+        return ignored
+
+
+def walk(path, ignore_rules=None):
+    """Like os.walk() but sorted and skipping paths excluded by ignore_rules.
+
+    Yields relative directory path, and its not ignored subdirectories and
+    files.
+    """
+    if ignore_rules is None:
+        ignore_rules = IgnoreRules()
+    for dirpath, dirnames, filenames in os.walk(path):
+        relative_dirpath = os.path.relpath(dirpath, path)
+        if relative_dirpath == '.':
+            relative_dirpath = ''
+        # Links to directories are handled as files, they are not followed.
+        linked_dirs = [dirname for dirname in dirnames
+                       if os.path.islink(os.path.join(dirpath, dirname))]
+        filenames = filenames + linked_dirs
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames
+            if dirname not in linked_dirs and not ignore_rules.is_ignored(
+                os.path.join(relative_dirpath, dirname), is_dir=True))
+        filenames = sorted(
+            filename for filename in filenames
+            if not ignore_rules.is_ignored(
+                os.path.join(relative_dirpath, filename)))
+        yield relative_dirpath, dirnames, filenames
+
+
+def fingerprint_directory(path, excluded_dirs=(), ignore_rules=None):
+    """Hash of every file content, relative path and executable bit under
+    path."""
+    digest = hashlib.sha256()
+    hash_index = _HashIndex(os.path.abspath(path))
+    hash_index.load()
+    try:
+        for relative_dirpath, dirnames, filenames in walk(path,
+                                                          ignore_rules):
+            dirnames[:] = [dirname for dirname in dirnames
+                           if dirname not in excluded_dirs]
+            for filename in filenames:
+                relative_pathname = os.path.join(relative_dirpath, filename)
+                file_pathname = os.path.join(path, relative_pathname)
+                file_stat = os.lstat(file_pathname)
+                if stat.S_ISLNK(file_stat.st_mode):
+                    content = 'link:%s' % os.readlink(file_pathname)
+                elif stat.S_ISREG(file_stat.st_mode):
+                    content = '%o:%s' % (file_stat.st_mode & 0o111,
+                                         hash_index.get_hash(file_pathname,
+                                                             file_stat))
+                else:
+                    continue
+                digest.update(to_bytes('%s\0%s\0' % (relative_pathname,
+                                                       content)))
+        hash_index.save()
+    finally:
+        hash_index.release()
+    return digest.hexdigest()
+
+
+def _run_git(args):
+    try:
+        output = subprocess.check_output(['git'] + args,
+                                         stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.getLogger('SourceTree').warning(
+            'git %s failed: %s' % (' '.join(args), e))
+        return None
+    return output.decode('UTF-8').strip()
+
+
+def _has_commit(repository_dir, treeish):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(
+            ['git', '-C', repository_dir, 'rev-parse', '--verify', '--quiet',
+             '%s^{commit}' % treeish], stdout=devnull, stderr=devnull) == 0
+
+
+def resolve_git_branch(repository_dir, branch):
+    """Return what to ask git for to get branch of repository at
+    repository_dir.
+
+    Like git checkout does, a branch not created locally yet is taken from
+    its remote tracking one at origin.
+    """
+    if not _has_commit(repository_dir, branch) and \
+            _has_commit(repository_dir, 'origin/%s' % branch):
+        return 'origin/%s' % branch
+    return branch
+
+
+def _get_remote_commit(uri, branch):
+    output = _run_git(['ls-remote', uri, branch])
+    if not output:
+        return None
+    return output.split()[0]
+
+
+def fingerprint(source):
+    """Fingerprint of a build source, or None if it cannot be computed."""
+    if source['type'] == 'git':
+        commit = _get_remote_commit(source['uri'], source['branch'])
+        if commit is None:
+            return None
+        return cache.make_key(source['uri'], commit)
+    if source['type'] == 'directory':
+        return fingerprint_directory(
+            source['path'],
+            ignore_rules=IgnoreRules.from_directory(source['path']))
+    if source['type'] == 'git_directory':
+        # Builds get files of branch tree, exported from git, and nothing
+        # else.
+        branch = resolve_git_branch(source['path'], source['branch'])
+        tree = _run_git(['-C', source['path'], 'rev-parse',
+                         '%s^{tree}' % branch])
+        if tree is None:
+            return None
+        return cache.make_key(source['type'], tree)
+    return None
+
+
+class SyncStats(object):
+
+    def __init__(self):
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.reused_files = 0
+        self.removed_files = 0
+
+    def __str__(self):
+        return ('%d files copied (%d bytes), %d reused, %d removed' %
+                (self.copied_files, self.copied_bytes, self.reused_files,
+                 self.removed_files))
+
+
+def _clone_file(source_pathname, target_pathname):
+    # Try a copy on write clone first, it shares data blocks so it is as
+    # fast as a hard link but target can be changed independently.
+    with open(source_pathname, 'rb') as source_file:
+        with open(target_pathname, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE,
+                            source_file.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(source_file, target_file,
+                                   READ_BLOCK_SIZE)
+    shutil.copystat(source_pathname, target_pathname)
+
+
+def _is_up_to_date(source_pathname, source_stat, target_pathname):
+    try:
+        target_stat = os.lstat(target_pathname)
+    except OSError:
+        return False
+    if stat.S_IFMT(source_stat.st_mode) != stat.S_IFMT(target_stat.st_mode):
+        return False
+    if stat.S_ISLNK(source_stat.st_mode):
+        return os.readlink(source_pathname) == os.readlink(target_pathname)
+    return (source_stat.st_size == target_stat.st_size and
+            source_stat.st_mtime == target_stat.st_mtime and
+            stat.S_IMODE(source_stat.st_mode) ==
+            stat.S_IMODE(target_stat.st_mode))
+
+
+def _remove(pathname):
+    if os.path.isdir(pathname) and not os.path.islink(pathname):
+        shutil.rmtree(pathname)
+    else:
+        os.remove(pathname)
+
+
+def sync_tree(source_dir, target_dir, ignore_rules=None):
+    """Make target_dir a copy of source_dir, copying only changed files.
+
+    Changed files are written aside and renamed, so hard links to previous
+    versions of target files keep their old contents.
+    """
+    stats = SyncStats()
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    for relative_dirpath, dirnames, filenames in walk(source_dir,
+                                                      ignore_rules):
+        current_target_dir = os.path.join(target_dir, relative_dirpath)
+        wanted = set(dirnames) | set(filenames)
+        for existing in os.listdir(current_target_dir):
+            if existing not in wanted:
+                _remove(os.path.join(current_target_dir, existing))
+                stats.removed_files += 1
+        for dirname in dirnames:
+            target_pathname = os.path.join(current_target_dir, dirname)
+            if os.path.islink(target_pathname) or \
+                    not os.path.isdir(target_pathname):
+                if os.path.lexists(target_pathname):
+                    _remove(target_pathname)
+                os.mkdir(target_pathname)
+        for filename in filenames:
+            source_pathname = os.path.join(source_dir, relative_dirpath,
+                                           filename)
+            target_pathname = os.path.join(current_target_dir, filename)
+            source_stat = os.lstat(source_pathname)
+            if _is_up_to_date(source_pathname, source_stat, target_pathname):
+                stats.reused_files += 1
+                continue
+            temporary_pathname = os.path.join(
+                current_target_dir, '.%s.vdist-tmp' % filename)
+            if stat.S_ISLNK(source_stat.st_mode):
+                os.symlink(os.readlink(source_pathname), temporary_pathname)
+            elif stat.S_ISREG(source_stat.st_mode):
+                _clone_file(source_pathname, temporary_pathname)
+                stats.copied_bytes += source_stat.st_size
+            else:
+                continue
+            if os.path.isdir(target_pathname) and \
+                    not os.path.islink(target_pathname):
+                shutil.rmtree(target_pathname)
+            os.rename(temporary_pathname, target_pathname)
+            stats.copied_files += 1
+    return stats
+
+
+def link_tree(source_dir, target_dir):
+    """Recreate source_dir at target_dir using hard links to its files.
+
+    Falls back to copies when hard links are not possible (i.e. different
+    filesystems).
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        relative_dirpath = os.path.relpath(dirpath, source_dir)
+        current_target_dir = os.path.normpath(
+            os.path.join(target_dir, relative_dirpath))
+        os.makedirs(current_target_dir)
+        for name in dirnames + filenames:
+            source_pathname = os.path.join(dirpath, name)
+            target_pathname = os.path.join(current_target_dir, name)
+            if os.path.islink(source_pathname):
+                os.symlink(os.readlink(source_pathname), target_pathname)
+                if name in dirnames:
+                    # Don't walk into linked directories.
+                    dirnames.remove(name)
+            elif name in filenames:
+                try:
+                    os.link(source_pathname, target_pathname)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM,
+                                       errno.EMLINK):
+                        raise
+                    shutil.copy2(source_pathname, target_pathname)
+
+
+class ExportStats(object):
+
+    def __init__(self):
+        self.exported_files = 0
+        self.exported_bytes = 0
+        self.archive_bytes = 0
+
+    def __str__(self):
+        return ('%d files exported (%d bytes, %d bytes of archive)' %
+                (self.exported_files, self.exported_bytes,
+                 self.archive_bytes))
+
+
+class _CountingReader(object):
+    # File like wrapper counting bytes read from a stream.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def export_git_tree(repository_dir, treeish, target_dir, path=None):
+    """Extract files of treeish (only those under path, if given) from
+    repository at repository_dir into target_dir.
+
+    Files are streamed from git archive, so neither git data nor other
+    branches or uncommitted changes of working copy get to target_dir.
+    """
+    command = ['git', '-C', repository_dir, 'archive', '--format=tar',
+               treeish]
+    if path:
+        command.extend(['--', path])
+    stats = ExportStats()
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    reader = _CountingReader(process.stdout)
+    tar_error = None
+    try:
+        archive = tarfile.open(fileobj=reader, mode='r|')
+        for member in archive:
+            if hasattr(tarfile, 'tar_filter'):
+                archive.extract(member, target_dir, filter='tar')
+            else:
+                archive.extract(member, target_dir)
+            if member.isfile():
+                stats.exported_files += 1
+                stats.exported_bytes += member.size
+    except tarfile.TarError as e:
+        tar_error = e
+    finally:
+        git_error = process.communicate()[1]
+    # A failed git archive gives no archive at all, its error tells why.
+    if process.returncode != 0:
+        raise GitExportException(
+            'git archive of %s in %s failed: %s' %
+            (treeish, repository_dir,
+             git_error.decode('UTF-8', 'replace').strip()))
+    if tar_error is not None:
+        raise GitExportException('git archive of %s in %s could not be '
+                                 'extracted: %s' %
+                                 (treeish, repository_dir, tar_error))
+    stats.archive_bytes = reader.bytes_read
+    return stats
+
+
+class GitExportException(Exception):
+    pass
@@ -35,8 +35,15 @@ def _load_default_configuration(arguments):
 def main(args=sys.argv[1:]):
     console_arguments = console_parser.parse_arguments(args)
     configurations = _get_build_configurations(console_arguments)
-    for _configuration in configurations:
-        builder.build_package(configurations[_configuration])
+    max_jobs = console_arguments.get("jobs", None)
+    results = builder.build_packages(
+        configurations,
+        max_jobs=max_jobs,
+        use_result_cache=not console_arguments.get("no_cache", False),
+        rebuild=console_arguments.get("rebuild", False))
+    # Any failed build fails the command, so scripts and CI notice it.
+    if not all(result.succeeded for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":